@@ -5,10 +5,20 @@ import yaml
 import time
 import argparse
 import json
-import requests
 import sys
 import os
 import pandas as pd
+import asyncio
+import tempfile
+## shared orchestration helpers live next to the deployment scripts
+## inserted first, so datasets / settings are not shadowed by installed packages of the same name
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "create-deployments"))
+from polling import poller
+from api_client import get_client
+from datasets import prune_dataset_versions
+from rate_limit import call_with_retry, acall_with_retry
+from monitoring_data import DEFAULT_CHUNK_SIZE, PREDICTION_MARKER, read_header, tracked_features, prepare_monitoring_dataset
+from mlops_monitoring import report_with_mlops, report_aggregated
 
 logging.basicConfig(
     level=logging.INFO,
@@ -16,37 +26,101 @@ logging.basicConfig(
     format='%(asctime)s %(filename)s:%(lineno)d %(levelname)s %(message)s',
 )
 logger = logging.getLogger(__name__)
-client = dr.Client() 
+client = get_client()
 
-## check number of versions and delete old ones
-## datarobot  has a soft 100 version limit on registered datasets.  
-## thie function is will delete old version (fifo) based on limit arg
-def purge_old_dataset_version(dataset_id, limit=100):
-    limit = limit - 1
-    dataset_url = f"datasets/{dataset_id}/versions?limit={limit}"
-    total_count = client.get(dataset_url).json()['totalCount']
-    logger.info(f"number of versions of prediction dataset: {total_count}")
-    logger.info(f"number of versions allowed: {limit + 1}")
-    deletion = total_count - limit
-    if deletion > 0:
-        logger.info(f"number of versions to delete before registering new version (FIFO): { deletion }")
-    def helper(dataset_url): 
-        dataset_versions = client.get(dataset_url).json()
-        if "offset" in dataset_url:
-            logger.info("deleting old versions")
-            for d in dataset_versions["data"]:
-                logger.info(f"deleting datasets/{d['datasetId']}/versions/{d['versionId']}/")
-                delete_req = client.delete(f"datasets/{d['datasetId']}/versions/{d['versionId']}/")
-                if delete_req.status_code >= 400:
-                    logger.error(delete_req.json())
-                    raise Exception(delete_req.json())
-                else:
-                    logger.info("dataset version deleted successfully")
-        if next := dataset_versions.get("next"):
-            query_parameters = next.split("/")[-1]
-            next_url = os.path.join( dataset_url.split("?")[0], query_parameters)
-            helper(next_url)
-    helper(dataset_url)
+## pages of batchJobs/ (newest first) read per polling round before falling back to one GET per job
+MAX_LIST_PAGES = 3
+PENDING_STATUSES = ["INITIALIZING", "RUNNING"]
+
+def create_job_definition(model, prediction_dataset_id):
+    logger.info(f"creating monitoring job for {model['prediction_column']}")
+    monitoring_job_payload = {
+        "deploymentId":model["deployment_id"],
+        "monitoringAggregation": None,
+        "intakeSettings":{"type":"dataset","datasetId":prediction_dataset_id},
+        "name":f"Rental Calc Monitoring {model['prediction_column']}",
+        "enabled":False,
+        "monitoringColumns": {"predictionsColumns":model["prediction_column"]}}
+    monitoring_job_response = client.post("batchMonitoringJobDefinitions/", data = monitoring_job_payload)
+    monitoring_job_response.raise_for_status()
+    ## recorded straight away, so a failure from here on does not create the definition again
+    model["batch_monitoring_job_id"] = monitoring_job_response.json()["id"]
+    return model["batch_monitoring_job_id"]
+
+def clear_monitoring_aggregation(model):
+    payload_patch = {"monitoringAggregation":None}
+    ## keep_attrs, otherwise the client drops the null before sending it
+    client.patch(f"batchMonitoringJobDefinitions/{model['batch_monitoring_job_id']}/", 
+                 data = payload_patch, keep_attrs = ["monitoringAggregation"])
+
+def launch_job(model):
+    logger.info(f"running monitoring job for {model['prediction_column']}")
+    job_run_payload = {"jobDefinitionId":model["batch_monitoring_job_id"]}
+    job_run_response = client.post("batchJobs/fromJobDefinition/", data = job_run_payload)
+    job_run_response.raise_for_status()
+    return job_run_response.json()
+
+async def start_jobs(models, prediction_dataset_id, max_parallel=8):
+    """
+    create the missing job definitions and launch a job from each, at most max_parallel models
+    at a time, each model's job launched as soon as its definition exists.  definition ids are
+    set on the models as soon as they are created, so when one model fails the others (and its
+    own, if the definition was created) are still recorded and not created again on the next run.  returns a job (or the exception) per model.
+    """
+    semaphore = asyncio.Semaphore(max_parallel)
+    async def _start(model):
+        async with semaphore:
+            ## the POSTs are creates, only retried on 429 / 503 so a gateway error can't make a second one
+            if not model.get("batch_monitoring_job_id"):
+                await acall_with_retry(create_job_definition, model, prediction_dataset_id,
+                                       name=f"{model['prediction_column']} job definition", idempotent=False)
+                await acall_with_retry(clear_monitoring_aggregation, model, name=f"{model['prediction_column']} job definition update")
+            return await acall_with_retry(launch_job, model, name=f"{model['prediction_column']} job launch", idempotent=False)
+    return await asyncio.gather(*[_start(model) for model in models], return_exceptions=True)
+
+def fetch_batch_jobs(job_ids, page_size=100):
+    """
+    {job id: state} for job_ids from a few pages of the batchJobs/ list, which has the newest
+    jobs first.  jobs not found there are fetched one by one.
+    """
+    wanted = set(job_ids)
+    states = {}
+    if len(wanted) > 1:
+        url = f"batchJobs/?limit={page_size}&offset=0"
+        for _ in range(MAX_LIST_PAGES):
+            page = client.get(url).json()
+            states.update({job["id"]: job for job in page["data"] if job["id"] in wanted})
+            if len(states) == len(wanted) or not page.get("next"):
+                break
+            ## next is an absolute url, keep just the paging parameters
+            url = f"batchJobs/?{page['next'].split('?', 1)[1]}"
+    for job_id in wanted - states.keys():
+        states[job_id] = client.get(f"batchJobs/{job_id}/").json()
+    return states
+
+def log_job(job_id, job):
+    if job["status"] == "COMPLETED":
+        logger.info(job['batchMonitoringJobDefinition']['name'])
+        logger.info(job["logs"][-1])
+    elif job["status"] in ["ABORTED", "FAILED"]:
+        logger.error( job["logs"][-1])
+
+async def wait_for_batch_jobs(batch_jobs, max_interval=10):
+    """
+    wait on every batch job with one list call per round, with backoff, and return as soon as
+    the last one is done.  each job is logged as it finishes.
+    """
+    states = await poller.wait_group(f"{len(batch_jobs)} batch jobs", [job["id"] for job in batch_jobs], fetch_batch_jobs,
+                                     lambda job: job["status"] not in PENDING_STATUSES, on_done=log_job,
+                                     initial_interval=2, max_interval=max_interval)
+    return [states[job["id"]] for job in batch_jobs]
+
+def remove_input_files(prediction_dataset_path, input_dataset_path):
+    logger.info("removing prediction dataset from disk")
+    Path(prediction_dataset_path).unlink()
+    if input_dataset_path:
+        logger.info("removing input dataset from disk")
+        Path(input_dataset_path).unlink()
 
 def parse_args():
     parser = argparse.ArgumentParser(
@@ -55,6 +129,11 @@ def parse_args():
     parser.add_argument('--deployment-conf', help='deployment configuration yaml.')
     parser.add_argument('--prediction-dataset', help='prediction dataset csv (includes predictions and inputs)')
     parser.add_argument('--input-dataset', help='input dataset csv (includes features for the mondel)')
+    parser.add_argument('--poll-deadline', type=float, help='seconds to wait in total for the monitoring jobs before giving up', default=None)
+    parser.add_argument('--max-parallel', type=int, help='models whose job definition is created / job launched at once', default=8)
+    parser.add_argument('--chunk-size', type=int, help='rows read from the csvs at a time while preparing the monitoring dataset', default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument('--mode', choices=['jobs', 'mlops', 'aggregated'], help='jobs: upload a dataset and run a batch monitoring job per deployment.  mlops: report every deployment from one local pass with the mlops library.  aggregated: like mlops, but only feature / prediction statistics computed locally are reported', default='jobs')
+    parser.add_argument('--mlops-spool-dir', help='--mode mlops / aggregated: filesystem spooler directory for the mlops agent.  Defaults to the MLOPS_* environment configuration', default=None)
     return parser.parse_args()
 
 def main():
@@ -62,6 +141,7 @@ def main():
     deployment_conf_path = args.deployment_conf
     prediction_dataset_path = args.prediction_dataset
     input_dataset_path = args.input_dataset
+    poller.set_deadline(args.poll_deadline)
     deployment_conf_path = Path(deployment_conf_path)
     prediction_dataset_path = Path(prediction_dataset_path)
     
@@ -69,17 +149,17 @@ def main():
         with open(deployment_conf_path, "r") as f:
             deployment_conf = yaml.load(f, Loader = yaml.SafeLoader)
         MONITOR = True
-        pred_df = pd.read_csv(str(prediction_dataset_path))
-        if Path(input_dataset_path).exists():
+        ## only the headers are read here, the data is streamed into the upload file below
+        received_columns = read_header(prediction_dataset_path)
+        if input_dataset_path and Path(input_dataset_path).exists():
             logger.info(f"input dataset is available at {input_dataset_path}")
-            input_df = pd.read_csv(str(input_dataset_path))
-            monitoring_df = pred_df.join(input_df)
+            received_columns += read_header(input_dataset_path)
         else:
-            monitoring_df = pred_df.copy()
-            logger.warning(f"{str(input_dataset_path)} does NOT exist or was not provided.")
+            input_dataset_path = None
+            logger.warning(f"{str(args.input_dataset)} does NOT exist or was not provided.")
             logger.warning(f"no feature drift will be monitoring for this run")
         expected_pred_columns = [d["prediction_column"] for d in deployment_conf["deployments"]]
-        received_pred_columns = [ p for p in monitoring_df.columns if 'ADJ_PRED_RENTAL_DAYS_' in p]
+        received_pred_columns = [ p for p in received_columns if PREDICTION_MARKER in p]
         num_missing = 0
         invalid_pred_columns = []
         for rpc in received_pred_columns:
@@ -93,75 +173,44 @@ def main():
         MONITOR = False
         raise Exception("Deployment configuration or prediction dataset does not exist!! Monitoring not available")
 
-    if MONITOR: 
+    if MONITOR and args.mode in ["mlops", "aggregated"]:
+        ## one pass over the files, reported to every deployment locally: no dataset upload, no server side jobs
+        report = report_aggregated if args.mode == "aggregated" else report_with_mlops
+        report(deployment_conf, prediction_dataset_path, input_dataset_path, features=tracked_features(deployment_conf),
+               chunk_size=args.chunk_size, spool_dir=args.mlops_spool_dir)
+        remove_input_files(prediction_dataset_path, input_dataset_path)
+
+    elif MONITOR: 
+        workdir = tempfile.TemporaryDirectory(prefix="batch-monitoring-")
+        ## pruned to the columns monitoring uses and joined chunk by chunk, so memory stays flat however large the csvs are
+        monitoring_path = prepare_monitoring_dataset(prediction_dataset_path, input_dataset_path, workdir.name, "Rental Calc Prediction Data",
+                                                     features=tracked_features(deployment_conf), chunk_size=args.chunk_size)
         if prediction_dataset_id := deployment_conf.get("prediction_dataset_id"):
             logger.info("prediction dataset id present")
-            purge_old_dataset_version(prediction_dataset_id)
+            ## datarobot has a soft limit of 100 versions per dataset, make room for the new one
+            prune_dataset_versions(prediction_dataset_id, keep=99)
             logger.info("registering new version")                        
-            # prediction_dataset = dr.Dataset.create_version_from_file(prediction_dataset_id, str(prediction_dataset_path))
-            prediction_dataset = dr.Dataset.create_version_from_in_memory_data(prediction_dataset_id, monitoring_df)
+            prediction_dataset = call_with_retry(dr.Dataset.create_version_from_file, prediction_dataset_id, str(monitoring_path), name="prediction dataset upload", idempotent=False)
         else:
             logger.info("register prediction dataset")
-            # prediction_dataset = dr.Dataset.create_from_file(str(prediction_dataset_path), fname = f"Rental Calc Prediction Data")    
-            prediction_dataset = dr.Dataset.create_from_in_memory_data(monitoring_df, fname = f"Rental Calc Prediction Data") 
+            prediction_dataset = call_with_retry(dr.Dataset.create_from_file, str(monitoring_path), name="prediction dataset upload", idempotent=False)
             logger.info("recording prediction dataset id to deployment config")
             deployment_conf["prediction_dataset_id"] = prediction_dataset.id     
+        workdir.cleanup()
         
         logger.info("done with prediction dataset registration")
     
-        for model in deployment_conf.get("deployments"):
-            if model.get("batch_monitoring_job_id"):
-                pass
-            else: 
-                logger.info(f"creating monitoring job for {model['prediction_column']}")
-                monitoring_job_payload = {
-                    "deploymentId":model["deployment_id"],
-                    "monitoringAggregation": None,
-                    "intakeSettings":{"type":"dataset","datasetId":deployment_conf["prediction_dataset_id"]},
-                    "name":f"Rental Calc Monitoring {model['prediction_column']}",
-                    "enabled":False,
-                    "monitoringColumns": {"predictionsColumns":model["prediction_column"]}}
-                monitoring_job_response = client.post("batchMonitoringJobDefinitions/", data = monitoring_job_payload)
-                monitoring_job_response.raise_for_status()
-                payload_patch = {"monitoringAggregation":None}
-                batch_monitoring_job_id = monitoring_job_response.json()["id"]
-                patch_response = requests.patch( f"{client.endpoint}/batchMonitoringJobDefinitions/{batch_monitoring_job_id}/", 
-                              headers = { 
-                                  "Authorization": f"Bearer {client.token}",
-                                  'Content-Type': "application/json" 
-                              },
-                              data = json.dumps(payload_patch))
-                model["batch_monitoring_job_id"] = batch_monitoring_job_id
-                logger.info("recording batch monitoring job id to deployment config")
-            
+        batch_jobs = asyncio.run(start_jobs(deployment_conf["deployments"], deployment_conf["prediction_dataset_id"], args.max_parallel))
+        logger.info("recording batch monitoring job ids to deployment config")
         logger.info(f"writing deployemnt config to {str(deployment_conf_path)}")
         with open(str(deployment_conf_path), "w") as f:
             f.write(yaml.dump(deployment_conf))
-
-        batch_jobs = []
-        for model in deployment_conf["deployments"]:
-            logger.info(f"running monitoring job for {model['prediction_column']}")
-            job_run_payload = {"jobDefinitionId":model["batch_monitoring_job_id"]}
-            job_run_response = client.post("batchJobs/fromJobDefinition/", data = job_run_payload)
-            job_run_response.raise_for_status()
-            batch_jobs.append(job_run_response.json())
+        if errors := [job for job in batch_jobs if isinstance(job, BaseException)]:
+            raise errors[0]
         logger.info(f"{len(batch_jobs)} monitoring jobs in process!")
         
-        for job in batch_jobs:
-            job = client.get(f"batchJobs/{job['id']}").json()
-            while job["status"] in ["INITIALIZING", "RUNNING"]:
-                job = client.get(f"batchJobs/{job['id']}").json()
-                time.sleep(5)
-            if job["status"] == "COMPLETED":
-                logger.info(job['batchMonitoringJobDefinition']['name'])
-                logger.info(job["logs"][-1])
-            elif job["status"] in ["ABORTED", "FAILED"]:
-                logger.error( job["logs"][-1])
-        logger.info("removing prediction dataset from disk")
-        Path(prediction_dataset_path).unlink()
-        if input_dataset_path:
-            logger.info("removing input dataset from disk")
-            Path(input_dataset_path).unlink()
+        asyncio.run(wait_for_batch_jobs(batch_jobs))
+        remove_input_files(prediction_dataset_path, input_dataset_path)
         
     else:
         logger.info("monitoring was not enabled -> either missing deployment conf yaml or prediction datasets")
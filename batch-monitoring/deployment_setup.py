@@ -10,8 +10,11 @@ import sys
 import pandas as pd 
 import numpy as np 
 import datetime
-
-client = dr.Client() 
+## shared orchestration helpers live next to the deployment scripts
+## inserted first, so datasets / settings are not shadowed by installed packages of the same name
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "create-deployments"))
+from api_client import get_client
+from datasets import register_training_dataset, dataset_index_path
 
 logging.basicConfig(
     level=logging.INFO,
@@ -19,7 +22,7 @@ logging.basicConfig(
     format='%(asctime)s %(filename)s:%(lineno)d %(levelname)s %(message)s',
 )
 logger = logging.getLogger(__name__)
-client = dr.Client() 
+client = get_client() 
 
 def parse_args():
     parser = argparse.ArgumentParser(
@@ -30,26 +33,6 @@ def parse_args():
     parser.add_argument('--training-dataset', help='training dataset csv (includes target and feature).  Cannot be used with training-dataset-id')
     return parser.parse_args()
 
-def purge_old_dataset_version(dataset_id, limit=100):
-    limit = limit - 1
-    dataset_url = f"datasets/{dataset_id}/versions?limit={limit}"
-    def helper(dataset_url): 
-        dataset_versions = client.get(dataset_url).json()
-        if "offset" in dataset_url:
-            print("off set present, deleting old versions")
-            for d in dataset_versions["data"]:
-                print(f"datasets/{d['datasetId']}/versions/{d['versionId']}/")
-                delete_req = client.delete(f"datasets/{d['datasetId']}/versions/{d['versionId']}/")
-                print(delete_req)
-        if next := dataset_versions.get("next"):
-            print(next)
-            print(dataset_url)
-            query_parameters = next.split("/")[-1]
-            next_url = os.path.join( dataset_url.split("?")[0], query_parameters)
-            print(next_url)
-            helper(next_url)
-    helper(dataset_url)
-
 def main():
     args = parse_args()
     deployment_conf_path = args.deployment_conf
@@ -88,11 +71,11 @@ def main():
         training_dataset_path = Path(training_dataset_path)
         if existing_training_dataset_id := deployment_conf.get("training_dataset_id"):
             logger.info("training dataset id present in conf, registering new version")
-            purge_old_dataset_version(existing_training_dataset_id)
-            training_dataset = dr.Dataset.create_version_from_file(existing_training_dataset_id, str(training_dataset_path))
+            training_dataset = register_training_dataset(existing_training_dataset_id, training_dataset_path, keep_versions=100,
+                                                         index_path=dataset_index_path(deployment_conf_path))
         else:
             logger.info("register training dataset")
-            training_dataset = dr.Dataset.create_from_file(str(training_dataset_path))    
+            training_dataset = register_training_dataset(None, training_dataset_path, index_path=dataset_index_path(deployment_conf_path))
             logger.info("recording training dataset id to deployment config")
             deployment_conf["training_dataset_id"] = training_dataset.id   
     elif training_dataset_id is not None and training_dataset_path is None:
@@ -0,0 +1,134 @@
+import os
+import time
+import logging
+
+import pandas as pd
+
+from entity_cache import get_deployment, prime_deployments
+from settings import ASSOCIATION_ID_COLUMN
+from monitoring_data import DEFAULT_CHUNK_SIZE, PREDICTION_MARKER, iter_monitoring_chunks
+
+logger = logging.getLogger(__name__)
+
+
+def init_mlops(spool_dir=None, feature_types=None):
+    """
+    the mlops library set up like custom.py does at serving time (spooler from the MLOPS_* env
+    vars), or with a filesystem spooler in spool_dir for an mlops agent to forward.  feature_types
+    are needed for report_aggregated_predictions_data and can only be set before init.
+    """
+    ## datarobot-mlops is only needed for this mode, see requirements
+    try:
+        from datarobot_mlops.mlops import MLOps
+    except ImportError:
+        raise Exception("--mode mlops needs the datarobot-mlops package (pip install datarobot-mlops)")
+    mlops = MLOps()
+    if spool_dir:
+        os.makedirs(spool_dir, exist_ok=True)
+        mlops.set_filesystem_spooler(str(spool_dir))
+    if feature_types:
+        mlops.set_feature_types(feature_types)
+    return mlops.init()
+
+
+def model_ids(deployments):
+    """{deployment id: id of the model it currently serves}, from a few list calls"""
+    deployment_ids = [model["deployment_id"] for model in deployments]
+    prime_deployments(deployment_ids)
+    return {deployment_id: get_deployment(deployment_id).model["id"] for deployment_id in deployment_ids}
+
+
+def report_with_mlops(deployment_conf, prediction_path, input_path=None, features=None, chunk_size=DEFAULT_CHUNK_SIZE, spool_dir=None):
+    """
+    read the prediction (and input) csv once and report the tracked features and each
+    deployment's prediction column to every deployment of deployment_conf through the mlops
+    library, instead of uploading a dataset for one server side monitoring job per deployment.
+    returns {deployment id: rows reported}.
+    """
+    deployments = deployment_conf["deployments"]
+    ids = model_ids(deployments)
+    mlops = init_mlops(spool_dir)
+    reported = {model["deployment_id"]: 0 for model in deployments}
+    start = time.monotonic()
+    try:
+        for chunk in iter_monitoring_chunks(prediction_path, input_path, features, chunk_size):
+            ## prediction columns are matched to the conf after sanitizing, like the column check in batch_monitoring.py
+            prediction_columns = {c.replace(".", "_"): c for c in chunk.columns if PREDICTION_MARKER in c}
+            feature_columns = [c for c in chunk.columns if PREDICTION_MARKER not in c and c != ASSOCIATION_ID_COLUMN]
+            features_df = chunk[feature_columns] if feature_columns else None
+            if features_df is not None:
+                ## the spooler serializes to json, which has no pd.NA
+                features_df = features_df.astype(object).where(features_df.notna(), None)
+            association_ids = chunk[ASSOCIATION_ID_COLUMN].tolist() if ASSOCIATION_ID_COLUMN in chunk.columns else None
+            for model in deployments:
+                if (column := prediction_columns.get(model["prediction_column"])) is None:
+                    continue
+                mlops.report_predictions_data(features_df=features_df, predictions=chunk[column].tolist(), association_ids=association_ids,
+                                              deployment_id=model["deployment_id"], model_id=ids[model["deployment_id"]])
+                reported[model["deployment_id"]] += len(chunk)
+    finally:
+        mlops.shutdown()
+    for model in deployments:
+        if not reported[model["deployment_id"]]:
+            logger.warning(f"{model['prediction_column']}: no predictions reported for deployment {model['deployment_id']}")
+    logger.info(f"reported {sum(reported.values())} rows to {len(deployments)} deployments in {time.monotonic() - start:.1f}s")
+    return reported
+
+
+def feature_types(chunk, columns):
+    """aggregation types from the dtypes monitoring_data.column_dtypes gives the chunks"""
+    from datarobot_mlops.stats_aggregator.types import FeatureDescriptor, FeatureType
+    types = []
+    for column in columns:
+        if pd.api.types.is_bool_dtype(chunk[column]):
+            types.append(FeatureDescriptor(column, FeatureType.BOOLEAN))
+        elif pd.api.types.is_numeric_dtype(chunk[column]):
+            types.append(FeatureDescriptor(column, FeatureType.NUMERIC))
+        else:
+            types.append(FeatureDescriptor(column, FeatureType.CATEGORY))
+    return types
+
+
+def report_aggregated(deployment_conf, prediction_path, input_path=None, features=None, chunk_size=DEFAULT_CHUNK_SIZE, spool_dir=None):
+    """
+    like report_with_mlops, but only statistics are reported: for every chunk, the histograms /
+    category counts of the tracked features and a summary of each deployment's predictions are
+    computed locally by the mlops library (report_aggregated_predictions_data) and one record per
+    chunk and deployment is spooled, so what is sent depends on the number of features, bins and
+    chunks, not rows.  accuracy needs the raw rows, association ids are not reported.  returns
+    {deployment id: rows aggregated}.
+    """
+    try:
+        import datarobot_mlops.stats_aggregator  # noqa: F401 - the aggregator is an extra
+    except ImportError:
+        raise Exception("--mode aggregated needs the datarobot-mlops aggregator (pip install datarobot-mlops[aggregator])")
+    deployments = deployment_conf["deployments"]
+    ids = model_ids(deployments)
+    reported = {model["deployment_id"]: 0 for model in deployments}
+    mlops = None
+    feature_columns = []
+    start = time.monotonic()
+    try:
+        for chunk in iter_monitoring_chunks(prediction_path, input_path, features, chunk_size):
+            prediction_columns = {c.replace(".", "_"): c for c in chunk.columns if PREDICTION_MARKER in c}
+            feature_columns = [c for c in chunk.columns if PREDICTION_MARKER not in c and c != ASSOCIATION_ID_COLUMN]
+            if mlops is None:
+                ## the feature types can only be set before init, they come from the dtypes of the first chunk
+                mlops = init_mlops(spool_dir, feature_types(chunk, feature_columns))
+            for model in deployments:
+                if (column := prediction_columns.get(model["prediction_column"])) is None:
+                    continue
+                ## a frame per call, the library renames the columns of the one it is given in place.
+                ## every row is reported, features and predictions alike, so the counts match
+                mlops.report_aggregated_predictions_data(features_df=chunk[feature_columns] if feature_columns else None,
+                                                         predictions=chunk[column].tolist(),
+                                                         deployment_id=model["deployment_id"], model_id=ids[model["deployment_id"]])
+                reported[model["deployment_id"]] += len(chunk)
+    finally:
+        if mlops is not None:
+            mlops.shutdown()
+    for model in deployments:
+        if not reported[model["deployment_id"]]:
+            logger.warning(f"{model['prediction_column']}: no predictions reported for deployment {model['deployment_id']}")
+    logger.info(f"aggregated {sum(reported.values())} predictions and {len(feature_columns)} features in {time.monotonic() - start:.1f}s")
+    return reported
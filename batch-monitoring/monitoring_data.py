@@ -0,0 +1,169 @@
+import os
+import gzip
+import logging
+from pathlib import Path
+
+import pandas as pd
+
+from datasets import UPLOAD_FORMAT
+from settings import ASSOCIATION_ID_COLUMN
+
+logger = logging.getLogger(__name__)
+
+PREDICTION_MARKER = "ADJ_PRED_RENTAL_DAYS_"
+DEFAULT_CHUNK_SIZE = int(os.environ.get("MONITORING_CHUNK_SIZE", 50_000))
+
+
+def read_header(path):
+    return list(pd.read_csv(path, nrows=0).columns)
+
+
+def tracked_features(deployment_conf):
+    """features_to_track of the monitoring conf (top level or per deployment), None when nothing is listed (= track everything)"""
+    features = list(deployment_conf.get("features_to_track") or [])
+    for model in deployment_conf.get("deployments", []):
+        features.extend(f for f in model.get("features_to_track") or [] if f not in features)
+    return features or None
+
+
+def select_columns(prediction_header, input_header=None, features=None, association_id=ASSOCIATION_ID_COLUMN, marker=PREDICTION_MARKER):
+    """
+    the columns monitoring needs from each file: the prediction columns and the association id
+    from the prediction file, the tracked features (all of them when features is None) from the
+    input file.  without an input file, listed features are taken from the prediction file.
+    """
+    prediction_columns = [c for c in prediction_header if marker in c]
+    if association_id in prediction_header:
+        prediction_columns.append(association_id)
+    if input_header:
+        wanted = input_header if features is None else [c for c in input_header if c in features]
+        input_columns = [c for c in wanted if c not in prediction_columns]
+        available = input_header
+    else:
+        input_columns = []
+        prediction_columns += [c for c in prediction_header if features and c in features and c not in prediction_columns]
+        available = prediction_header
+    if missing := [f for f in features or [] if f not in available]:
+        logger.warning(f"tracked features not in the monitoring data: {missing}")
+    return prediction_columns, input_columns
+
+
+def column_dtypes(path, columns, sample_rows=1000):
+    """
+    one dtype per column for every chunk, so the chunks line up in one parquet schema.  numbers
+    are read as float (an int column with a missing value further down would otherwise change
+    type), everything else as nullable strings / booleans.  the association id is always read as
+    a string, "17" must not be uploaded as 17.0.
+    """
+    if not columns:
+        return {}
+    sample = pd.read_csv(path, usecols=columns, nrows=sample_rows)
+    dtypes = {}
+    for column in columns:
+        if column == ASSOCIATION_ID_COLUMN:
+            dtypes[column] = "string"
+        elif pd.api.types.is_bool_dtype(sample[column]):
+            dtypes[column] = "boolean"
+        elif pd.api.types.is_numeric_dtype(sample[column]):
+            dtypes[column] = "float64"
+        else:
+            dtypes[column] = "string"
+    return dtypes
+
+
+class _ParquetWriter(object):
+    def __init__(self, path):
+        import pyarrow.parquet  # noqa: F401 - fail before anything is read when there is no engine
+        self.path = path
+        self.writer = None
+        self.schema = None
+
+    def write(self, chunk):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        if self.writer is None:
+            self.schema = pa.Schema.from_pandas(chunk, preserve_index=False)
+            self.writer = pq.ParquetWriter(self.path, self.schema, compression="snappy")
+        self.writer.write_table(pa.Table.from_pandas(chunk, schema=self.schema, preserve_index=False))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class _CsvWriter(object):
+    def __init__(self, path, compress=True):
+        self.path = path
+        self.file = gzip.open(path, "wt", newline="") if compress else open(path, "w", newline="")
+        self.header = True
+
+    def write(self, chunk):
+        chunk.to_csv(self.file, header=self.header, index=False)
+        self.header = False
+
+    def close(self):
+        self.file.close()
+
+
+def _open_writer(output_dir, name, upload_format):
+    if upload_format == "parquet":
+        try:
+            path = Path(output_dir) / f"{name}.parquet"
+            return path, _ParquetWriter(path)
+        except ImportError:
+            logger.warning("no parquet engine installed (pyarrow), writing gzipped csv instead")
+    if upload_format == "csv":
+        path = Path(output_dir) / f"{name}.csv"
+        return path, _CsvWriter(path, compress=False)
+    path = Path(output_dir) / f"{name}.csv.gz"
+    return path, _CsvWriter(path)
+
+
+def iter_monitoring_chunks(prediction_path, input_path=None, features=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    the prediction and input csvs joined row by row, chunk_size rows at a time, keeping only the
+    columns monitoring uses (see select_columns).  rows are matched by position like
+    DataFrame.join on the default index: input rows past the end of the prediction file are
+    dropped, missing ones are left empty.  memory stays at about one chunk of the pruned columns
+    however large the files are.
+    """
+    prediction_columns, input_columns = select_columns(
+        read_header(prediction_path), read_header(input_path) if input_path else None, features)
+    logger.info(f"monitoring data columns: {len(prediction_columns)} from {Path(prediction_path).name}, "
+                f"{len(input_columns)} from {Path(input_path).name if input_path else '-'}")
+    prediction_dtypes = column_dtypes(prediction_path, prediction_columns)
+    input_dtypes = column_dtypes(input_path, input_columns) if input_columns else {}
+    predictions = pd.read_csv(prediction_path, usecols=prediction_columns, dtype=prediction_dtypes, chunksize=chunk_size)
+    inputs = pd.read_csv(input_path, usecols=input_columns, dtype=input_dtypes, iterator=True) if input_columns else None
+    empty_inputs = pd.DataFrame({c: pd.Series(dtype=input_dtypes[c]) for c in input_columns})
+    try:
+        for chunk in predictions:
+            ## usecols reads columns in file order, keep a stable order for the schema
+            chunk = chunk[prediction_columns].reset_index(drop=True)
+            if inputs is not None:
+                try:
+                    features_chunk = inputs.get_chunk(len(chunk))
+                except StopIteration:
+                    features_chunk = empty_inputs
+                features_chunk = features_chunk[input_columns].reset_index(drop=True).reindex(range(len(chunk)))
+                chunk = pd.concat([chunk, features_chunk], axis=1)
+            yield chunk
+    finally:
+        predictions.close()
+        if inputs is not None:
+            inputs.close()
+
+
+def prepare_monitoring_dataset(prediction_path, input_path, output_dir, name, features=None,
+                               chunk_size=DEFAULT_CHUNK_SIZE, upload_format=UPLOAD_FORMAT):
+    """write iter_monitoring_chunks to one parquet (or gzipped csv) file in output_dir, returns the path"""
+    output_path, writer = _open_writer(output_dir, name, upload_format)
+    rows = 0
+    try:
+        for chunk in iter_monitoring_chunks(prediction_path, input_path, features, chunk_size):
+            writer.write(chunk)
+            rows += len(chunk)
+    finally:
+        writer.close()
+    logger.info(f"monitoring dataset: {rows} rows, {output_path.name} {output_path.stat().st_size / 2**20:.1f} MiB")
+    return output_path
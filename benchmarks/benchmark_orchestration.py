@@ -0,0 +1,209 @@
+"""
+Usage:
+    python benchmarks/benchmark_orchestration.py --output ./bench_results/orchestration.json
+    python benchmarks/benchmark_orchestration.py --latency 0.1 --rate-limit 5 --compare ./bench_results/orchestration.json
+
+End to end benchmark of the deployment and monitoring orchestration against the local fake
+DataRobot api (benchmarks/fake_datarobot.py), so nothing is sent to DataRobot.  A temporary
+workspace gets a deployment conf with one custom model per folder in custom-model/models, then
+    rollout    - create_custom_inference_deployment_v2.py from scratch
+    rerun      - the same conf again, nothing changed
+    monitoring - batch-monitoring/batch_monitoring.py for all the deployments
+are run one after the other, and the wall clock time, number of api calls, writes and 429s of
+each are reported.  monitoring-mlops and monitoring-aggregated (not run by default, need
+datarobot-mlops[aggregator]) run batch_monitoring.py --mode mlops / aggregated with a
+filesystem spooler in the workspace instead.
+"""
+import sys
+import os
+import json
+import time
+import socket
+import shutil
+import argparse
+import logging
+import tempfile
+import subprocess
+import urllib.request
+from pathlib import Path
+
+import yaml
+import pandas as pd
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+MODELS_DIR = REPO_ROOT / "custom-model" / "models"
+TEST_DATA = REPO_ROOT / "data" / "test_data.csv"
+TRAINING_DATA = REPO_ROOT / "data" / "training_data.csv"
+TARGET = "charges"
+SCENARIOS = ["rollout", "rerun", "monitoring"]
+OPTIONAL_SCENARIOS = ["monitoring-mlops", "monitoring-aggregated"]
+SERVER_OPTIONS = ["latency", "jitter", "assignment_seconds", "build_seconds", "package_build_seconds",
+                  "dataset_seconds", "deploy_seconds", "batch_job_seconds", "rate_limit", "burst", "other_deployments"]
+
+logging.basicConfig(
+    level=logging.INFO,
+    stream=sys.stdout,
+    format='%(asctime)s %(filename)s:%(lineno)d %(levelname)s %(message)s',
+)
+logger = logging.getLogger(__name__)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description=__doc__, usage='python %(prog)s [--models 19] [--latency 0.05] [--rate-limit 10] [--output results.json]',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('--models', type=int, help='number of models to roll out, cycling through custom-model/models', default=len(list(MODELS_DIR.iterdir())))
+    parser.add_argument('--scenarios', nargs="+", choices=SCENARIOS + OPTIONAL_SCENARIOS, help='scenarios to run, in order', default=SCENARIOS)
+    parser.add_argument('--latency', type=float, help='seconds added to every fake api response', default=0.05)
+    parser.add_argument('--jitter', type=float, help='extra random seconds added to every fake api response', default=0.02)
+    parser.add_argument('--assignment-seconds', type=float, default=2.0)
+    parser.add_argument('--build-seconds', type=float, default=10.0)
+    parser.add_argument('--package-build-seconds', type=float, default=5.0)
+    parser.add_argument('--dataset-seconds', type=float, default=1.0)
+    parser.add_argument('--deploy-seconds', type=float, default=2.0)
+    parser.add_argument('--batch-job-seconds', type=float, default=5.0)
+    parser.add_argument('--rate-limit', type=float, help='fake api requests per second before answering 429, 0 for no limit', default=10.0)
+    parser.add_argument('--burst', type=int, default=20)
+    parser.add_argument('--other-deployments', type=int, help='unrelated deployments already in the fake account', default=0)
+    parser.add_argument('--script-args', help='extra arguments for create_custom_inference_deployment_v2.py, e.g. "--api-rate 8"', default="")
+    parser.add_argument('--keep-workspace', action='store_true', help='keep the temporary workspace (confs, journals, logs) for inspection')
+    parser.add_argument('--output', help='where to write the json results', default=None)
+    parser.add_argument('--compare', help='previous json results to compare against', default=None)
+    return parser.parse_args()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def fetch_stats(base_url, reset=False):
+    request = urllib.request.Request(f"{base_url}/__stats__{'/reset' if reset else ''}", method="POST" if reset else "GET")
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.loads(response.read())
+
+
+def start_server(args, port, log_path):
+    command = [sys.executable, str(Path(__file__).resolve().parent / "fake_datarobot.py"), "--port", str(port)]
+    for option in SERVER_OPTIONS:
+        command += [f"--{option.replace('_', '-')}", str(getattr(args, option))]
+    with open(log_path, "w") as log:
+        server = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+    base_url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            fetch_stats(base_url)
+            return server, base_url
+        except OSError:
+            time.sleep(0.1)
+    server.terminate()
+    raise Exception(f"fake datarobot api did not start on port {port}")
+
+
+def build_workspace(workspace, n_models):
+    """deployment conf with n_models custom models, each with its own copy of an artifact folder"""
+    folders = sorted(MODELS_DIR.iterdir())
+    confs = []
+    for i in range(n_models):
+        folder = folders[i % len(folders)]
+        artifact_folder = workspace / "models" / f"{folder.name}-{i}"
+        shutil.copytree(folder, artifact_folder)
+        confs.append({
+            "name": f"{folder.name}-{i} benchmark deployment",
+            "artifact_folder": str(artifact_folder),
+            "drum_test_data_path": str(TEST_DATA),
+            "environment_id": "5e8c889607389fe0f466c72d",
+            "prediction_environment_id": "68517d02a038d3c56d0bbb40",
+            "target_name": TARGET,
+            "target_type": "Regression",
+            "prediction_column": f"ADJ_PRED_RENTAL_DAYS_{i}",
+            "features_to_track": ["age", "bmi", "smoker"],
+        })
+    with open(workspace / "deployment_conf.yaml", "w") as f:
+        yaml.dump({"deployments": confs}, f)
+    shutil.copy(TRAINING_DATA, workspace / "training_data.csv")
+
+
+def write_monitoring_inputs(workspace, confs):
+    """batch_monitoring.py deletes its datasets after a run, so they are written fresh every time"""
+    inputs = pd.read_csv(TEST_DATA).drop(columns=[TARGET])
+    predictions = pd.DataFrame({conf["prediction_column"]: 1000.0 * (i + 1) for i, conf in enumerate(confs)}, index=inputs.index)
+    predictions.to_csv(workspace / "prediction_dataset.csv", index=False)
+    inputs.to_csv(workspace / "input_dataset.csv", index=False)
+    with open(workspace / "monitoring_conf.yaml", "w") as f:
+        yaml.dump({"deployments": [{"deployment_id": c["deployment_id"], "prediction_column": c["prediction_column"]} for c in confs]}, f)
+
+
+def run_scenario(name, args, workspace, base_url, env):
+    if name in ("rollout", "rerun"):
+        command = [sys.executable, str(REPO_ROOT / "create-deployments" / "create_custom_inference_deployment_v2.py"),
+                   "--deployment-conf", "deployment_conf.yaml", "--training-dataset-path", "training_data.csv", "--no-validate",
+                   *args.script_args.split()]
+    else:
+        with open(workspace / "deployment_conf.yaml") as f:
+            write_monitoring_inputs(workspace, yaml.safe_load(f)["deployments"])
+        command = [sys.executable, str(REPO_ROOT / "batch-monitoring" / "batch_monitoring.py"),
+                   "--deployment-conf", "monitoring_conf.yaml", "--prediction-dataset", "prediction_dataset.csv",
+                   "--input-dataset", "input_dataset.csv"]
+        if name in OPTIONAL_SCENARIOS:
+            command += ["--mode", name.split("-")[1], "--mlops-spool-dir", str(workspace / f"{name}-spool")]
+    fetch_stats(base_url, reset=True)
+    start = time.perf_counter()
+    with open(workspace / f"{name}.log", "w") as log:
+        returncode = subprocess.run(command, cwd=workspace, env=env, stdout=log, stderr=subprocess.STDOUT).returncode
+    seconds = time.perf_counter() - start
+    stats = fetch_stats(base_url)
+    if returncode != 0:
+        logger.error(f"{name}: exited with {returncode}, see {workspace / f'{name}.log'}")
+    logger.info(f"{name}: {seconds:.1f}s, {stats['total']} api calls ({stats['writes']} writes, {stats['throttled']} throttled)")
+    return {"scenario": name, "ok": returncode == 0, "seconds": seconds, "api_calls": stats["total"],
+            "writes": stats["writes"], "throttled": stats["throttled"], "calls": stats["calls"]}
+
+
+def compare(results, previous_path):
+    with open(previous_path) as f:
+        previous = {r["scenario"]: r for r in json.load(f)["results"]}
+    logger.info(f"compared to {previous_path}")
+    for result in results:
+        if (before := previous.get(result["scenario"])) is None:
+            continue
+        logger.info(f"  {result['scenario']}: {before['seconds']:.1f}s -> {result['seconds']:.1f}s, "
+                    f"{before['api_calls']} -> {result['api_calls']} api calls, {before['throttled']} -> {result['throttled']} throttled")
+
+
+def main():
+    args = parse_args()
+    workspace = Path(tempfile.mkdtemp(prefix="orchestration-bench-"))
+    server, base_url = start_server(args, free_port(), workspace / "fake_datarobot.log")
+    env = {**os.environ, "DATAROBOT_ENDPOINT": f"{base_url}/api/v2", "DATAROBOT_API_TOKEN": "fake",
+           "DATAROBOT_DATASET_INDEX": str(workspace / ".dataset_index.json")}
+    results = []
+    try:
+        build_workspace(workspace, args.models)
+        for name in args.scenarios:
+            results.append(run_scenario(name, args, workspace, base_url, env))
+            if not results[-1]["ok"]:
+                break
+    finally:
+        server.terminate()
+        server.wait()
+        if args.keep_workspace or not all(r["ok"] for r in results):
+            logger.info(f"workspace kept at {workspace}")
+        else:
+            shutil.rmtree(workspace)
+
+    for result in results:
+        print(f"{result['scenario']:<12} {result['seconds']:>8.1f}s {result['api_calls']:>6} calls {result['writes']:>5} writes {result['throttled']:>5} throttled")
+    if args.compare:
+        compare(results, args.compare)
+    if args.output:
+        Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump({"models": args.models, "server": {option: getattr(args, option) for option in SERVER_OPTIONS}, "results": results}, f, indent=2)
+    return 0 if results and all(r["ok"] for r in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,230 @@
+"""
+Usage:
+    python benchmarks/benchmark_routing_model.py --output ./bench_results/routing_model.json
+
+Micro benchmark for the scoring paths of RoutingModel (predict, concurrent_predict, ...).
+Inputs are built from data/test_data.csv and data/training_data.csv, replicated to the
+requested batch sizes, and scored against the real pickles in custom-model/models.
+Everything runs locally on CPU, nothing is sent to DataRobot.
+"""
+import sys
+import os
+import json
+import time
+import argparse
+import logging
+import platform
+import hashlib
+import resource
+import tracemalloc
+import multiprocessing as mp
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+DEFAULT_CODE_DIR = REPO_ROOT / "custom-model"
+DEFAULT_DATA = [REPO_ROOT / "data" / "test_data.csv", REPO_ROOT / "data" / "training_data.csv"]
+DEFAULT_SIZES = [1, 10, 1_000, 100_000, 1_000_000]
+DEFAULT_PATHS = ["predict", "concurrent_predict"]
+TARGET = "charges"
+
+logging.basicConfig(
+    level=logging.INFO,
+    stream=sys.stdout,
+    format='%(asctime)s %(filename)s:%(lineno)d %(levelname)s %(message)s',
+)
+logger = logging.getLogger(__name__)
+
+## ru_maxrss is reported in kilobytes on linux and bytes on macos
+RU_MAXRSS_TO_MB = 1 / 1024 if sys.platform != "darwin" else 1 / (1024 * 1024)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description=__doc__, usage='python %(prog)s [--sizes 1 10 1000] [--paths predict concurrent_predict]',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('--code-dir', help='custom model folder containing routing_config.yaml and models/', default=str(DEFAULT_CODE_DIR))
+    parser.add_argument('--data', nargs="+", help='csv files used to build the scoring inputs', default=[str(p) for p in DEFAULT_DATA])
+    parser.add_argument('--sizes', nargs="+", type=int, help='batch sizes (rows) to benchmark', default=DEFAULT_SIZES)
+    parser.add_argument('--paths', nargs="+", help='RoutingModel methods to benchmark', default=DEFAULT_PATHS)
+    parser.add_argument('--repeats', type=int, help='timed iterations per batch size', default=20)
+    parser.add_argument('--max-scored-rows', type=int, help='cap on rows scored per case, limits repeats for large batches', default=3_000_000)
+    parser.add_argument('--warmup', type=int, help='untimed iterations before timing', default=2)
+    parser.add_argument('--output', help='where to write the json results', default=None)
+    parser.add_argument('--compare', help='previous json results to compare against', default=None)
+    return parser.parse_args()
+
+
+def load_base_frame(data_paths):
+    frames = [pd.read_csv(p) for p in data_paths]
+    df = pd.concat(frames, ignore_index=True)
+    return df.drop(columns=[TARGET], errors="ignore")
+
+
+def replicate(df, n_rows):
+    """tile the base rows until the frame has exactly n_rows"""
+    idx = np.arange(n_rows) % df.shape[0]
+    return df.iloc[idx].reset_index(drop=True)
+
+
+def current_rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError):
+        return None
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * RU_MAXRSS_TO_MB
+
+
+def model_fingerprint(code_dir):
+    """sha256 of every model pickle, so results can be tied back to a model version"""
+    fingerprint = {}
+    for pkl in sorted(Path(code_dir, "models").glob("*/model.pkl")):
+        fingerprint[pkl.parent.name] = hashlib.sha256(pkl.read_bytes()).hexdigest()
+    return fingerprint
+
+
+def package_versions():
+    versions = {}
+    for name in ["numpy", "pandas", "sklearn", "category_encoders"]:
+        try:
+            versions[name] = __import__(name).__version__
+        except Exception:
+            versions[name] = None
+    return versions
+
+
+def run_case(model, path, df, repeats, warmup):
+    score = getattr(model, path)
+    start_rss = current_rss_mb()
+    for _ in range(warmup):
+        score(df)
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        score(df)
+        latencies.append(time.perf_counter() - start)
+    ## allocation tracing slows scoring down considerably, so it gets its own untimed pass
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    score(df)
+    after = tracemalloc.take_snapshot()
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    alloc_diff = after.compare_to(before, "filename")
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        "path": path,
+        "rows": int(df.shape[0]),
+        "repeats": repeats,
+        "latency_ms": {
+            "min": float(latencies_ms.min()),
+            "mean": float(latencies_ms.mean()),
+            "p50": float(np.percentile(latencies_ms, 50)),
+            "p90": float(np.percentile(latencies_ms, 90)),
+            "p95": float(np.percentile(latencies_ms, 95)),
+            "p99": float(np.percentile(latencies_ms, 99)),
+            "max": float(latencies_ms.max()),
+        },
+        "rows_per_sec": float(df.shape[0] / np.median(latencies)),
+        "peak_rss_mb": peak_rss_mb(),
+        "start_rss_mb": start_rss,
+        "traced_peak_mb": traced_peak / (1024 * 1024),
+        "alloc_blocks": int(sum(stat.count_diff for stat in alloc_diff if stat.count_diff > 0)),
+    }
+
+
+def _case_worker(conn, model, path, df, repeats, warmup):
+    try:
+        conn.send(run_case(model, path, df, repeats, warmup))
+    except Exception as e:
+        conn.send({"path": path, "rows": int(df.shape[0]), "error": repr(e)})
+    finally:
+        conn.close()
+
+
+def run_isolated(model, path, df, repeats, warmup):
+    """run a single case in a forked child so peak rss is not polluted by earlier cases"""
+    ctx = mp.get_context("fork")
+    parent_conn, child_conn = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_case_worker, args=(child_conn, model, path, df, repeats, warmup))
+    proc.start()
+    child_conn.close()
+    result = parent_conn.recv()
+    proc.join()
+    return result
+
+
+def compare(results, baseline_path):
+    with open(baseline_path, "r") as f:
+        baseline = json.load(f)
+    previous = {(r["path"], r["rows"]): r for r in baseline["results"] if "error" not in r}
+    logger.info(f"comparing against {baseline_path} ({baseline.get('timestamp')})")
+    for r in results:
+        prev = previous.get((r["path"], r["rows"]))
+        if prev is None or "error" in r:
+            continue
+        ratio = r["latency_ms"]["p50"] / prev["latency_ms"]["p50"]
+        logger.info(f"{r['path']:>20} rows={r['rows']:>9}: p50 {prev['latency_ms']['p50']:.2f}ms -> {r['latency_ms']['p50']:.2f}ms ({ratio:.2f}x)")
+
+
+def main():
+    args = parse_args()
+    sys.path.insert(0, str(Path(args.code_dir).resolve()))
+    from custom_model import RoutingModel
+
+    base_df = load_base_frame(args.data)
+    logger.info(f"base frame has {base_df.shape[0]} rows from {args.data}")
+
+    load_start = time.perf_counter()
+    model = RoutingModel(args.code_dir)
+    load_seconds = time.perf_counter() - load_start
+    logger.info(f"loaded {len(model.models)} models in {load_seconds:.2f}s")
+
+    missing = [p for p in args.paths if not callable(getattr(model, p, None))]
+    if missing:
+        raise Exception(f"RoutingModel has no scoring path(s) {missing}")
+
+    results = []
+    for n_rows in args.sizes:
+        df = replicate(base_df, n_rows)
+        repeats = max(1, min(args.repeats, args.max_scored_rows // n_rows))
+        for path in args.paths:
+            logger.info(f"benchmarking {path} with {n_rows} rows x {repeats} repeats")
+            result = run_isolated(model, path, df, repeats, args.warmup if n_rows < 100_000 else min(args.warmup, 1))
+            if "error" in result:
+                logger.error(f"{path} with {n_rows} rows failed: {result['error']}")
+            else:
+                logger.info(f"{path} rows={n_rows}: p50 {result['latency_ms']['p50']:.2f}ms, {result['rows_per_sec']:.0f} rows/s, peak rss {result['peak_rss_mb']:.0f}MB")
+            results.append(result)
+
+    out = {
+        "timestamp": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "packages": package_versions(),
+        "models": model_fingerprint(args.code_dir),
+        "model_load_seconds": load_seconds,
+        "results": results,
+    }
+    if args.compare:
+        compare(results, args.compare)
+    if args.output:
+        Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(out, f, indent=2)
+        logger.info(f"results written to {args.output}")
+    else:
+        print(json.dumps(out, indent=2))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
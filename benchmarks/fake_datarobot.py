@@ -0,0 +1,602 @@
+"""
+Usage:
+    python benchmarks/fake_datarobot.py --port 8090 --latency 0.05 --build-seconds 30 --rate-limit 10
+    DATAROBOT_ENDPOINT=http://127.0.0.1:8090/api/v2 DATAROBOT_API_TOKEN=fake \\
+        python create-deployments/create_custom_inference_deployment_v2.py --deployment-conf ...
+
+Local stand-in for the parts of the DataRobot api used by create-deployments/ and
+batch-monitoring/, so the rollout and monitoring orchestration can be timed (and regression
+tested) offline.  Everything is kept in memory.  Long running operations (training data
+assignment, dependency builds, model package builds, dataset uploads, deployment creation,
+batch jobs) finish after a configurable number of seconds, every response can be delayed, and
+a server side token bucket answers 429 with Retry-After once the client goes over the rate limit.
+
+GET /__stats__ returns the number of api calls per endpoint (POST /__stats__/reset clears them).
+"""
+import re
+import sys
+import math
+import json
+import time
+import random
+import logging
+import argparse
+import threading
+from datetime import datetime, timezone
+from email.parser import BytesParser
+from email.policy import HTTP
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logging.basicConfig(
+    level=logging.INFO,
+    stream=sys.stdout,
+    format='%(asctime)s %(filename)s:%(lineno)d %(levelname)s %(message)s',
+)
+logger = logging.getLogger(__name__)
+
+API_PREFIX = "/api/v2/"
+WRITE_METHODS = {"POST", "PATCH", "PUT", "DELETE"}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description=__doc__, usage='python %(prog)s [--port 8090] [--latency 0.05] [--build-seconds 30] [--rate-limit 10]',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--latency', type=float, help='seconds added to every response', default=0.0)
+    parser.add_argument('--jitter', type=float, help='extra uniformly random seconds added to every response', default=0.0)
+    parser.add_argument('--assignment-seconds', type=float, help='training data assignment time of a new custom model version', default=2.0)
+    parser.add_argument('--build-seconds', type=float, help='dependency build time', default=10.0)
+    parser.add_argument('--package-build-seconds', type=float, help='model package build time of a registered model version', default=5.0)
+    parser.add_argument('--dataset-seconds', type=float, help='dataset upload processing time', default=1.0)
+    parser.add_argument('--deploy-seconds', type=float, help='deployment creation time', default=2.0)
+    parser.add_argument('--batch-job-seconds', type=float, help='batch monitoring job run time', default=5.0)
+    parser.add_argument('--rate-limit', type=float, help='requests per second before answering 429, 0 for no limit', default=0.0)
+    parser.add_argument('--burst', type=int, help='burst above --rate-limit', default=20)
+    parser.add_argument('--other-deployments', type=int, help='unrelated deployments the account already has', default=0)
+    return parser.parse_args()
+
+
+def now_iso():
+    return datetime.now(timezone.utc).isoformat()
+
+
+class FakeDataRobot(object):
+    """in memory state of the fake api, and a handler per route"""
+
+    def __init__(self, args):
+        self.args = args
+        ## handlers run one at a time (responses are delayed outside of it), so the state needs no finer locking
+        self.lock = threading.RLock()
+        self.counter = 0
+        self.custom_models = {}
+        self.versions = {}
+        self.builds = {}
+        self.datasets = {}
+        self.registered_models = {}
+        self.packages = {}
+        self.deployments = {}
+        self.statuses = {}
+        self.job_definitions = {}
+        self.batch_jobs = {}
+        self.calls = {}
+        self.throttled = 0
+        self.tokens = float(args.burst)
+        self.tokens_updated = time.monotonic()
+        self.routes = []
+        for method, template, handler in [
+            ("GET", "version/", self.version),
+            ("POST", "customModels/", self.create_custom_model),
+            ("GET", "customModels/{id}/", self.get_custom_model),
+            ("POST", "customModels/{id}/versions/", self.create_version),
+            ("PATCH", "customModels/{id}/versions/", self.create_version),
+            ("GET", "customModels/{id}/versions/{id}/", self.get_version),
+            ("POST", "customModels/{id}/versions/{id}/dependencyBuild/", self.start_build),
+            ("GET", "customModels/{id}/versions/{id}/dependencyBuild/", self.get_build),
+            ("DELETE", "customModels/{id}/versions/{id}/dependencyBuild/", self.cancel_build),
+            ("POST", "datasets/fromFile/", self.create_dataset),
+            ("POST", "datasets/{id}/versions/fromFile/", self.create_dataset),
+            ("GET", "datasets/{id}/", self.get_dataset),
+            ("GET", "datasets/{id}/versions/", self.list_dataset_versions),
+            ("GET", "datasets/{id}/versions/{id}/", self.get_dataset),
+            ("DELETE", "datasets/{id}/versions/{id}/", self.delete_dataset_version),
+            ("GET", "status/{id}/", self.get_status),
+            ("POST", "modelPackages/fromCustomModelVersion/", self.create_package),
+            ("POST", "modelPackages/fromJSON/", self.create_package),
+            ("GET", "registeredModels/{id}/", self.get_registered_model),
+            ("GET", "registeredModels/{id}/versions/{id}/", self.get_package),
+            ("GET", "deployments/", self.list_deployments),
+            ("POST", "deployments/fromModelPackage/", self.create_deployment),
+            ("GET", "deployments/{id}/", self.get_deployment),
+            ("POST", "deployments/{id}/model/validation/", self.validate_replacement),
+            ("PATCH", "deployments/{id}/model/", self.replace_model),
+            ("GET", "deployments/{id}/settings/", self.get_settings),
+            ("PATCH", "deployments/{id}/settings/", self.update_settings),
+            ("GET", "batchMonitoringJobDefinitions/", self.list_job_definitions),
+            ("POST", "batchMonitoringJobDefinitions/", self.create_job_definition),
+            ("GET", "batchMonitoringJobDefinitions/{id}/", self.get_job_definition),
+            ("PATCH", "batchMonitoringJobDefinitions/{id}/", self.update_job_definition),
+            ("POST", "batchJobs/fromJobDefinition/", self.run_job_definition),
+            ("GET", "batchJobs/", self.list_batch_jobs),
+            ("GET", "batchJobs/{id}/", self.get_batch_job),
+        ]:
+            pattern = re.compile("^" + template.replace("{id}", "([^/]+)").rstrip("/") + "/?$")
+            self.routes.append((method, template, pattern, handler))
+        ## the rest of the account, listed before anything a benchmark creates
+        if args.other_deployments:
+            package = {"id": self.new_id(), "name": "other model", "registeredModelId": self.new_id(), "modelId": self.new_id(), "modelExecutionType": "dedicated"}
+            self.packages[package["id"]] = package
+            for i in range(args.other_deployments):
+                deployment = {"_started": time.monotonic(), "_package_id": package["id"], "id": self.new_id(), "label": f"other deployment {i}",
+                              "description": None, "status": "active", "predictionEnvironment": None, "_settings": {}}
+                self.deployments[deployment["id"]] = deployment
+
+    ## bookkeeping
+
+    def new_id(self):
+        with self.lock:
+            self.counter += 1
+            return f"{self.counter:024x}"
+
+    def elapsed(self, entity):
+        return time.monotonic() - entity["_started"]
+
+    def throttle(self):
+        """server side token bucket, returns seconds to wait when over the limit"""
+        if not self.args.rate_limit:
+            return None
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.args.burst, self.tokens + (now - self.tokens_updated) * self.args.rate_limit)
+            self.tokens_updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return None
+            self.throttled += 1
+            return (1 - self.tokens) / self.args.rate_limit
+
+    def record_call(self, method, template):
+        with self.lock:
+            key = f"{method} {template}"
+            self.calls[key] = self.calls.get(key, 0) + 1
+
+    def stats(self):
+        with self.lock:
+            total = sum(self.calls.values())
+            writes = sum(n for key, n in self.calls.items() if key.split(" ")[0] in WRITE_METHODS)
+            return {"total": total, "writes": writes, "throttled": self.throttled, "calls": dict(sorted(self.calls.items()))}
+
+    def reset_stats(self):
+        with self.lock:
+            self.calls = {}
+            self.throttled = 0
+
+    def dispatch(self, method, path, query, body, content_type, base_url):
+        for route_method, template, pattern, handler in self.routes:
+            if route_method != method:
+                continue
+            match = pattern.match(path)
+            if match:
+                self.record_call(method, template)
+                request = {"method": method, "ids": match.groups(), "query": query, "body": body, "content_type": content_type, "base_url": base_url}
+                try:
+                    with self.lock:
+                        return handler(request)
+                except Exception as e:
+                    logger.exception(f"{method} {path} failed")
+                    return 500, {"message": f"fake api error: {e}"}, {}
+        return 404, {"message": f"{method} {path} is not part of the fake api"}, {}
+
+    def async_status(self, request, location, seconds):
+        status_id = self.new_id()
+        self.statuses[status_id] = {"_started": time.monotonic(), "seconds": seconds, "location": location}
+        return {"Location": f"{request['base_url']}status/{status_id}/"}
+
+    ## request bodies
+
+    def json_body(self, request):
+        return json.loads(request["body"] or b"{}")
+
+    def form_body(self, request):
+        """multipart form -> [(name, filename, value)]"""
+        message = BytesParser(policy=HTTP).parsebytes(
+            b"Content-Type: " + request["content_type"].encode("latin-1") + b"\r\n\r\n" + request["body"])
+        fields = []
+        for part in message.iter_parts():
+            payload = part.get_payload(decode=True) or b""
+            fields.append((part.get_param("name", header="content-disposition"), part.get_filename(), payload))
+        return fields
+
+    ## handlers
+
+    def version(self, request):
+        try:
+            from datarobot._version import __expected_server_version__ as expected
+        except ImportError:
+            expected = "2.99"
+        return 200, {"major": int(expected.split(".")[0]), "minor": int(expected.split(".")[1]), "versionString": f"{expected}.0"}, {}
+
+    def custom_model_json(self, cm):
+        versions = [v for v in self.versions.values() if v["customModelId"] == cm["id"]]
+        latest = self.version_json(max(versions, key=lambda v: v["_started"])) if versions else None
+        deployments = sum(1 for d in self.deployments.values() if self.packages[d["_package_id"]]["modelId"] in {v["id"] for v in versions})
+        data = {k: v for k, v in cm.items() if not k.startswith("_") and v is not None}
+        return {**data, "latestVersion": latest, "deploymentsCount": deployments, "updated": now_iso()}
+
+    def create_custom_model(self, request):
+        body = self.json_body(request)
+        cm = {
+            "_started": time.monotonic(), "id": self.new_id(), "name": body.get("name", ""), "description": body.get("description") or "",
+            "createdBy": "fake", "created": now_iso(), "customModelType": body.get("customModelType", "inference"), "targetType": body.get("targetType"), "targetName": body.get("targetName", ""),
+            "language": body.get("language") or "python", "trainingDataAssignmentInProgress": False,
+            "supportsRegression": body.get("targetType") == "Regression", "supportsBinaryClassification": body.get("targetType") == "Binary",
+        }
+        self.custom_models[cm["id"]] = cm
+        return 201, self.custom_model_json(cm), {}
+
+    def get_custom_model(self, request):
+        cm = self.custom_models.get(request["ids"][0])
+        if cm is None:
+            return 404, {"message": "custom model not found"}, {}
+        return 200, self.custom_model_json(cm), {}
+
+    def version_json(self, version):
+        data = {k: v for k, v in version.items() if not k.startswith("_")}
+        if version.get("trainingData"):
+            data["trainingData"] = {**version["trainingData"], "assignmentInProgress": self.elapsed(version) < self.args.assignment_seconds}
+        return data
+
+    def create_version(self, request):
+        cm_id = request["ids"][0]
+        if cm_id not in self.custom_models:
+            return 404, {"message": "custom model not found"}, {}
+        fields = self.form_body(request)
+        values = {name: value.decode("utf-8") for name, filename, value in fields if filename is None}
+        paths = [value.decode("utf-8") for name, filename, value in fields if name == "filePath"]
+        delete = {value.decode("utf-8") for name, filename, value in fields if name == "filesToDelete"}
+        previous = [v for v in self.versions.values() if v["customModelId"] == cm_id]
+        items = []
+        if request["method"] == "PATCH" and previous:
+            items = [item for item in max(previous, key=lambda v: v["_started"])["items"] if item["id"] not in delete]
+        items = [item for item in items if item["filePath"] not in paths]
+        for path in paths:
+            items.append({"id": self.new_id(), "fileName": path.split("/")[-1], "filePath": path, "fileSource": "local", "created": now_iso()})
+        training_data = json.loads(values["trainingData"]) if "trainingData" in values else None
+        version = {
+            "_started": time.monotonic(), "id": self.new_id(), "customModelId": cm_id, "versionMajor": len(previous) + 1, "versionMinor": 0,
+            "isFrozen": False, "items": items, "label": f"v{len(previous) + 1}.0", "description": "", "created": now_iso(),
+            "baseEnvironmentId": values.get("baseEnvironmentId"),
+            "trainingData": {"datasetId": training_data["datasetId"], "datasetVersionId": None, "datasetName": None} if training_data else None,
+        }
+        if not version["baseEnvironmentId"]:
+            version.pop("baseEnvironmentId")
+        self.versions[version["id"]] = version
+        return 201, self.version_json(version), {}
+
+    def get_version(self, request):
+        version = self.versions.get(request["ids"][1])
+        if version is None:
+            return 404, {"message": "custom model version not found"}, {}
+        return 200, self.version_json(version), {}
+
+    def build_json(self, build):
+        done = "_cancelled" in build or self.elapsed(build) >= self.args.build_seconds
+        status = "aborted" if "_cancelled" in build else "success"
+        return {
+            "customModelId": build["customModelId"], "customModelVersionId": build["customModelVersionId"],
+            "buildStatus": status if done else "processing", "buildStart": build["buildStart"], "buildEnd": now_iso() if done else "",
+        }
+
+    def start_build(self, request):
+        cm_id, version_id = request["ids"]
+        if version_id not in self.versions:
+            return 404, {"message": "custom model version not found"}, {}
+        if version_id in self.builds:
+            return 422, {"message": "dependency build already started for this version"}, {}
+        self.builds[version_id] = {"_started": time.monotonic(), "customModelId": cm_id, "customModelVersionId": version_id, "buildStart": now_iso()}
+        return 202, self.build_json(self.builds[version_id]), {}
+
+    def get_build(self, request):
+        build = self.builds.get(request["ids"][1])
+        if build is None:
+            return 404, {"message": "no dependency build for this version"}, {}
+        return 200, self.build_json(build), {}
+
+    def cancel_build(self, request):
+        build = self.builds.get(request["ids"][1])
+        if build is None:
+            return 404, {"message": "no dependency build for this version"}, {}
+        build.setdefault("_cancelled", True)
+        return 204, None, {}
+
+    def dataset_json(self, dataset_id, version):
+        latest = max(self.datasets[dataset_id]["versions"].values(), key=lambda v: v["_started"])
+        return {
+            "datasetId": dataset_id, "versionId": version["versionId"], "name": self.datasets[dataset_id]["name"], "categories": [],
+            "creationDate": version["creationDate"], "createdBy": "fake", "dataPersisted": True, "isDataEngineEligible": False,
+            "isLatestVersion": version is latest, "isSnapshot": True, "datasetSize": version["size"], "processingState": "COMPLETED",
+        }
+
+    def create_dataset(self, request):
+        fields = self.form_body(request)
+        upload = next(((filename, value) for name, filename, value in fields if filename is not None), ("data.csv", b""))
+        if request["ids"]:
+            dataset_id = request["ids"][0]
+            if dataset_id not in self.datasets:
+                return 404, {"message": "dataset not found"}, {}
+        else:
+            dataset_id = self.new_id()
+            self.datasets[dataset_id] = {"name": upload[0], "versions": {}}
+        version = {"_started": time.monotonic(), "versionId": self.new_id(), "creationDate": now_iso(), "size": len(upload[1])}
+        self.datasets[dataset_id]["versions"][version["versionId"]] = version
+        location = f"datasets/{dataset_id}/versions/{version['versionId']}/"
+        return 202, {"statusId": location}, self.async_status(request, location, self.args.dataset_seconds)
+
+    def get_dataset(self, request):
+        dataset = self.datasets.get(request["ids"][0])
+        if dataset is None or not dataset["versions"]:
+            return 404, {"message": "dataset not found"}, {}
+        if len(request["ids"]) > 1:
+            version = dataset["versions"].get(request["ids"][1])
+            if version is None:
+                return 404, {"message": "dataset version not found"}, {}
+        else:
+            version = max(dataset["versions"].values(), key=lambda v: v["_started"])
+        return 200, self.dataset_json(request["ids"][0], version), {}
+
+    def list_dataset_versions(self, request):
+        dataset_id = request["ids"][0]
+        if dataset_id not in self.datasets:
+            return 404, {"message": "dataset not found"}, {}
+        versions = sorted(self.datasets[dataset_id]["versions"].values(), key=lambda v: v["_started"], reverse=True)
+        return 200, self.page(request, [self.dataset_json(dataset_id, v) for v in versions], f"datasets/{dataset_id}/versions/"), {}
+
+    def page(self, request, items, path):
+        limit = int(request["query"].get("limit", ["100"])[0]) or 100
+        offset = int(request["query"].get("offset", ["0"])[0])
+        next_url = f"{request['base_url']}{path}?limit={limit}&offset={offset + limit}" if offset + limit < len(items) else None
+        return {"count": len(items[offset:offset + limit]), "totalCount": len(items), "data": items[offset:offset + limit], "next": next_url, "previous": None}
+
+    def delete_dataset_version(self, request):
+        dataset_id, version_id = request["ids"]
+        if self.datasets.get(dataset_id, {}).get("versions", {}).pop(version_id, None) is None:
+            return 404, {"message": "dataset version not found"}, {}
+        return 204, None, {}
+
+    def get_status(self, request):
+        status = self.statuses.get(request["ids"][0])
+        if status is None:
+            return 404, {"message": "status not found"}, {}
+        if self.elapsed(status) < status["seconds"]:
+            return 200, {"status": "RUNNING"}, {}
+        return 303, {"status": "COMPLETED"}, {"Location": request["base_url"] + status["location"]}
+
+    def package_json(self, package):
+        data = {k: v for k, v in package.items() if not k.startswith("_")}
+        data["buildStatus"] = "complete" if self.elapsed(package) >= self.args.package_build_seconds else "inProgress"
+        return data
+
+    def create_package(self, request):
+        body = self.json_body(request)
+        rm_id = body.get("registeredModelId")
+        if rm_id is None:
+            rm_id = self.new_id()
+            self.registered_models[rm_id] = {
+                "id": rm_id, "name": body.get("registeredModelName") or body.get("name", ""), "description": body.get("registeredModelDescription") or "",
+                "createdAt": now_iso(), "modifiedAt": now_iso(), "target": body.get("target") or {}, "createdBy": {"id": "fake"},
+                "lastVersionNum": 0, "isArchived": False,
+            }
+        elif rm_id not in self.registered_models:
+            return 404, {"message": "registered model not found"}, {}
+        rm = self.registered_models[rm_id]
+        rm["lastVersionNum"] += 1
+        is_custom = "customModelVersionId" in body
+        package = {
+            "_started": time.monotonic(), "id": self.new_id(), "registeredModelId": rm_id, "registeredModelVersion": rm["lastVersionNum"],
+            "name": body.get("name") or "", "modelId": body.get("customModelVersionId") or self.new_id(),
+            "modelExecutionType": "custom_inference_model" if is_custom else "external", "isArchived": False, "importMeta": {},
+            "sourceMeta": {}, "modelKind": {}, "target": body.get("target") or {}, "modelDescription": {}, "datasets": body.get("datasets") or {},
+            "timeseries": {}, "isDeprecated": False, "permissions": [], "activeDeploymentCount": 0,
+        }
+        self.packages[package["id"]] = package
+        return 201, self.package_json(package), {}
+
+    def get_registered_model(self, request):
+        rm = self.registered_models.get(request["ids"][0])
+        if rm is None:
+            return 404, {"message": "registered model not found"}, {}
+        return 200, rm, {}
+
+    def get_package(self, request):
+        package = self.packages.get(request["ids"][1])
+        if package is None or package["registeredModelId"] != request["ids"][0]:
+            return 404, {"message": "registered model version not found"}, {}
+        return 200, self.package_json(package), {}
+
+    def deployment_json(self, deployment):
+        package = self.packages[deployment["_package_id"]]
+        return {
+            **{k: v for k, v in deployment.items() if not k.startswith("_")},
+            "modelPackage": {"id": package["id"], "name": package["name"], "registeredModelId": package["registeredModelId"]},
+            "model": {"id": package["modelId"], "type": package["modelExecutionType"]},
+        }
+
+    def create_deployment(self, request):
+        body = self.json_body(request)
+        if body.get("modelPackageId") not in self.packages:
+            return 404, {"message": "model package not found"}, {}
+        deployment = {
+            "_started": time.monotonic(), "_package_id": body["modelPackageId"], "id": self.new_id(), "label": body.get("label", ""),
+            "description": body.get("description"), "status": "active",
+            "predictionEnvironment": {"id": body.get("predictionEnvironmentId"), "name": "fake serverless", "platform": "datarobotServerless"},
+            "_settings": {
+                "associationId": {"columnNames": [], "requiredInPredictionRequests": False},
+                "predictionsDataCollection": {"enabled": False},
+                "targetDrift": {"enabled": False},
+                "featureDrift": {"enabled": False, "featureSelection": "auto", "trackedFeatures": []},
+            },
+        }
+        self.deployments[deployment["id"]] = deployment
+        return 202, {"id": deployment["id"]}, self.async_status(request, f"deployments/{deployment['id']}/", self.args.deploy_seconds)
+
+    def list_deployments(self, request):
+        ## search matches the label or description, case insensitive
+        search = request["query"].get("search", [""])[0].lower()
+        items = [self.deployment_json(d) for d in self.deployments.values()
+                 if search in d["label"].lower() or search in (d["description"] or "").lower()]
+        return 200, self.page(request, items, "deployments/"), {}
+
+    def get_deployment(self, request):
+        deployment = self.deployments.get(request["ids"][0])
+        if deployment is None:
+            return 404, {"message": "deployment not found"}, {}
+        return 200, self.deployment_json(deployment), {}
+
+    def validate_replacement(self, request):
+        if request["ids"][0] not in self.deployments:
+            return 404, {"message": "deployment not found"}, {}
+        if self.json_body(request).get("modelPackageId") not in self.packages:
+            return 422, {"status": "failing", "message": "model package not found"}, {}
+        return 200, {"status": "passing", "message": "", "checks": {}}, {}
+
+    def replace_model(self, request):
+        deployment = self.deployments.get(request["ids"][0])
+        package_id = self.json_body(request).get("modelPackageId")
+        if deployment is None or package_id not in self.packages:
+            return 404, {"message": "deployment or model package not found"}, {}
+        deployment["_package_id"] = package_id
+        return 202, {}, self.async_status(request, f"deployments/{deployment['id']}/", 0)
+
+    def get_settings(self, request):
+        deployment = self.deployments.get(request["ids"][0])
+        if deployment is None:
+            return 404, {"message": "deployment not found"}, {}
+        return 200, deployment["_settings"], {}
+
+    def update_settings(self, request):
+        deployment = self.deployments.get(request["ids"][0])
+        if deployment is None:
+            return 404, {"message": "deployment not found"}, {}
+        for section, values in self.json_body(request).items():
+            deployment["_settings"].setdefault(section, {}).update(values)
+        return 202, {}, self.async_status(request, f"deployments/{deployment['id']}/settings/", 0)
+
+    def job_definition_json(self, definition):
+        return {k: v for k, v in definition.items() if not k.startswith("_")}
+
+    def list_job_definitions(self, request):
+        items = [self.job_definition_json(d) for d in self.job_definitions.values()]
+        deployment_id = request["query"].get("deploymentId", [None])[0]
+        if deployment_id:
+            items = [d for d in items if d["batchMonitoringJob"]["deploymentId"] == deployment_id]
+        return 200, self.page(request, items, "batchMonitoringJobDefinitions/"), {}
+
+    def create_job_definition(self, request):
+        body = self.json_body(request)
+        if body.get("deploymentId") not in self.deployments:
+            return 404, {"message": "deployment not found"}, {}
+        definition = {"id": self.new_id(), "name": body.get("name", ""), "enabled": body.get("enabled", False), "batchMonitoringJob": body}
+        self.job_definitions[definition["id"]] = definition
+        return 201, self.job_definition_json(definition), {}
+
+    def get_job_definition(self, request):
+        definition = self.job_definitions.get(request["ids"][0])
+        if definition is None:
+            return 404, {"message": "job definition not found"}, {}
+        return 200, self.job_definition_json(definition), {}
+
+    def update_job_definition(self, request):
+        definition = self.job_definitions.get(request["ids"][0])
+        if definition is None:
+            return 404, {"message": "job definition not found"}, {}
+        definition["batchMonitoringJob"].update(self.json_body(request))
+        return 200, self.job_definition_json(definition), {}
+
+    def batch_job_json(self, job):
+        elapsed = self.elapsed(job)
+        status = "COMPLETED" if elapsed >= self.args.batch_job_seconds else ("RUNNING" if elapsed >= 1 else "INITIALIZING")
+        return {
+            "id": job["id"], "status": status, "percentageCompleted": 100 if status == "COMPLETED" else 0,
+            "batchMonitoringJobDefinition": {"id": job["_definition"]["id"], "name": job["_definition"]["name"]},
+            "logs": [f"{now_iso()} job {status.lower()}"], "links": {"self": f"batchJobs/{job['id']}/"},
+        }
+
+    def run_job_definition(self, request):
+        definition = self.job_definitions.get(self.json_body(request).get("jobDefinitionId"))
+        if definition is None:
+            return 404, {"message": "job definition not found"}, {}
+        job = {"_started": time.monotonic(), "_definition": definition, "id": self.new_id()}
+        self.batch_jobs[job["id"]] = job
+        return 202, self.batch_job_json(job), {}
+
+    def list_batch_jobs(self, request):
+        ## newest first, like the real list
+        items = [self.batch_job_json(job) for job in reversed(list(self.batch_jobs.values()))]
+        return 200, self.page(request, items, "batchJobs/"), {}
+
+    def get_batch_job(self, request):
+        job = self.batch_jobs.get(request["ids"][0])
+        if job is None:
+            return 404, {"message": "batch job not found"}, {}
+        return 200, self.batch_job_json(job), {}
+
+
+def make_handler(api, args):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        ## a client that sends less body than its Content-Length should not hang a worker forever
+        timeout = 60
+
+        def send_json(self, status, payload, headers=None):
+            body = json.dumps(payload).encode("utf-8") if payload is not None else b""
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def handle_any(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            url = urlparse(self.path)
+            if url.path.startswith("/__stats__"):
+                if self.command == "POST":
+                    api.reset_stats()
+                return self.send_json(200, api.stats())
+            if not url.path.startswith(API_PREFIX):
+                return self.send_json(404, {"message": f"{url.path} not found"})
+            time.sleep(args.latency + random.uniform(0, args.jitter))
+            if (wait := api.throttle()) is not None:
+                ## whole seconds, like the real api (urllib3 rejects fractional Retry-After values)
+                return self.send_json(429, {"message": "rate limit exceeded"}, {"Retry-After": str(math.ceil(wait))})
+            base_url = f"http://{self.headers.get('Host')}{API_PREFIX}"
+            status, payload, headers = api.dispatch(
+                self.command, url.path[len(API_PREFIX):], parse_qs(url.query), body, self.headers.get("Content-Type", ""), base_url)
+            self.send_json(status, payload, headers)
+
+        do_GET = do_POST = do_PATCH = do_PUT = do_DELETE = handle_any
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    return Handler
+
+
+def main():
+    args = parse_args()
+    api = FakeDataRobot(args)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(api, args))
+    server.daemon_threads = True
+    logger.info(f"fake datarobot api on http://{args.host}:{args.port}{API_PREFIX}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,221 @@
+"""
+Usage:
+    python benchmarks/load_test.py --url http://0.0.0.0:12345 --rps 5 10 20 --batch-sizes 1 100 --concurrency 8
+    python benchmarks/load_test.py --start-server --rps 10 --duration 30 --output ./bench_results/load_test.json
+
+Open loop load generator for the drum inference server started by start_server.sh.
+Rows from data/test_data.csv are replayed to /predictUnstructured/ in batches at a fixed
+target rate, independent of how fast the server answers, so queueing in the server shows
+up as latency instead of silently lowering the offered load.
+"""
+import sys
+import os
+import json
+import time
+import random
+import argparse
+import asyncio
+import logging
+import tempfile
+import subprocess
+from datetime import datetime
+from pathlib import Path
+
+import aiohttp
+import numpy as np
+import pandas as pd
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+TARGET = "charges"
+## short names for the payload formats score_unstructured understands
+MIMETYPES = {"csv": "application/text", "json": "application/json"}
+
+logging.basicConfig(
+    level=logging.INFO,
+    stream=sys.stdout,
+    format='%(asctime)s %(filename)s:%(lineno)d %(levelname)s %(message)s',
+)
+logger = logging.getLogger(__name__)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description=__doc__, usage='python %(prog)s [--url URL] [--rps 10] [--batch-sizes 1 100] [--mimetypes csv json]',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('--url', help='base url of the inference server', default="http://0.0.0.0:12345")
+    parser.add_argument('--data', help='csv with rows to replay', default=str(REPO_ROOT / "data" / "test_data.csv"))
+    parser.add_argument('--batch-sizes', nargs="+", type=int, help='rows per request', default=[1, 100])
+    parser.add_argument('--concurrency', nargs="+", type=int, help='max requests in flight', default=[8])
+    parser.add_argument('--mimetypes', nargs="+", help='csv, json or a literal mimetype', default=["csv", "json"])
+    parser.add_argument('--rps', nargs="+", type=float, help='target requests per second (open loop)', default=[10.0])
+    parser.add_argument('--duration', type=float, help='seconds to run each scenario', default=30.0)
+    parser.add_argument('--warmup', type=float, help='seconds of load before measuring each scenario', default=3.0)
+    parser.add_argument('--poisson', action="store_true", help='exponential inter-arrival times instead of a fixed interval')
+    parser.add_argument('--timeout', type=float, help='per request timeout in seconds', default=60.0)
+    parser.add_argument('--output', help='where to write the json results', default=None)
+    parser.add_argument('--start-server', action="store_true", help='start drum locally with the mlops filesystem spooler in a temp dir')
+    parser.add_argument('--code-dir', help='code dir for --start-server', default=str(REPO_ROOT / "custom-model"))
+    return parser.parse_args()
+
+
+def build_payloads(df, batch_size, mimetype, n_payloads=50):
+    """pre-encode a pool of request bodies so encoding isn't measured as server latency"""
+    payloads = []
+    for i in range(n_payloads):
+        idx = (np.arange(batch_size) + i * batch_size) % df.shape[0]
+        batch = df.iloc[idx]
+        if mimetype == "application/json":
+            body = batch.to_json(orient="records")
+        else:
+            body = batch.to_csv(index=False)
+        payloads.append(body.encode("utf-8"))
+    return payloads
+
+
+def start_drum_server(code_dir, url, spool_dir):
+    address = url.split("://")[-1].rstrip("/")
+    env = dict(os.environ)
+    env.update({
+        "MLOPS_SPOOLER_TYPE": "FILESYSTEM",
+        "MLOPS_FILESYSTEM_DIRECTORY": spool_dir,
+        "MLOPS_DEPLOYMENT_ID": "dummy_id_1234",
+        "MLOPS_MODEL_ID": "dummy_id_4321",
+        "DEPLOYMENT_ID": "dummy_id_1234",
+        "MODEL_ID": "dummy_id_4321",
+    })
+    cmd = ["drum", "server", "--code-dir", code_dir, "--target-type", "unstructured", "--address", address]
+    logger.info(f"starting drum server: {' '.join(cmd)} (spooling to {spool_dir})")
+    return subprocess.Popen(cmd, env=env)
+
+
+async def wait_for_server(session, url, timeout=120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            async with session.get(f"{url}/ping/") as response:
+                if response.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(1)
+    raise Exception(f"server at {url} did not respond to /ping/ within {timeout} seconds")
+
+
+async def send(session, url, body, mimetype, semaphore, scheduled, samples, measuring):
+    ## latency is measured from the scheduled send time, so time spent waiting for a free
+    ## connection slot is included (avoids coordinated omission)
+    async with semaphore:
+        sent = time.perf_counter()
+        status = None
+        error = None
+        try:
+            async with session.post(f"{url}/predictUnstructured/", data=body, headers={"Content-Type": mimetype}) as response:
+                await response.read()
+                status = response.status
+        except Exception as e:
+            error = type(e).__name__
+        done = time.perf_counter()
+    if measuring():
+        samples.append({"latency": done - scheduled, "service": done - sent, "status": status, "error": error})
+
+
+async def run_scenario(session, url, payloads, mimetype, batch_size, rps, concurrency, duration, warmup, poisson):
+    semaphore = asyncio.Semaphore(concurrency)
+    samples = []
+    tasks = []
+    start = time.perf_counter()
+    measure_from = start + warmup
+    stop_at = measure_from + duration
+    next_send = start
+    i = 0
+    while next_send < stop_at:
+        now = time.perf_counter()
+        if next_send > now:
+            await asyncio.sleep(next_send - now)
+        scheduled = next_send
+        measuring = (lambda s=scheduled: s >= measure_from)
+        tasks.append(asyncio.create_task(send(session, url, payloads[i % len(payloads)], mimetype, semaphore, scheduled, samples, measuring)))
+        i += 1
+        next_send += random.expovariate(rps) if poisson else 1.0 / rps
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - measure_from
+    return summarize(samples, mimetype, batch_size, rps, concurrency, elapsed)
+
+
+def summarize(samples, mimetype, batch_size, rps, concurrency, elapsed):
+    ok = [s for s in samples if s["status"] == 200]
+    errors = {}
+    for s in samples:
+        if s["status"] != 200:
+            key = s["error"] or f"http_{s['status']}"
+            errors[key] = errors.get(key, 0) + 1
+    latencies = np.array([s["latency"] for s in ok]) * 1000
+    service = np.array([s["service"] for s in ok]) * 1000
+    pct = lambda arr, q: float(np.percentile(arr, q)) if len(arr) else None
+    return {
+        "mimetype": mimetype,
+        "batch_size": batch_size,
+        "target_rps": rps,
+        "concurrency": concurrency,
+        "requests": len(samples),
+        "succeeded": len(ok),
+        "error_rate": (len(samples) - len(ok)) / len(samples) if samples else None,
+        "errors": errors,
+        "throughput_rps": len(ok) / elapsed if elapsed > 0 else None,
+        "throughput_rows_per_sec": len(ok) * batch_size / elapsed if elapsed > 0 else None,
+        "latency_ms": {"p50": pct(latencies, 50), "p95": pct(latencies, 95), "p99": pct(latencies, 99), "max": pct(latencies, 100)},
+        "service_time_ms": {"p50": pct(service, 50), "p95": pct(service, 95), "p99": pct(service, 99)},
+    }
+
+
+async def run(args):
+    df = pd.read_csv(args.data).drop(columns=[TARGET], errors="ignore")
+    url = args.url.rstrip("/")
+    server = None
+    spool_dir = None
+    if args.start_server:
+        spool_dir = tempfile.mkdtemp(prefix="mlops-spool-")
+        server = start_drum_server(args.code_dir, url, spool_dir)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    ## keep-alive connections, sized for the largest concurrency level being tested
+    connector = aiohttp.TCPConnector(limit=max(args.concurrency), force_close=False)
+    results = []
+    try:
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            await wait_for_server(session, url)
+            for mimetype_name in args.mimetypes:
+                mimetype = MIMETYPES.get(mimetype_name, mimetype_name)
+                for batch_size in args.batch_sizes:
+                    payloads = build_payloads(df, batch_size, mimetype)
+                    for concurrency in args.concurrency:
+                        for rps in args.rps:
+                            logger.info(f"{mimetype} batch={batch_size} concurrency={concurrency} target={rps}rps for {args.duration}s")
+                            result = await run_scenario(session, url, payloads, mimetype, batch_size, rps, concurrency,
+                                                        args.duration, args.warmup, args.poisson)
+                            lat = result["latency_ms"]
+                            logger.info(f"  p50={lat['p50']}ms p95={lat['p95']}ms p99={lat['p99']}ms "
+                                        f"throughput={result['throughput_rps']:.1f}rps error_rate={result['error_rate']}")
+                            results.append(result)
+    finally:
+        if server is not None:
+            logger.info("stopping drum server")
+            server.terminate()
+            server.wait(timeout=30)
+    return {"timestamp": datetime.now().isoformat(), "url": url, "mlops_spool_dir": spool_dir, "results": results}
+
+
+def main():
+    args = parse_args()
+    out = asyncio.run(run(args))
+    if args.output:
+        Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(out, f, indent=2)
+        logger.info(f"results written to {args.output}")
+    else:
+        print(json.dumps(out, indent=2))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
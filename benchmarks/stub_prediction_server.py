@@ -0,0 +1,105 @@
+"""
+Usage:
+    python benchmarks/stub_prediction_server.py --port 8080 --latency 0.05 --error-rate 0.05
+    REMOTE_PREDICTION_BASE_URL=http://127.0.0.1:8080 ./start_server.sh
+
+Local stand-in for the DataRobot realtime prediction api, for exercising the remote tags of
+RoutingModel (`remote: true` in routing_config.yaml) offline.  Each deployment id from
+routing_config.yaml is answered by the matching pickle in custom-model/models, with optional
+added latency and injected 503s to see hedging and retries at work.
+"""
+import sys
+import json
+import time
+import random
+import pickle
+import logging
+import argparse
+from io import StringIO
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import yaml
+import pandas as pd
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+logging.basicConfig(
+    level=logging.INFO,
+    stream=sys.stdout,
+    format='%(asctime)s %(filename)s:%(lineno)d %(levelname)s %(message)s',
+)
+logger = logging.getLogger(__name__)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description=__doc__, usage='python %(prog)s [--port 8080] [--latency 0.05] [--error-rate 0.0]',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('--code-dir', help='custom model folder with routing_config.yaml and models/', default=str(REPO_ROOT / "custom-model"))
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, help='seconds added to every response', default=0.0)
+    parser.add_argument('--jitter', type=float, help='extra uniformly random seconds added to every response', default=0.0)
+    parser.add_argument('--error-rate', type=float, help='fraction of requests answered with a 503', default=0.0)
+    return parser.parse_args()
+
+
+def load_models(code_dir):
+    with open(Path(code_dir) / "routing_config.yaml", "r") as f:
+        routing_config = yaml.load(f, Loader=yaml.SafeLoader)
+    models = {}
+    for model_config in routing_config:
+        with open(Path(code_dir) / "models" / model_config["tag"] / "model.pkl", "rb") as f:
+            models[model_config["deployment_id"]] = pickle.load(f)
+    return models
+
+
+def make_handler(models, args):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def send_json(self, status, payload):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            parts = self.path.split("?")[0].strip("/").split("/")
+            ## api/v2/deployments/<deployment_id>/predictions
+            if len(parts) != 5 or parts[:3] != ["api", "v2", "deployments"] or parts[4] != "predictions":
+                return self.send_json(404, {"message": f"{self.path} not found"})
+            model = models.get(parts[3])
+            if model is None:
+                return self.send_json(404, {"message": f"deployment {parts[3]} not found"})
+            time.sleep(args.latency + random.uniform(0, args.jitter))
+            if random.random() < args.error_rate:
+                return self.send_json(503, {"message": "injected error"})
+            df = pd.read_csv(StringIO(body.decode("utf-8")))
+            predictions = model.predict(df).tolist()
+            self.send_json(200, {"data": [{"rowId": i, "prediction": p} for i, p in enumerate(predictions)]})
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    return Handler
+
+
+def main():
+    args = parse_args()
+    models = load_models(args.code_dir)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(models, args))
+    logger.info(f"stub prediction server for {len(models)} deployments on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    sys.exit(main())
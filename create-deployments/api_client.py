@@ -0,0 +1,33 @@
+import os
+import logging
+import threading
+
+from rate_limit import install
+
+logger = logging.getLogger(__name__)
+
+## enough connections for every model's worker thread to keep its own keep-alive connection
+DEFAULT_POOL_SIZE = int(os.environ.get("DATAROBOT_POOL_SIZE", 32))
+
+_client = None
+_lock = threading.Lock()
+
+
+def get_client(pool_size=None):
+    """
+    the one DataRobot client shared by all the orchestration code.
+
+    dr.Client() builds a new session (and a new TLS handshake on first use) every time it is
+    called, so it is created once here, registered as the datarobot sdk's default client, and
+    given a connection pool big enough that connections from concurrent worker threads are kept
+    alive and reused instead of being discarded when the pool overflows.  requests go through
+    the shared rate limiter in rate_limit.py.
+    """
+    global _client
+    with _lock:
+        if _client is None:
+            import datarobot as dr
+            pool_size = pool_size or DEFAULT_POOL_SIZE
+            _client = install(dr.Client(), pool_connections=pool_size, pool_maxsize=pool_size)
+            logger.debug(f"datarobot client created with a pool of {pool_size} connections")
+        return _client
@@ -0,0 +1,173 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+def hash_file(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_folder(folder):
+    """
+    sha256 of every file in folder, keyed by path relative to folder, and one digest over all of
+    them.  hidden files and __pycache__ are ignored, they are not part of the model.
+    """
+    folder = Path(folder)
+    files = {}
+    for path in sorted(folder.rglob("*")):
+        relative = path.relative_to(folder)
+        if not path.is_file() or "__pycache__" in relative.parts or any(p.startswith(".") for p in relative.parts):
+            continue
+        files[relative.as_posix()] = hash_file(path)
+    digest = hashlib.sha256(json.dumps(files, sort_keys=True).encode("utf-8")).hexdigest()
+    return digest, files
+
+
+def _key(*parts):
+    return hashlib.sha256("|".join(str(p) for p in parts).encode("utf-8")).hexdigest()
+
+
+class ArtifactIndex(object):
+    """
+    local index of artifact folder contents -> custom model versions already created from them.
+
+    a version is keyed by the custom model, its environment, its training dataset and the
+    sha256 of every file in the artifact folder, so an unchanged quantile reuses its existing
+    version (and the dependency build and registered model version that came with it) instead of
+    uploading the folder and building it again.  requirements.txt files are hashed with the
+    environment so a failed build can stop the builds of identical requirements, see
+    BuildWatch.  the index is a json file written atomically after every update.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        self.data = {"versions": {}, "latest": {}, "validations": {}}
+        ## file hashes per conf name for this run, kept out of the conf so they don't end up in the yaml
+        self.files = {}
+        if self.path.exists():
+            with open(self.path, "r") as f:
+                self.data.update(json.load(f))
+
+    def _save(self):
+        tmp_path = self.path.with_name(f".{self.path.name}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.data, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def fingerprint(self, conf):
+        """hash the artifact folder and requirements of conf, and store the keys on the conf"""
+        folder = Path(conf["artifact_folder"])
+        digest, files = hash_folder(folder)
+        conf["artifact_hash"] = digest
+        self.files[conf.get("name")] = files
+        requirements = files.get("requirements.txt")
+        conf["requirements_hash"] = (
+            _key(requirements, conf.get("environment_id"), conf.get("environment_version_id")) if requirements else None
+        )
+        return conf
+
+    def version_key(self, conf):
+        return _key(
+            conf.get("custom_model_id"), conf.get("environment_id"), conf.get("environment_version_id"),
+            conf.get("training_dataset_id"), conf["artifact_hash"],
+        )
+
+    def lookup_version(self, conf):
+        if conf.get("custom_model_id") is None:
+            return None
+        return self.data["versions"].get(self.version_key(conf))
+
+    def latest_files(self, custom_model_id):
+        """{custom_model_version_id, files} of the last version created for custom_model_id"""
+        return self.data["latest"].get(custom_model_id)
+
+    def changed_files(self, conf, previous_files):
+        """(files added or changed since previous_files, files removed since)"""
+        files = self.files[conf.get("name")]
+        changed = [path for path, digest in files.items() if previous_files.get(path) != digest]
+        removed = [path for path in previous_files if path not in files]
+        return changed, removed
+
+    def validation(self, key):
+        return self.data["validations"].get(key)
+
+    def record_validation(self, key):
+        with self.lock:
+            self.data["validations"][key] = True
+            self._save()
+
+    def update(self, stage_name, conf):
+        """called after each pipeline stage, records what the stage created for conf"""
+        if "artifact_hash" not in conf or conf.get("custom_model_id") is None:
+            return
+        with self.lock:
+            entry = self.data["versions"].setdefault(self.version_key(conf), {})
+            if stage_name == "create_version":
+                entry.update({
+                    "name": conf.get("name"),
+                    "custom_model_version_id": conf["custom_model_version_id"],
+                    "includes_requirements": conf.get("includes_requirements", False),
+                })
+                self.data["latest"][conf["custom_model_id"]] = {
+                    "custom_model_version_id": conf["custom_model_version_id"],
+                    "files": self.files.get(conf.get("name"), {}),
+                }
+            elif stage_name == "wait_for_environment":
+                entry["environment_build_status"] = conf.get("environment_build_status")
+            elif stage_name == "wait_for_package_build":
+                entry["registered_model_id"] = conf.get("registered_model_id")
+                entry["registered_model_version_id"] = conf.get("registered_model_version_id")
+            self._save()
+
+    def apply(self, conf):
+        """look conf up in the index, and when its artifacts are unchanged point it at the existing version"""
+        entry = self.lookup_version(conf)
+        if entry is None or "custom_model_version_id" not in entry:
+            conf.pop("reused_version", None)
+            return conf
+        logger.info(f"{conf.get('name')}: artifacts unchanged, reusing custom model version {entry['custom_model_version_id']}")
+        conf["reused_version"] = dict(entry)
+        conf["custom_model_version_id"] = entry["custom_model_version_id"]
+        conf["includes_requirements"] = entry.get("includes_requirements", False)
+        if entry.get("environment_build_status"):
+            conf["environment_build_status"] = entry["environment_build_status"]
+        if entry.get("registered_model_version_id"):
+            conf["registered_model_id"] = entry["registered_model_id"]
+            conf["registered_model_version_id"] = entry["registered_model_version_id"]
+        return conf
+
+
+class BuildWatch(object):
+    """
+    dependency builds of identical requirements.txt (+ environment) in a run.
+
+    dependency builds belong to a custom model version, so every new version needs its own, and
+    they all build in parallel.  the first one to fail marks its requirements hash as failed, the
+    other builds of that hash then stop waiting (and are cancelled) or don't start, so a broken
+    requirements.txt fails the run after one build instead of after 19 identical ones.
+    """
+
+    def __init__(self):
+        self.failed = {}
+
+    def done(self, conf, status):
+        """record conf's build status, a failed build fails its requirements hash for the run"""
+        key = conf.get("requirements_hash")
+        if key is not None and status not in (None, "success"):
+            self.failed.setdefault(key, (conf.get("name"), status))
+
+    def failure(self, conf):
+        """(name, status) of the failed build of conf's requirements, None while none has failed"""
+        failure = self.failed.get(conf.get("requirements_hash"))
+        if failure is None or failure[0] == conf.get("name"):
+            return None
+        return failure
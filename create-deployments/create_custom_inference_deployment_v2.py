@@ -9,8 +9,25 @@ import argparse
 import os
 from pathlib import Path
 import time 
+from pipeline import Stage, PipelineError, run_pipeline, parse_stage_limits
+from polling import poller
+from api_client import get_client
+from rate_limit import limiter, acall_with_retry
+from journal import StageJournal, check_unique_names, write_yaml_atomic
+from artifact_cache import ArtifactIndex, BuildWatch
+from datasets import register_training_dataset, dataset_index_path
+from settings import reconcile_deployment_settings
+from validation import validate_artifacts
+from sampling import register_test_sample
+from functools import partial
+from planner import CUSTOM_MODEL_STAGES, dataset_changed, fetch_server_state, plan_custom_model, format_plan
+from tracing import RUN, tracer
+from entity_cache import entity_cache, get_custom_model, get_deployment, get_registered_model_version
 
-client = dr.Client()
+client = get_client()
+## set up in main(), None when --no-artifact-cache is given
+artifact_index = None
+build_watch = BuildWatch()
 
 logging.basicConfig(
     level=logging.INFO,
@@ -84,28 +101,7 @@ async def drum_test(conf):
     conf["drum_test_passed"] = True
     return conf 
 
-def purge_old_dataset_version(dataset_id, limit=100):
-    limit = limit - 1
-    dataset_url = f"datasets/{dataset_id}/versions?limit={limit}"
-    def helper(dataset_url): 
-        dataset_versions = client.get(dataset_url).json()
-        if "offset" in dataset_url:
-            print("off set present, deleting old versions")
-            for d in dataset_versions["data"]:
-                print(f"datasets/{d['datasetId']}/versions/{d['versionId']}/")
-                delete_req = client.delete(f"datasets/{d['datasetId']}/versions/{d['versionId']}/")
-                print(delete_req)
-        if next := dataset_versions.get("next"):
-            print(next)
-            print(dataset_url)
-            query_parameters = next.split("/")[-1]
-            next_url = os.path.join( dataset_url.split("?")[0], query_parameters)
-            print(next_url)
-            helper(next_url)
-    helper(dataset_url)
-
-def register_dataset(training_dataset_id, training_dataset_path):
-    client = dr.Client()
+def register_dataset(training_dataset_id, training_dataset_path, keep_versions=None, protect=(), index_path=None):
     if training_dataset_id is not None and training_dataset_path is not None:
         logger.info(f"when providing both training dataset id and training dataset path in config, it is assumed a new version should be registered.")
     elif training_dataset_id is None and training_dataset_path is None: 
@@ -114,22 +110,20 @@ def register_dataset(training_dataset_id, training_dataset_path):
     if training_dataset_id is None and training_dataset_path is not None:
         training_dataset_path = Path(training_dataset_path)
         logger.info(f"register training dataset")
-        training_dataset = dr.Dataset.create_from_file(str(training_dataset_path))    
+        training_dataset = register_training_dataset(None, training_dataset_path, index_path=index_path)
         logger.info(f"recording training dataset id to deployment config")
     elif training_dataset_id is not None and training_dataset_path is None:
         logger.info(f"training dataset id has been provided and will be used to set drift baselines for deployments")
         training_dataset = dr.Dataset.get(training_dataset_id)
     elif training_dataset_id is not None and training_dataset_path is not None:
         logger.info(f"training dataset id and trainign data path have been provided, registering new version")
-        # purge_old_dataset_version(training_dataset_id)
-        training_dataset = dr.Dataset.create_version_from_file(training_dataset_id, str(training_dataset_path))
+        training_dataset = register_training_dataset(training_dataset_id, training_dataset_path, keep_versions=keep_versions, protect=protect, index_path=index_path)
     else:
         raise Exception("expection occured since neither training dataset nor training dataset id were provided.")
     return training_dataset
 
 async def create_custom_model_version(conf):
     def _create():
-        client = dr.Client()
         custom_model_id = conf.get("custom_model_id") 
         artifact_folder = conf.get("artifact_folder")
         name = conf.get("name")
@@ -148,34 +142,60 @@ async def create_custom_model_version(conf):
                 class_labels = conf.get("class_labels")
             )
             custom_model_id = cm.id
+            ## a retried _create picks up this custom model instead of creating another one
+            conf["custom_model_id"] = cm.id
         else: 
             logger.info(f"{conf.get('name')}: creating new version of custom inference model")
-            cm = dr.CustomInferenceModel.get(custom_model_id)
-        logger.info(f"{conf.get('name')}: creating custom model version")
-        cmv = dr.CustomModelVersion.create_clean(cm.id, 
-                                                base_environment_id = environment_id,
-                                                base_environment_version_id = environment_version_id,
-                                                folder_path = artifact_folder, 
-                                                training_dataset_id=training_dataset_id
-                                                )
+            cm = get_custom_model(custom_model_id)
+        previous = artifact_index.latest_files(cm.id) if artifact_index is not None else None
+        if previous is not None and cm.latest_version is not None and previous["custom_model_version_id"] == cm.latest_version.id:
+            ## only upload what changed since the last version created from this folder
+            changed, removed = artifact_index.changed_files(conf, previous["files"])
+            logger.info(f"{conf.get('name')}: creating custom model version from previous, {len(changed)} changed and {len(removed)} removed file(s)")
+            files_to_delete = [item.id for item in cm.latest_version.items if item.file_path in removed or item.file_path in changed]
+            cmv = dr.CustomModelVersion.create_from_previous(cm.id,
+                                                            base_environment_id = environment_id,
+                                                            base_environment_version_id = environment_version_id,
+                                                            files = [(str(Path(artifact_folder) / path), path) for path in changed],
+                                                            files_to_delete = files_to_delete,
+                                                            training_dataset_id=training_dataset_id,
+                                                            max_wait=None
+                                                            )
+        else:
+            logger.info(f"{conf.get('name')}: creating custom model version")
+            cmv = dr.CustomModelVersion.create_clean(cm.id, 
+                                                    base_environment_id = environment_id,
+                                                    base_environment_version_id = environment_version_id,
+                                                    folder_path = artifact_folder, 
+                                                    training_dataset_id=training_dataset_id,
+                                                    max_wait=None
+                                                    )
+        ## the custom model's latest version has changed
+        entity_cache.invalidate("custom_model", cm.id)
+        return cm, cmv
+    ## max_wait=None: the sdk would block this thread on its own fixed 5s polling loop, the
+    ## assignment is waited on below with the shared poller instead.  the artifacts are a streamed
+    ## upload the rate limited adapter can't send again, so throttling is retried here (429 / 503
+    ## only, a create behind a gateway error may have gone through)
+    cm, cmv = await acall_with_retry(_create, name=f"{conf.get('name')}: create custom model version", idempotent=False)
+
+    def _assignment_done():
         cmv.refresh()
-        logger.info(f"{conf.get('name')}: Training data assignment in progress: {cmv.training_data.assignment_in_progress}")
-        i = 0
-        while cmv.training_data.assignment_in_progress:
-            logger.info(f"{conf.get('name')}: Waiting for training data assignment to complete...")
-            time.sleep(60)
-            i += 1
-            cmv.refresh()
-        conf["custom_model_id"] = cm.id 
-        conf["custom_model_version_id"] = cmv.id 
-        conf["includes_requirements"] = any( item.file_name=="requirements.txt" for item in cmv.items)
-        return conf
-    return await asyncio.to_thread(_create)    
+        if cmv.training_data.assignment_in_progress:
+            return None
+        return cmv
+    logger.info(f"{conf.get('name')}: waiting for training data assignment to complete...")
+    await poller.wait(f"{conf.get('name')} training data assignment", _assignment_done, initial_interval=5)
+    conf["custom_model_id"] = cm.id 
+    conf["custom_model_version_id"] = cmv.id 
+    conf["includes_requirements"] = any( item.file_name=="requirements.txt" for item in cmv.items)
+    return conf
 
 
 async def build_custom_model_environment(conf):
     def _create():
-        client = dr.Client()
+        if conf["includes_requirements"] and (failure := build_watch.failure(conf)):
+            raise Exception(f"{conf.get('name')}: build of identical requirements ({failure[0]}) finished with status {failure[1]}")
         if conf["includes_requirements"]:
             logger.info(f"{conf.get('name')}: building custom model environment")
             cm_id = conf.get("custom_model_id")
@@ -183,6 +203,8 @@ async def build_custom_model_environment(conf):
             url = f"customModels/{cm_id}/versions/{cmv_id}/dependencyBuild/"
             try:
                 build_req = client.post(url)
+                ## lets a resumed run pick the build back up in wait_for_custom_model_environment
+                conf["dependency_build_requested"] = True
                 build_info = dr.CustomModelVersionDependencyBuild.get_build_info(cm_id, cmv_id)
             # build = dr.CustomModelVersionDependencyBuild.start_build(cm.id, cmv.id, max_wait = 1200)
             except Exception as e: 
@@ -194,30 +216,51 @@ async def build_custom_model_environment(conf):
         return conf, build_info
     return await asyncio.to_thread(_create)
 
-async def wait_for_custom_model_environment(conf, build_info):
-    def _create():
-        client = dr.Client()
-        if build_info is None:
-                return conf
-        while build_info.build_status in  ["submitted", "processing"]:
-            build_info.refresh()
-        if build_info.build_status != "success":
-            logger.info(f"{conf.get('name')}: {build_info}")
-        else:
-            logger.info(f"{conf.get('name')}: {build_info}")
-        conf["environment_build_status"] = build_info.build_status
+async def wait_for_custom_model_environment(conf, build_info=None):
+    if build_info is None and conf.get("dependency_build_requested"):
+        ## resumed run, the build was started before the interruption
+        build_info = await asyncio.to_thread(
+            dr.CustomModelVersionDependencyBuild.get_build_info, conf["custom_model_id"], conf["custom_model_version_id"])
+    if build_info is None:
         return conf
-    return await asyncio.to_thread(_create)
+    def _build_done():
+        ## a failed build of identical requirements fails this one too, no need to wait it out
+        if build_watch.failure(conf):
+            return build_info
+        if build_info.build_status in ["submitted", "processing"]:
+            build_info.refresh()
+        if build_info.build_status in ["submitted", "processing"]:
+            return None
+        return build_info
+    await poller.wait(f"{conf.get('name')} environment build", _build_done, initial_interval=10)
+    if build_info.build_status in ["submitted", "processing"]:
+        name, status = build_watch.failure(conf)
+        await asyncio.to_thread(cancel_dependency_build, conf)
+        raise Exception(f"{conf.get('name')}: build of identical requirements ({name}) finished with status {status}, build cancelled")
+    if build_info.build_status != "success":
+        logger.info(f"{conf.get('name')}: {build_info}")
+    else:
+        logger.info(f"{conf.get('name')}: {build_info}")
+    conf["environment_build_status"] = build_info.build_status
+    build_watch.done(conf, build_info.build_status)
+    return conf
 
-async def test_custom_model(conf):
+def cancel_dependency_build(conf):
+    url = f"customModels/{conf['custom_model_id']}/versions/{conf['custom_model_version_id']}/dependencyBuild/"
+    try:
+        client.delete(url)
+    except Exception as e:
+        logger.warning(f"{conf.get('name')}: could not cancel the environment build: {e}")
+
+async def test_custom_model(conf, sample_dataset_id=None):
     def _create():
-        client = dr.Client()
         cm_id = conf.get("custom_model_id")
         cmv_id = conf.get("custom_model_version_id")
-        test_dataset_id = conf.get("test_dataset_id", conf.get("training_dataset_id"))
+        ## a test_dataset_id in the conf wins, then the shared stratified sample, then the full training data
+        test_dataset_id = conf.get("test_dataset_id") or sample_dataset_id or conf.get("training_dataset_id")
         if test_dataset_id is None:
             logger.warning(f"{conf.get('name')}:not test dataset is provided. for testing custom model in datarobot.  Skipping test")
-            return conf, None
+            return conf
         else:
             logger.info(f"{conf.get('name')}: testing custom model with dataset.  This could take a while")
             custom_model_test = dr.CustomModelTest.create(
@@ -234,57 +277,43 @@ async def test_custom_model(conf):
     return await asyncio.to_thread(_create)
     
 async def register_custom_model(conf):
-    async def try_register():
-        def _create():
-            client = dr.Client()
-            cmv_id = conf.get("custom_model_version_id")
-            registered_model_id = conf.get("registered_model_id")
-            registered_model_name = f"{conf.get('name')} {datetime.now()}" if registered_model_id is None else None
-            return dr.RegisteredModelVersion.create_for_custom_model_version(
-                custom_model_version_id=cmv_id,
-                name=conf.get("name"),
-                registered_model_name=registered_model_name,
-                description=conf.get("name"),
-                registered_model_id=registered_model_id
-            )
-
-        return await asyncio.to_thread(_create)
-    while True:
-        try:
-            logger.info(f"{conf.get('name')}: registering model - this could take a while")
-            registered_model_version = await try_register()
-            conf["registered_model_version_id"] = registered_model_version.id
-            conf["registered_model_id"] = registered_model_version.registered_model_id
-            logging.info(f"{conf.get('name')}: registered model version {registered_model_version.id} registered successfully")
-            return conf
-        except Exception as e:
-            logger.info(e)
-            try:
-                message = e.json["message"]
-                wait_for = int(message.split(" ")[-2])
-            except Exception:
-                logger.error(f"{conf.get('name')}:Unexpected error format. Aborting retry.")
-                raise
-            logger.info(f"{conf.get('name')}: Waiting for {wait_for} seconds before retrying to register custom model.")
-            await asyncio.sleep(wait_for)
+    def _create():
+        cmv_id = conf.get("custom_model_version_id")
+        registered_model_id = conf.get("registered_model_id")
+        registered_model_name = f"{conf.get('name')} {datetime.now()}" if registered_model_id is None else None
+        return dr.RegisteredModelVersion.create_for_custom_model_version(
+            custom_model_version_id=cmv_id,
+            name=conf.get("name"),
+            registered_model_name=registered_model_name,
+            description=conf.get("name"),
+            registered_model_id=registered_model_id
+        )
+    logger.info(f"{conf.get('name')}: registering model - this could take a while")
+    ## throttling is retried based on the status code / Retry-After, see rate_limit.py.  a create,
+    ## so a 502 / 504 is not sent again
+    registered_model_version = await acall_with_retry(_create, name=f"{conf.get('name')}: register custom model", idempotent=False)
+    conf["registered_model_version_id"] = registered_model_version.id
+    conf["registered_model_id"] = registered_model_version.registered_model_id
+    logging.info(f"{conf.get('name')}: registered model version {registered_model_version.id} registered successfully")
+    return conf
 
 async def wait_for_model_package_build(conf):
-    def _create():
-        client = dr.Client()
-        rm = dr.RegisteredModel.get(conf["registered_model_id"])
-        rmv = rm.get_version(conf["registered_model_version_id"])
-        logger.info(f"{conf.get('name')}: waiting for model package build to complete")
-        while rmv.build_status == "inProgress":
-            rmv = rm.get_version(rmv.id)
-        if rmv.build_status == "complete":
-            logger.info(f"{conf.get('name')}: registered model model package build is complete")
-        else:
-            logger.error(f"{conf.get('name')}: something happened during model package build: {rmv.build_status}")
-    return await asyncio.to_thread(_create)
+    def _package_built():
+        ## fresh status every check, the final state is left in the entity cache for the planner / deploy
+        rmv = get_registered_model_version(conf["registered_model_id"], conf["registered_model_version_id"], fresh=True)
+        if rmv.build_status == "inProgress":
+            return None
+        return rmv
+    logger.info(f"{conf.get('name')}: waiting for model package build to complete")
+    rmv = await poller.wait(f"{conf.get('name')} model package build", _package_built, initial_interval=5)
+    if rmv.build_status == "complete":
+        logger.info(f"{conf.get('name')}: registered model model package build is complete")
+    else:
+        logger.error(f"{conf.get('name')}: something happened during model package build: {rmv.build_status}")
+    return conf
 
 async def create_deployment(conf):
     def _create():
-        client = dr.Client()
         prediction_environment_id = conf.get("prediction_environment_id")
         registered_model_version_id = conf["registered_model_version_id"]
         if deployment_id := conf.get("deployment_id"):
@@ -299,7 +328,7 @@ async def create_deployment(conf):
                 logger.info(f"{conf.get('name')}:  deployment refresh successful")
             else:
                 logger.error(f"{conf.get('name')}: something went wrong.  replacement response returned status code {replacement_response.status_code}")
-            deployment = dr.Deployment.get(deployment_id)
+            deployment = get_deployment(deployment_id, fresh=True)
         else:
             logger.info(f"{conf.get('name')}: deployment does not exists")
             logger.info(f"{conf.get('name')}: creating deployment")
@@ -310,6 +339,7 @@ async def create_deployment(conf):
                 prediction_environment_id=prediction_environment_id,
                 max_wait = 3600
             )
+            entity_cache.put("deployment", deployment.id, deployment)
             conf["deployment_id"] = deployment.id
             conf["prediction_environment_id"] = prediction_environment_id
         if deployment.prediction_environment["platform"] == "datarobotServerless":
@@ -321,31 +351,16 @@ async def create_deployment(conf):
     return await asyncio.to_thread(_create)
 
 async def update_deployment_settings(conf):
-    features_to_track = conf.get("features_to_track", [])
-    logger.info(f"{conf.get('name')}: features to track: {features_to_track}")
-    if len(features_to_track) == 0:
-        feature_selection = "auto"
-    else:
-        feature_selection = "manual"
-    logger.info(f"{conf.get('name')}: feature selection for drift is {feature_selection}")
+    logger.info(f"{conf.get('name')}: features to track: {conf.get('features_to_track', [])}")
     def _create():
-        client = dr.Client()
-        deployment = dr.Deployment.get(conf["deployment_id"])
-        deployment.update_association_id_settings(["ASSOCIATION_ID"], required_in_prediction_requests=False)
-        deployment.update_predictions_data_collection_settings(enabled=True) 
-        # deployment.update_drift_tracking_settings(target_drift_enabled=True, feature_drift_enabled=True)
-        payload = {"targetDrift":{"enabled":True},
-                                         "featureDrift":{"enabled":True,"featureSelection":feature_selection,"trackedFeatures":features_to_track}}
-        logger.info(f"{conf.get('name')}: feature drift settings payload: {payload}")
-        dep_patch = client.patch(f"deployments/{deployment.id}/settings/", 
-                                 data = payload)
+        ## only the settings that differ from the conf are patched, see settings.py
+        conf["settings_patched"] = sorted(reconcile_deployment_settings(conf))
         return conf
     return await asyncio.to_thread(_create)
 
 def write_model_confs(model_confs, output_path = "./deployment_conf.yaml"):
     logger.info(f"writing model confs to disk as {output_path}")
-    with open(output_path,"w") as f:
-        f.write(yaml.dump(model_confs))
+    write_yaml_atomic(model_confs, output_path)
 
 def parse_args():
     parser = argparse.ArgumentParser(
@@ -354,6 +369,21 @@ def parse_args():
     parser.add_argument('--deployment-conf', help='path to deployment config yaml.  This must be provided.')
     parser.add_argument('--training-dataset-id', help='prediction dataset id for dataset registered to datarobot', default = None)
     parser.add_argument('--training-dataset-path', help='training dataset csv (includes target and feature).  Cannot be used with training-dataset-id', default=None)
+    parser.add_argument('--poll-deadline', type=float, help='seconds to wait in total for builds, training data assignment and package builds before giving up', default=None)
+    parser.add_argument('--api-rate', type=float, help='max DataRobot api requests per second, shared by all models', default=limiter.rate)
+    parser.add_argument('--api-burst', type=int, help='max burst of DataRobot api requests above --api-rate', default=int(limiter.burst))
+    parser.add_argument('--max-concurrency', type=int, help='max stage calls running at once across all models', default=None)
+    parser.add_argument('--stage-limit', action='append', help='per stage concurrency limit as <stage>=<int>, e.g. --stage-limit register=4.  Can be repeated', default=[])
+    parser.add_argument('--journal', help='stage journal path.  Defaults to <deployment-conf>.journal.jsonl', default=None)
+    parser.add_argument('--resume', action='store_true', help='skip the stages the journal has on record for each model from the last (interrupted) run')
+    parser.add_argument('--artifact-cache', help='artifact hash index path.  Defaults to <deployment-conf>.artifacts.json', default=None)
+    parser.add_argument('--no-artifact-cache', action='store_true', help='always create a new custom model version from the whole artifact folder')
+    parser.add_argument('--dataset-retention', type=int, help='keep at most this many versions of the training dataset, older ones are deleted before a new version is registered', default=None)
+    parser.add_argument('--no-validate', action='store_true', help='skip scoring the artifact folders locally before creating new versions')
+    parser.add_argument('--validation-workers', type=int, help='processes used to score artifact folders locally', default=None)
+    parser.add_argument('--custom-model-test', action='store_true', help='run a CustomModelTest for every new custom model version, on a small stratified sample of the training data')
+    parser.add_argument('--plan', action='store_true', help='dry run: print what would be created / updated for each model and exit')
+    parser.add_argument('--trace', help='stage timing report (json, with an html waterfall next to it).  Defaults to <deployment-conf>.trace.json', default=None)
 
     return parser.parse_args()
 
@@ -362,6 +392,12 @@ async def main():
     deployment_confs_path = args.deployment_conf
     training_dataset_path = args.training_dataset_path 
     training_dataset_id = args.training_dataset_id
+    poller.set_deadline(args.poll_deadline)
+    limiter.configure(args.api_rate, args.api_burst)
+    tracer.reset()
+    global artifact_index
+    if not args.no_artifact_cache:
+        artifact_index = ArtifactIndex(args.artifact_cache or f"{deployment_confs_path}.artifacts.json")
 
     with open(deployment_confs_path, "r") as f:
         master_conf = yaml.load(f, Loader = yaml.SafeLoader)
@@ -372,21 +408,107 @@ async def main():
         model_confs = master_conf
     
     model_confs = [ validate_model_conf(conf) for conf in model_confs]
+    check_unique_names(model_confs)
+    journal = StageJournal(args.journal or f"{deployment_confs_path}.journal.jsonl")
+    journal.start_run(resume=args.resume, dry_run=args.plan)
+    for conf in model_confs:
+        journal.restore(conf)
     
-    # model_confs = await asyncio.gather( *[drum_test(conf) for conf in model_confs])
-    training_dataset = register_dataset(training_dataset_id, training_dataset_path)
+    ## plan: diff the confs and local artifacts against what datarobot has, then only run what differs
+    dataset_is_new, dataset_hash = dataset_changed(model_confs, training_dataset_id, training_dataset_path)
+    ## a resumed run may have registered the new version already, the models not yet moved on to it
+    ## (their recorded version differs from the journalled one) still have a changed dataset
+    dataset_registered = journal.run_value("training_dataset_id") is not None
+    dataset_changed_for = {
+        conf["name"]: dataset_is_new and (not dataset_registered or conf.get("training_dataset_version") != journal.run_value("training_dataset_version"))
+        for conf in model_confs
+    }
+    for conf in model_confs:
+        if artifact_index is not None:
+            artifact_index.fingerprint(conf)
+            if not dataset_changed_for[conf["name"]]:
+                artifact_index.apply(conf)
+    with tracer.span(RUN, "plan"):
+        server_state = await fetch_server_state(model_confs)
+    plan = {conf["name"]: plan_custom_model(conf, server_state[conf["name"]], dataset_changed_for[conf["name"]]) for conf in model_confs}
+    if dataset_is_new and not dataset_registered:
+        logger.info("training dataset will be registered")
+    logger.info(format_plan(plan.values(), CUSTOM_MODEL_STAGES))
+    if args.plan:
+        return
+
+    ## catch broken artifacts locally before anything is created in datarobot
+    to_validate = [conf for conf in model_confs if "create_version" in plan[conf["name"]].stages]
+    if to_validate and not args.no_validate:
+        kwargs = {"max_workers": args.validation_workers} if args.validation_workers else {}
+        with tracer.span(RUN, "validate"):
+            invalid = await validate_artifacts(to_validate, drum_test, index=artifact_index, **kwargs)
+        if invalid:
+            raise Exception(f"local validation failed for {invalid}, nothing was created.  See the log above, or rerun with --no-validate")
+
+    if journal.run_value("training_dataset_id") is None:
+        if dataset_is_new:
+            ## versions the deployed models were trained on are never pruned
+            in_use = {conf.get("training_dataset_version") for conf in model_confs}
+            with tracer.span(RUN, "register_dataset"):
+                training_dataset = register_dataset(training_dataset_id, training_dataset_path, keep_versions=args.dataset_retention, protect=in_use,
+                                                    index_path=dataset_index_path(deployment_confs_path))
+            journal.record_run_value("training_dataset_id", training_dataset.id)
+            journal.record_run_value("training_dataset_version", training_dataset.version_id)
+        else:
+            logger.info("training dataset unchanged, reusing it")
+            journal.record_run_value("training_dataset_id", model_confs[0]["training_dataset_id"])
+            journal.record_run_value("training_dataset_version", model_confs[0].get("training_dataset_version"))
     for conf in model_confs:
-        conf["training_dataset_id"] = training_dataset.id
-        conf["training_dataset_version"] = training_dataset.version_id
-    model_confs = await asyncio.gather( *[create_custom_model_version(conf) for conf in model_confs])
-    model_confs = await asyncio.gather( *[build_custom_model_environment(conf) for conf in model_confs])
-    model_confs = await asyncio.gather( *[wait_for_custom_model_environment(conf, build_info) for conf, build_info in model_confs])
-    model_confs = await asyncio.gather( *[register_custom_model(conf) for conf in model_confs])    
-    write_model_confs(model_confs, "./post_registration_conf.yaml")
-    await asyncio.gather( *[wait_for_model_package_build(conf) for conf in model_confs])  
-    write_model_confs(model_confs, "./post_package_build_conf.yaml")
-    model_confs = await asyncio.gather( *[create_deployment(conf) for conf in model_confs])   
-    logger.info("success!!")  
+        conf["training_dataset_id"] = journal.run_value("training_dataset_id")
+        conf["training_dataset_version"] = journal.run_value("training_dataset_version")
+        if dataset_hash is not None:
+            conf["training_dataset_hash"] = dataset_hash
+    ## one small sample, registered once (and reused while the training data is unchanged), for all the tests.
+    ## a new sample is a new version of the previous one, recorded on the confs
+    sample_dataset_id = None
+    if args.custom_model_test and any("test" in plan[conf["name"]].stages and not conf.get("test_dataset_id") for conf in model_confs):
+        sample_dataset_id = journal.run_value("test_sample_dataset_id")
+        if sample_dataset_id is None:
+            with tracer.span(RUN, "register_test_sample"):
+                sample_dataset_id = register_test_sample(model_confs[0]["training_dataset_id"], training_dataset_path,
+                                                         index_path=dataset_index_path(deployment_confs_path),
+                                                         sample_dataset_id=model_confs[0].get("test_sample_dataset_id"))
+            journal.record_run_value("test_sample_dataset_id", sample_dataset_id)
+        for conf in model_confs:
+            conf["test_sample_dataset_id"] = sample_dataset_id
+    ## each model moves to its next stage as soon as it is done with the current one
+    stages = [
+        Stage("create_version", create_custom_model_version),
+        Stage("build_environment", build_custom_model_environment),
+        Stage("wait_for_environment", wait_for_custom_model_environment),
+        Stage("test", partial(test_custom_model, sample_dataset_id=sample_dataset_id)),
+        Stage("register", register_custom_model),
+        Stage("wait_for_package_build", wait_for_model_package_build),
+        Stage("deploy", create_deployment),
+        Stage("settings", update_deployment_settings),
+    ]
+    ## the journal replaces the post_registration / post_package_build snapshots, every finished
+    ## stage is recorded with the conf as it was right after
+    def on_stage_done(stage_name, conf):
+        journal.record_stage(conf["name"], stage_name, conf)
+        if artifact_index is not None:
+            artifact_index.update(stage_name, conf)
+    def skip(conf, stage_name):
+        if stage_name == "test" and not args.custom_model_test:
+            return True
+        if args.resume and stage_name in journal.completed_stages(conf["name"]):
+            return True
+        return stage_name not in plan[conf["name"]].stages
+    failed = None
+    try:
+        await run_pipeline(model_confs, stages, max_concurrency=args.max_concurrency, 
+                           stage_limits=parse_stage_limits(args.stage_limit), on_stage_done=on_stage_done,
+                           skip=skip)
+        logger.info("success!!")  
+    except PipelineError as e:
+        logger.error(e)
+        failed = e
 
     if isinstance(master_conf, list):
         final_out = {"deployments": model_confs}
@@ -395,6 +517,11 @@ async def main():
         final_out["deployments"] = model_confs
 
     write_model_confs(final_out, deployment_confs_path)
+    ## where the time went: per model waterfall and the critical path of the run
+    logger.info(tracer.summary(tracer.write(args.trace or f"{deployment_confs_path}.trace.json")))
+    logger.info(f"entity cache: {entity_cache.stats()}")
+    if failed:
+        raise failed
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
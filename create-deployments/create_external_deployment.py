@@ -13,8 +13,18 @@ import datetime
 from requests_futures.sessions import FuturesSession
 import asyncio
 import os
+from functools import partial
+from pipeline import Stage, PipelineError, run_pipeline, parse_stage_limits
+from api_client import get_client
+from rate_limit import limiter, call_with_retry
+from journal import StageJournal, check_unique_names, write_yaml_atomic
+from datasets import register_training_dataset, dataset_index_path
+from settings import reconcile_deployment_settings
+from planner import EXTERNAL_STAGES, EXTERNAL_SPEC_KEYS, spec_hash, dataset_changed, fetch_server_state, plan_external, format_plan
+from tracing import RUN, tracer
+from entity_cache import entity_cache, get_deployment
 
-client = dr.Client() 
+client = get_client() 
 
 logging.basicConfig(
     level=logging.INFO,
@@ -23,7 +33,6 @@ logging.basicConfig(
 )
 
 logger = logging.getLogger(__name__)
-client = dr.Client() 
 
 features_to_track = ["age", "bmi", "region"]
 
@@ -34,6 +43,15 @@ def parse_args():
     parser.add_argument('--deployment-conf', help='existing path or where to write deployment configuration yaml.')
     parser.add_argument('--training-dataset-id', help='prediction dataset id for dataset registered to datarobot', default = None)
     parser.add_argument('--training-dataset-path', help='training dataset csv (includes target and feature).  Cannot be used with training-dataset-id', default=None)
+    parser.add_argument('--api-rate', type=float, help='max DataRobot api requests per second, shared by all models', default=limiter.rate)
+    parser.add_argument('--api-burst', type=int, help='max burst of DataRobot api requests above --api-rate', default=int(limiter.burst))
+    parser.add_argument('--max-concurrency', type=int, help='max stage calls running at once across all models', default=None)
+    parser.add_argument('--stage-limit', action='append', help='per stage concurrency limit as <stage>=<int>, e.g. --stage-limit register=4.  Can be repeated', default=[])
+    parser.add_argument('--journal', help='stage journal path.  Defaults to <deployment-conf>.journal.jsonl', default=None)
+    parser.add_argument('--resume', action='store_true', help='skip the stages the journal has on record for each model from the last (interrupted) run')
+    parser.add_argument('--dataset-retention', type=int, help='keep at most this many versions of the training dataset, older ones are deleted before a new version is registered', default=None)
+    parser.add_argument('--plan', action='store_true', help='dry run: print what would be created / updated for each model and exit')
+    parser.add_argument('--trace', help='stage timing report (json, with an html waterfall next to it).  Defaults to <deployment-conf>.trace.json', default=None)
     return parser.parse_args()
 
 def validate_model_conf(model_conf):
@@ -55,27 +73,7 @@ def validate_model_conf(model_conf):
         raise Exception(f"invalid model config.  missign one of the followign keys {required_keys}")
     return model_conf
 
-def purge_old_dataset_version(dataset_id, limit=100):
-    limit = limit - 1
-    dataset_url = f"datasets/{dataset_id}/versions?limit={limit}"
-    def helper(dataset_url): 
-        dataset_versions = client.get(dataset_url).json()
-        if "offset" in dataset_url:
-            print("off set present, deleting old versions")
-            for d in dataset_versions["data"]:
-                print(f"datasets/{d['datasetId']}/versions/{d['versionId']}/")
-                delete_req = client.delete(f"datasets/{d['datasetId']}/versions/{d['versionId']}/")
-                print(delete_req)
-        if next := dataset_versions.get("next"):
-            print(next)
-            print(dataset_url)
-            query_parameters = next.split("/")[-1]
-            next_url = os.path.join( dataset_url.split("?")[0], query_parameters)
-            print(next_url)
-            helper(next_url)
-    helper(dataset_url)
-
-def register_dataset(conf, training_dataset_id, training_dataset_path):
+def register_dataset(conf, training_dataset_id, training_dataset_path, training_dataset_hash=None, keep_versions=None, index_path=None):
     if training_dataset_id is not None and training_dataset_path is not None:
         logger.info("when providing both training dataset id and training dataset path in config, it is assumed a new version should be registered.")
     elif training_dataset_id is None and training_dataset_path is None: 
@@ -85,7 +83,7 @@ def register_dataset(conf, training_dataset_id, training_dataset_path):
     if training_dataset_id is None and training_dataset_path is not None:
         training_dataset_path = Path(training_dataset_path)
         logger.info("register training dataset")
-        training_dataset = dr.Dataset.create_from_file(str(training_dataset_path))    
+        training_dataset = register_training_dataset(None, training_dataset_path, index_path=index_path)
         logger.info("recording training dataset id to deployment config")
         conf["training_dataset_id"] = training_dataset.id   
     elif training_dataset_id is not None and training_dataset_path is None:
@@ -93,63 +91,58 @@ def register_dataset(conf, training_dataset_id, training_dataset_path):
         conf["training_dataset_id"] = training_dataset_id
     elif training_dataset_id is not None and training_dataset_path is not None:
         logger.info("training dataset id and trainign data path are present, registering new version")
-        # purge_old_dataset_version(training_dataset_id)
-        training_dataset = dr.Dataset.create_version_from_file(training_dataset_id, str(training_dataset_path))
+        training_dataset = register_training_dataset(training_dataset_id, training_dataset_path, keep_versions=keep_versions, index_path=index_path)
         conf["training_dataset_id"] = training_dataset.id
     else:
         raise Exception("expection occured since neither training dataset nor training dataset id were provided.")
+    if training_dataset_hash is not None:
+        conf["training_dataset_hash"] = training_dataset_hash
     return conf
 
 def create_external_model_version(conf):
-    while True: 
-        try:
-            registered_model_id = conf.get("registered_model_id")
-            name = conf.get("name")
-            training_dataset_id = conf.get("training_dataset_id")
-            target_name=conf.get("target_name")
-            target_type= conf.get("target_type")
-            description = conf.get("description")
-            if registered_model_id:
-                registered_model_name = None
-                logger.info(f"{name}: registered model with id {registered_model_id} exists.  Adding a new version")
-            else:
-                logger.info(f"{name}: registered model does not exist.  creating new entry")
-                ts = datetime.datetime.now()
-                registered_model_name = f"external {name} {ts}"
-            if conf.get("positive_class_label"):
-                class_names = [conf.get("positive_class_label"), conf.get("negative_class_label")]
-            elif conf.get("class_names"):
-                class_names = conf.get("class_names")
-            else:
-                class_names = None
-            ext_reg_model = dr.RegisteredModelVersion.create_for_external(
-                name = name, 
-                registered_model_id = registered_model_id,
-                target = {"type": target_type, "name": target_name, "predictionThreshold": conf.get("prediction_threshold"), "classNames": class_names},
-                datasets = {"trainingDataCatalogId": training_dataset_id}, 
-                registered_model_name = registered_model_name,
-                registered_model_description=description
-            )
-            conf["registered_model_id"] = ext_reg_model.registered_model_id 
-            conf["registered_model_version_id"] = ext_reg_model.id 
-            return conf
-        except Exception as e:
-            logger.info(e)
-            try:
-                message = e.json["message"]
-                wait_for = int(message.split(" ")[-2])
-            except Exception:
-                logger.error("Unexpected error format. Aborting retry.")
-                raise
-            logger.info(f"Waiting for {wait_for} seconds before retrying to register external model.")
-            time.sleep(wait_for)
+    registered_model_id = conf.get("registered_model_id")
+    name = conf.get("name")
+    training_dataset_id = conf.get("training_dataset_id")
+    target_name=conf.get("target_name")
+    target_type= conf.get("target_type")
+    description = conf.get("description")
+    if registered_model_id:
+        registered_model_name = None
+        logger.info(f"{name}: registered model with id {registered_model_id} exists.  Adding a new version")
+    else:
+        logger.info(f"{name}: registered model does not exist.  creating new entry")
+        ts = datetime.datetime.now()
+        registered_model_name = f"external {name} {ts}"
+    if conf.get("positive_class_label"):
+        class_names = [conf.get("positive_class_label"), conf.get("negative_class_label")]
+    elif conf.get("class_names"):
+        class_names = conf.get("class_names")
+    else:
+        class_names = None
+    ## throttling is retried based on the status code / Retry-After, see rate_limit.py.  a create,
+    ## so a 502 / 504 is not sent again.  name is passed positionally, call_with_retry's own name= is the one used in its log lines
+    ext_reg_model = call_with_retry(
+        dr.RegisteredModelVersion.create_for_external,
+        name, 
+        registered_model_id = registered_model_id,
+        target = {"type": target_type, "name": target_name, "predictionThreshold": conf.get("prediction_threshold"), "classNames": class_names},
+        datasets = {"trainingDataCatalogId": training_dataset_id}, 
+        registered_model_name = registered_model_name,
+        registered_model_description=description,
+        name = f"{name}: register external model",
+        idempotent = False
+    )
+    conf["registered_model_id"] = ext_reg_model.registered_model_id 
+    conf["registered_model_version_id"] = ext_reg_model.id 
+    ## lets the planner tell whether the next run needs a new version
+    conf["registered_spec_hash"] = spec_hash(conf, EXTERNAL_SPEC_KEYS)
+    return conf
 
 def create_external_deployment(conf):
     name = conf["name"]
     description = conf.get("description")
     prediction_environment_id = conf.get("prediction_environment_id")
     if deployment_id := conf.get("deployment_id"):
-        deployment = dr.Deployment.get(deployment_id)
         name = conf.get("name")
         logger.info(f"updated deployment {name} with new version")
         logger.info(f"{name}: refreshing deployment")
@@ -163,7 +156,7 @@ def create_external_deployment(conf):
             logger.info("deployment refresh successful")
         else:
             logger.error(f"something went wrong.  replacement response returned status code {replacement_response.status_code}")
-        deployment = dr.Deployment.get(deployment_id)
+        deployment = get_deployment(deployment_id, fresh=True)
     else:
         logger.info(f"{name}: deployment does not exists")
         logger.info(f"{name}: creating deployment")
@@ -173,36 +166,17 @@ def create_external_deployment(conf):
             description=description,
             prediction_environment_id=prediction_environment_id
         )
+        entity_cache.put("deployment", deployment.id, deployment)
     conf["deployment_id"] = deployment.id
     conf["url"] = f"https://app.datarobot.com/console-nextgen/deployments/{deployment.id}"
     return conf 
 
 async def update_deployment_settings(conf, target_drift = True, feature_drift = True):
-    features_to_track = conf.get("features_to_track", [])
-    logger.info(f"features to track: {features_to_track}")
-    if len(features_to_track) == 0:
-        feature_selection = "auto"
-    else:
-        feature_selection = "manual"
-    logger.info(f"feature selection for drift is {feature_selection}")
+    logger.info(f"{conf.get('name')}: features to track: {conf.get('features_to_track', [])}")
     def _create():
-        deployment_id = conf.get("deployment_id")
-        client = dr.Client()
-        deployment = dr.Deployment.get(deployment_id)
-        # # Enabling Accuracy
-        logger.info("updating association id for accuracy tracking")
-        deployment.update_association_id_settings(column_names=["ASSOCIATION_ID"], required_in_prediction_requests=False)
-        # # Enabling Challenger
-        logger.info("updating prediction data collection settings")
-        deployment.update_predictions_data_collection_settings(enabled=True) 
-        payload = {"targetDrift":{"enabled":target_drift},
-                                         "featureDrift":{"enabled":feature_drift,"featureSelection":feature_selection,"trackedFeatures":features_to_track}}
-        logger.info(f"feature drift settings payload: {payload}")
-        dep_patch = client.patch(f"deployments/{deployment_id}/settings/", 
-                                 data = payload)
-        logger.info(f'{conf["name"]}: updated accuracy settings and drift settings on deployment monitorin')
-        logger.info(dep_patch.status_code)
-        logger.info("update complete")
+        ## only the settings that differ from the conf are patched, see settings.py
+        conf["settings_patched"] = sorted(reconcile_deployment_settings(conf, target_drift=target_drift, feature_drift=feature_drift))
+        return conf
     return await asyncio.to_thread(_create)
 
 async def main():
@@ -211,6 +185,8 @@ async def main():
     training_dataset_path = args.training_dataset_path 
     training_dataset_id = args.training_dataset_id
     logger.info(args)
+    limiter.configure(args.api_rate, args.api_burst)
+    tracer.reset()
 
     if deployment_conf_path is not None:
         if Path(deployment_conf_path).exists():
@@ -231,10 +207,39 @@ async def main():
 
        
     deployment_conf = [ validate_model_conf(conf) for conf in deployment_confs]                  
-    deployment_conf = [ register_dataset(conf, training_dataset_id, training_dataset_path) for conf in deployment_confs]
-    deployment_conf = [ create_external_model_version(conf) for conf in deployment_confs]
-    deployment_conf = [ create_external_deployment(conf) for conf in deployment_confs]
-    await asyncio.gather( *[update_deployment_settings(conf, True, True) for conf in deployment_confs])
+    check_unique_names(deployment_conf)
+    journal = StageJournal(args.journal or f"{deployment_conf_path}.journal.jsonl")
+    journal.start_run(resume=args.resume, dry_run=args.plan)
+    for conf in deployment_conf:
+        journal.restore(conf)
+    ## plan: diff the confs against what datarobot has, then only run what differs
+    dataset_is_new, dataset_hash = dataset_changed(deployment_conf, training_dataset_id, training_dataset_path)
+    with tracer.span(RUN, "plan"):
+        server_state = await fetch_server_state(deployment_conf)
+    plan = {conf["name"]: plan_external(conf, server_state[conf["name"]], dataset_is_new) for conf in deployment_conf}
+    logger.info(format_plan(plan.values(), EXTERNAL_STAGES))
+    if args.plan:
+        return
+    def skip(conf, stage_name):
+        if args.resume and stage_name in journal.completed_stages(conf["name"]):
+            return True
+        return stage_name not in plan[conf["name"]].stages
+    ## each model moves to its next stage as soon as it is done with the current one
+    stages = [
+        Stage("register_dataset", partial(register_dataset, training_dataset_id=training_dataset_id, training_dataset_path=training_dataset_path, training_dataset_hash=dataset_hash, keep_versions=args.dataset_retention,
+                                               index_path=dataset_index_path(deployment_conf_path))),
+        Stage("register", create_external_model_version),
+        Stage("deploy", create_external_deployment),
+        Stage("settings", partial(update_deployment_settings, target_drift=True, feature_drift=True)),
+    ]
+    failed = None
+    try:
+        await run_pipeline(deployment_conf, stages, max_concurrency=args.max_concurrency, stage_limits=parse_stage_limits(args.stage_limit),
+                           on_stage_done=lambda stage_name, conf: journal.record_stage(conf["name"], stage_name, conf),
+                           skip=skip)
+    except PipelineError as e:
+        logger.error(e)
+        failed = e
 
     if isinstance(master_conf, list):
         final_out = {"deployments": deployment_conf}
@@ -243,8 +248,12 @@ async def main():
         final_out["deployments"] = deployment_conf
 
     logger.info(f"updated deployment conf at {deployment_conf_path}")
-    with open(str(deployment_conf_path), "w") as f:
-        f.write(yaml.dump(final_out))
+    write_yaml_atomic(final_out, deployment_conf_path)
+    ## where the time went: per model waterfall and the critical path of the run
+    logger.info(tracer.summary(tracer.write(args.trace or f"{deployment_conf_path}.trace.json")))
+    logger.info(f"entity cache: {entity_cache.stats()}")
+    if failed:
+        raise failed
     logger.info("deployments have been updated!!")
 
 if __name__ == "__main__":
@@ -0,0 +1,145 @@
+import os
+import json
+import logging
+import tempfile
+import threading
+from pathlib import Path
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import datarobot as dr
+
+from api_client import get_client
+from artifact_cache import hash_file
+from rate_limit import call_with_retry
+
+logger = logging.getLogger(__name__)
+
+## parquet is a fraction of the csv size and keeps the column types, csv.gz is the fallback
+## when neither pyarrow nor fastparquet is installed
+UPLOAD_FORMAT = os.environ.get("DATAROBOT_DATASET_FORMAT", "parquet")
+
+RegisteredDataset = namedtuple("RegisteredDataset", ["id", "version_id", "reused"])
+
+_lock = threading.Lock()
+
+
+def dataset_index_path(deployment_conf_path):
+    """the dataset index next to the deployment conf, like its journal and artifact index, unless DATAROBOT_DATASET_INDEX is set"""
+    return os.environ.get("DATAROBOT_DATASET_INDEX") or f"{deployment_conf_path}.datasets.json"
+
+
+class DatasetIndex(object):
+    """sha256 of local dataset files -> the dataset versions they were uploaded as.  path None keeps it in memory"""
+
+    def __init__(self, path=None):
+        self.path = Path(path) if path is not None else None
+        self.data = {}
+        if self.path is not None and self.path.exists():
+            with open(self.path, "r") as f:
+                self.data = json.load(f)
+
+    def lookup(self, digest, dataset_id=None):
+        for entry in reversed(self.data.get(digest, [])):
+            if dataset_id is None or entry["dataset_id"] == dataset_id:
+                return entry
+        return None
+
+    def record(self, digest, dataset_id, version_id):
+        self.data.setdefault(digest, []).append({"dataset_id": dataset_id, "version_id": version_id})
+        if self.path is None:
+            return
+        tmp_path = self.path.with_name(f".{self.path.name}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.data, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+def version_exists(dataset_id, version_id):
+    try:
+        get_client().get(f"datasets/{dataset_id}/versions/{version_id}/")
+    except dr.errors.ClientError as e:
+        if e.status_code == 404:
+            return False
+        raise
+    return True
+
+
+def compress_for_upload(path, workdir, upload_format=UPLOAD_FORMAT):
+    """write the csv at path to workdir as parquet (or gzipped csv), returns the file to upload"""
+    path = Path(path)
+    if upload_format == "csv":
+        return path
+    df = pd.read_csv(path)
+    if upload_format == "parquet":
+        try:
+            output = Path(workdir) / f"{path.stem}.parquet"
+            df.to_parquet(output, index=False)
+            return output
+        except ImportError:
+            logger.warning("no parquet engine installed (pyarrow / fastparquet), uploading gzipped csv instead")
+    output = Path(workdir) / f"{path.stem}.csv.gz"
+    df.to_csv(output, index=False, compression="gzip")
+    return output
+
+
+def list_dataset_versions(dataset_id, page_size=100):
+    versions = []
+    url = f"datasets/{dataset_id}/versions/?limit={page_size}&offset=0"
+    while url:
+        page = get_client().get(url).json()
+        versions.extend(page["data"])
+        ## next is an absolute url, keep just the paging parameters
+        url = f"datasets/{dataset_id}/versions/?{page['next'].split('?', 1)[1]}" if page.get("next") else None
+    return versions
+
+
+def prune_dataset_versions(dataset_id, keep=100, protect=(), max_parallel=8):
+    """
+    delete all but the newest `keep` versions of a dataset (datarobot has a soft limit of 100
+    versions per dataset).  versions in protect, e.g. ones still used as training data, are kept.
+    deletes run concurrently.
+    """
+    versions = sorted(list_dataset_versions(dataset_id), key=lambda v: v["creationDate"], reverse=True)
+    to_delete = [v["versionId"] for v in versions[keep:] if v["versionId"] not in protect and not v.get("isLatestVersion")]
+    logger.info(f"dataset {dataset_id}: {len(versions)} versions, deleting {len(to_delete)} (keeping the newest {keep})")
+    if not to_delete:
+        return []
+    def _delete(version_id):
+        response = get_client().delete(f"datasets/{dataset_id}/versions/{version_id}/")
+        logger.debug(f"deleted datasets/{dataset_id}/versions/{version_id}/: {response.status_code}")
+        return version_id
+    with ThreadPoolExecutor(max_workers=max_parallel, thread_name_prefix="prune") as pool:
+        return list(pool.map(_delete, to_delete))
+
+
+def register_training_dataset(training_dataset_id, training_dataset_path, keep_versions=None, protect=(), index_path=None):
+    """
+    register training_dataset_path (as a new version of training_dataset_id if given), unless a
+    file with the same sha256 was registered before (per the index at index_path, see
+    dataset_index_path) and that version still exists, in which case it is reused and nothing is
+    uploaded.  with keep_versions set, old versions are pruned first.
+    """
+    ## serialized so concurrent callers with the same file upload it once and reuse it after
+    with _lock:
+        index = DatasetIndex(index_path)
+        digest = hash_file(training_dataset_path)
+        entry = index.lookup(digest, training_dataset_id)
+        if entry is not None and version_exists(entry["dataset_id"], entry["version_id"]):
+            logger.info(f"{training_dataset_path} unchanged, reusing dataset {entry['dataset_id']} version {entry['version_id']}")
+            return RegisteredDataset(entry["dataset_id"], entry["version_id"], True)
+        if training_dataset_id is not None and keep_versions:
+            ## make room for the new version
+            prune_dataset_versions(training_dataset_id, keep=keep_versions - 1, protect=protect)
+        with tempfile.TemporaryDirectory() as workdir:
+            upload_path = compress_for_upload(training_dataset_path, workdir)
+            logger.info(f"uploading {upload_path.name} ({upload_path.stat().st_size / 2**20:.1f} MiB, csv was {Path(training_dataset_path).stat().st_size / 2**20:.1f} MiB)")
+            ## the upload is streamed, so a throttled upload is retried here rather than by the adapter.
+            ## only on 429 / 503, an upload behind a gateway error may have made the dataset already
+            if training_dataset_id is None:
+                dataset = call_with_retry(dr.Dataset.create_from_file, str(upload_path), name="dataset upload", idempotent=False)
+            else:
+                dataset = call_with_retry(dr.Dataset.create_version_from_file, training_dataset_id, str(upload_path), name="dataset upload", idempotent=False)
+        index.record(digest, dataset.id, dataset.version_id)
+        return RegisteredDataset(dataset.id, dataset.version_id, False)
@@ -0,0 +1,147 @@
+import os
+import time
+import logging
+import threading
+
+import datarobot as dr
+
+from api_client import get_client
+from tracing import record
+
+logger = logging.getLogger(__name__)
+
+## seconds an entity is served from the cache.  DATAROBOT_ENTITY_CACHE_TTL overrides all of them, 0 turns the cache off
+DEFAULT_TTLS = {
+    "deployment": 60,
+    "settings": 60,
+    "registered_model_version": 30,
+    "custom_model": 60,
+    "custom_model_version": 60,
+}
+## most pages of deployments/ read to find the deployments of a rollout before falling back to one GET each
+MAX_LIST_PAGES = 5
+
+
+class EntityCache(object):
+    """
+    read-through cache for DataRobot entity metadata, shared by every worker thread in a run.
+
+    entries expire after a per kind ttl, and the code that changes an entity invalidates (or
+    replaces) its entry straight after the write.  concurrent lookups of the same missing entry
+    load it once.  polling loops that wait on a status pass fresh=True and put the final state back.
+    """
+
+    def __init__(self, ttls=None):
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        if (override := os.environ.get("DATAROBOT_ENTITY_CACHE_TTL")) is not None:
+            self.ttls = {kind: float(override) for kind in self.ttls}
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.loading = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, kind, key, loader, fresh=False):
+        """the cached value of (kind, key), or loader() when missing, expired or fresh=True"""
+        ttl = self.ttls.get(kind, 0)
+        if not fresh and ttl > 0:
+            with self.lock:
+                entry = self.entries.get((kind, key))
+                if entry is not None and entry[0] > time.monotonic():
+                    self.hits += 1
+                    record("cache_hits")
+                    return entry[1]
+                load_lock = self.loading.setdefault((kind, key), threading.Lock())
+            with load_lock:
+                ## another thread may have loaded it while this one waited
+                with self.lock:
+                    entry = self.entries.get((kind, key))
+                    if entry is not None and entry[0] > time.monotonic():
+                        self.hits += 1
+                        record("cache_hits")
+                        return entry[1]
+                return self._load(kind, key, loader)
+        return self._load(kind, key, loader)
+
+    def _load(self, kind, key, loader):
+        with self.lock:
+            self.misses += 1
+        value = loader()
+        self.put(kind, key, value)
+        return value
+
+    def put(self, kind, key, value):
+        ttl = self.ttls.get(kind, 0)
+        if ttl > 0 and value is not None:
+            with self.lock:
+                self.entries[(kind, key)] = (time.monotonic() + ttl, value)
+
+    def invalidate(self, kind, key=None):
+        """drop (kind, key), or every entry of kind"""
+        with self.lock:
+            for entry_key in [k for k in self.entries if k[0] == kind and (key is None or k[1] == key)]:
+                del self.entries[entry_key]
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries)}
+
+
+## shared by the deployment scripts, like poller, limiter and tracer
+entity_cache = EntityCache()
+
+
+def get_deployment(deployment_id, fresh=False):
+    return entity_cache.get("deployment", deployment_id, lambda: dr.Deployment.get(deployment_id), fresh)
+
+
+def get_settings(deployment_id, fresh=False):
+    return entity_cache.get("settings", deployment_id, lambda: get_client().get(f"deployments/{deployment_id}/settings/").json(), fresh)
+
+
+def get_registered_model_version(registered_model_id, version_id, fresh=False):
+    ## straight from the version's url, without fetching the registered model first
+    def _load():
+        return dr.RegisteredModelVersion.from_location(f"registeredModels/{registered_model_id}/versions/{version_id}/")
+    return entity_cache.get("registered_model_version", version_id, _load, fresh)
+
+
+def get_custom_model(custom_model_id, fresh=False):
+    return entity_cache.get("custom_model", custom_model_id, lambda: dr.CustomInferenceModel.get(custom_model_id), fresh)
+
+
+def get_custom_model_version(custom_model_id, version_id, fresh=False):
+    return entity_cache.get("custom_model_version", version_id, lambda: dr.CustomModelVersion.get(custom_model_id, version_id), fresh)
+
+
+def prime_deployments(deployment_ids, labels=None, max_pages=MAX_LIST_PAGES, page_size=100):
+    """
+    load many deployments with a few calls to the deployments/ list instead of one GET each.
+    labels (e.g. the conf names the deployments were created with) narrow the list server side
+    to the deployments matching their common prefix.  stops as soon as every id has been seen, or
+    at the first page without any of them, ids not found are left to get_deployment.  returns the
+    ids that were found.
+    """
+    wanted = {d for d in deployment_ids if d}
+    if len(wanted) < 2 or entity_cache.ttls.get("deployment", 0) <= 0:
+        return set()
+    params = {"limit": page_size}
+    ## too short a prefix would match most of the account anyway
+    if len(search := os.path.commonprefix([label for label in labels or [] if label]).strip()) >= 3:
+        params["search"] = search
+    found = set()
+    client = get_client()
+    for page in range(max_pages):
+        data = client.get("deployments/", params=dict(params, offset=page * page_size)).json()
+        matched = [item for item in data.get("data", []) if item.get("id") in wanted]
+        for item in matched:
+            entity_cache.put("deployment", item["id"], dr.Deployment.from_server_data(item))
+            found.add(item["id"])
+        if found == wanted or not matched or not data.get("next"):
+            break
+    logger.debug(f"{len(found)} of {len(wanted)} deployments loaded from the deployments list")
+    return found
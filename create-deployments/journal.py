@@ -0,0 +1,101 @@
+import os
+import json
+import logging
+import threading
+from datetime import datetime
+from pathlib import Path
+
+import yaml
+
+logger = logging.getLogger(__name__)
+
+
+class StageJournal(object):
+    """
+    append-only record of which stages each conf has finished in a rollout, and the conf as it
+    was right after (ids of the new custom model version, registered model version, ...).
+
+    every record is a single json line written with one O_APPEND write and fsync'd, so an
+    interrupted run leaves at worst one torn last line, which is ignored on load.  a run starts
+    with a run_start record; --resume picks up the records after the last one and skips the
+    stages they cover instead of starting the rollout from scratch.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        self.records = []
+
+    def _append(self, record):
+        record["ts"] = datetime.now().isoformat()
+        line = (json.dumps(record, default=str) + "\n").encode("utf-8")
+        with self.lock:
+            fd = os.open(str(self.path), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        self.records.append(record)
+
+    def _load_last_run(self):
+        if not self.path.exists():
+            return []
+        records = []
+        with open(self.path, "r") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    logger.warning(f"ignoring incomplete journal line in {self.path}")
+        starts = [i for i, r in enumerate(records) if r.get("event") == "run_start"]
+        return records[starts[-1] + 1:] if starts else records
+
+    def start_run(self, resume=False, dry_run=False):
+        """dry_run (--plan) reads the journal like a real run would, but never writes to it"""
+        if resume:
+            self.records = self._load_last_run()
+            logger.info(f"resuming from {self.path}: {len(self.records)} completed stage(s) on record")
+        else:
+            self.records = []
+            if not dry_run:
+                self._append({"event": "run_start"})
+
+    def record_stage(self, name, stage, conf):
+        self._append({"event": "stage_done", "name": name, "stage": stage, "conf": conf})
+
+    def record_run_value(self, key, value):
+        """values shared by every conf in the run, e.g. the training dataset registered up front"""
+        self._append({"event": "run_value", "key": key, "value": value})
+
+    def run_value(self, key):
+        values = [r["value"] for r in self.records if r.get("event") == "run_value" and r.get("key") == key]
+        return values[-1] if values else None
+
+    def completed_stages(self, name):
+        return {r["stage"] for r in self.records if r.get("event") == "stage_done" and r.get("name") == name}
+
+    def restore(self, conf):
+        """bring conf up to date with the last snapshot recorded for it"""
+        snapshots = [r["conf"] for r in self.records if r.get("event") == "stage_done" and r.get("name") == conf.get("name")]
+        if snapshots:
+            conf.update(snapshots[-1])
+        return conf
+
+
+def check_unique_names(confs):
+    names = [conf.get("name") for conf in confs]
+    duplicates = {name for name in names if names.count(name) > 1}
+    if duplicates:
+        raise Exception(f"conf names must be unique to journal a rollout, duplicated: {duplicates}")
+
+
+def write_yaml_atomic(data, output_path):
+    """write to a temp file next to output_path and rename it over, so a crash never leaves half a conf"""
+    output_path = Path(output_path)
+    tmp_path = output_path.with_name(f".{output_path.name}.tmp")
+    with open(tmp_path, "w") as f:
+        f.write(yaml.dump(data))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, output_path)
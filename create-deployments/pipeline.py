@@ -0,0 +1,116 @@
+import asyncio
+import logging
+import inspect
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+
+class Stage(object):
+    """
+    one step of the per model pipeline.
+
+    fn is called with the result of the previous stage (a tuple is unpacked into positional
+    args, the first stage gets the conf).  sync functions are run in a worker thread.  limit
+    caps how many confs can be in this stage at the same time, None means no cap.
+    """
+
+    def __init__(self, name, fn, limit=None):
+        self.name = name
+        self.fn = fn
+        self.limit = limit
+        self.semaphore = None
+
+    async def __call__(self, *args):
+        if inspect.iscoroutinefunction(self.fn):
+            return await self.fn(*args)
+        return await asyncio.to_thread(self.fn, *args)
+
+
+class PipelineError(Exception):
+    """Raised after a pipeline run in which one or more confs failed"""
+
+    def __init__(self, failures):
+        self.failures = failures
+        names = ", ".join(f"{conf.get('name')} ({stage})" for conf, stage, _ in failures)
+        super().__init__(f"{len(failures)} model(s) failed: {names}")
+
+
+def parse_stage_limits(values):
+    """['build=4', 'register=2'] -> {'build': 4, 'register': 2}"""
+    limits = {}
+    for value in values or []:
+        name, _, limit = value.partition("=")
+        if not limit.isdigit():
+            raise Exception(f"stage limit should look like <stage>=<int>, got {value}")
+        limits[name.strip()] = int(limit)
+    return limits
+
+
+async def run_pipeline(confs, stages, max_concurrency=None, stage_limits=None, on_stage_done=None, skip=None):
+    """
+    move every conf through the stages on its own, instead of waiting for all confs to finish
+    a stage before any of them starts the next one.  the slowest model then only delays itself.
+
+    max_concurrency caps the stage calls running at once across all confs, stage_limits
+    ({stage name: limit}) caps individual stages on top of that.  on_stage_done(stage_name, conf)
+    is called after each stage completes for a conf.  skip(conf, stage_name) returning True skips
+    the stage for that conf (e.g. already done in an interrupted run), the next stage then gets
+    the conf.  failed confs stop where they failed, the
+    rest carry on, and a PipelineError listing the failures is raised once everything is done.
+    every stage call is recorded as a span on tracing.tracer.
+    """
+    stage_limits = stage_limits or {}
+    for stage in stages:
+        limit = stage_limits.get(stage.name, stage.limit)
+        stage.semaphore = asyncio.Semaphore(limit) if limit else None
+    global_semaphore = asyncio.Semaphore(max_concurrency) if max_concurrency else None
+
+    ## most stages block a worker thread while they wait on datarobot, the default executor
+    ## (cpu count + 4 threads) would quietly serialize them
+    workers = max_concurrency or max(len(confs), 1) * 2
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pipeline"))
+
+    failures = []
+
+    async def run_one(conf):
+        result = conf
+        for stage in stages:
+            if skip is not None and skip(conf, stage.name):
+                logger.info(f"{conf.get('name')}: stage {stage.name} already done, skipping")
+                result = conf
+                continue
+            args = result if isinstance(result, tuple) else (result,)
+            start = time.monotonic()
+            try:
+                ## time spent waiting on the concurrency limits is recorded as queued
+                with tracer.span(conf.get("name"), stage.name) as span:
+                    if stage.semaphore:
+                        await stage.semaphore.acquire()
+                    if global_semaphore:
+                        await global_semaphore.acquire()
+                    span.add("queued", time.monotonic() - start)
+                    try:
+                        result = await stage(*args)
+                    finally:
+                        if global_semaphore:
+                            global_semaphore.release()
+                        if stage.semaphore:
+                            stage.semaphore.release()
+            except Exception as e:
+                logger.error(f"{conf.get('name')}: stage {stage.name} failed: {e}")
+                failures.append((conf, stage.name, e))
+                return conf
+            logger.info(f"{conf.get('name')}: stage {stage.name} done in {time.monotonic() - start:.1f}s")
+            if on_stage_done is not None:
+                on_stage_done(stage.name, conf)
+        return conf
+
+    ## stages update the conf dicts in place, so the confs are returned in their original order
+    results = await asyncio.gather(*[run_one(conf) for conf in confs])
+    if failures:
+        raise PipelineError(failures)
+    return results
@@ -0,0 +1,164 @@
+import json
+import asyncio
+import hashlib
+import logging
+
+import datarobot as dr
+
+from artifact_cache import hash_file
+from settings import desired_settings, diff_settings, fetch_settings
+from entity_cache import get_deployment, get_custom_model_version, get_registered_model_version, prime_deployments
+
+logger = logging.getLogger(__name__)
+
+CUSTOM_MODEL_STAGES = ["create_version", "build_environment", "wait_for_environment", "test", "register", "wait_for_package_build", "deploy", "settings"]
+EXTERNAL_STAGES = ["register_dataset", "register", "deploy", "settings"]
+## conf keys that end up in an external registered model version, a change in any of them needs a new version
+EXTERNAL_SPEC_KEYS = ["name", "target_type", "target_name", "positive_class_label", "negative_class_label",
+                      "class_names", "prediction_threshold", "description", "training_dataset_id"]
+
+
+class Action(object):
+    """the stages one conf needs to run to get from the current server state to the desired conf"""
+
+    def __init__(self, name, stages=None, reasons=None):
+        self.name = name
+        self.stages = stages or []
+        self.reasons = reasons or []
+
+    def add(self, stages, reason):
+        for stage in stages:
+            if stage not in self.stages:
+                self.stages.append(stage)
+        self.reasons.append(reason)
+
+
+def spec_hash(conf, keys):
+    return hashlib.sha256(json.dumps({key: conf.get(key) for key in keys}, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def dataset_changed(confs, training_dataset_id, training_dataset_path):
+    """
+    whether the training dataset needs registering again, and the file hash to record.  a file
+    whose hash matches the one recorded on every conf (with the same dataset id) is not uploaded again.
+    """
+    if training_dataset_path is None:
+        return training_dataset_id is None or any(conf.get("training_dataset_id") != training_dataset_id for conf in confs), None
+    digest = hash_file(training_dataset_path)
+    for conf in confs:
+        if conf.get("training_dataset_hash") != digest or conf.get("training_dataset_id") is None:
+            return True, digest
+        if training_dataset_id is not None and conf["training_dataset_id"] != training_dataset_id:
+            return True, digest
+    return False, digest
+
+
+def _get_or_none(fn, *args):
+    try:
+        return fn(*args)
+    except dr.errors.ClientError as e:
+        if e.status_code == 404:
+            return None
+        raise
+
+
+def fetch_state(conf):
+    """what datarobot currently has for conf: the deployed package, the version and its builds"""
+    state = {"deployed_package_id": None, "settings": None, "version_exists": None, "build_status": None,
+             "registered_version_exists": False, "package_build_status": None}
+    if deployment_id := conf.get("deployment_id"):
+        deployment = _get_or_none(get_deployment, deployment_id)
+        if deployment is not None:
+            state["deployed_package_id"] = (getattr(deployment, "model_package", None) or {}).get("id")
+            state["settings"] = fetch_settings(deployment_id)
+    cm_id, cmv_id = conf.get("custom_model_id"), conf.get("custom_model_version_id")
+    if cm_id and cmv_id:
+        state["version_exists"] = _get_or_none(get_custom_model_version, cm_id, cmv_id) is not None
+        if state["version_exists"] and conf.get("includes_requirements"):
+            if conf.get("environment_build_status") == "success":
+                ## a successful build of a version never changes, no need to ask again
+                state["build_status"] = "success"
+            else:
+                build_info = _get_or_none(dr.CustomModelVersionDependencyBuild.get_build_info, cm_id, cmv_id)
+                state["build_status"] = build_info.build_status if build_info is not None else None
+    if conf.get("registered_model_id") and conf.get("registered_model_version_id"):
+        rmv = _get_or_none(get_registered_model_version, conf["registered_model_id"], conf["registered_model_version_id"])
+        state["registered_version_exists"] = rmv is not None
+        state["package_build_status"] = rmv.build_status if rmv is not None else None
+    return state
+
+
+async def fetch_server_state(confs, max_parallel=8):
+    """fetch_state for every conf at once, at most max_parallel in flight.  {conf name: state}"""
+    ## the deployments come from a few list calls, the rest of the state from the entity cache
+    ## both scripts label a deployment with its conf name
+    await asyncio.to_thread(prime_deployments, [conf.get("deployment_id") for conf in confs], [conf.get("name") for conf in confs])
+    semaphore = asyncio.Semaphore(max_parallel)
+    async def _fetch(conf):
+        async with semaphore:
+            return await asyncio.to_thread(fetch_state, conf)
+    states = await asyncio.gather(*[_fetch(conf) for conf in confs])
+    return {conf["name"]: state for conf, state in zip(confs, states)}
+
+
+def plan_custom_model(conf, state, dataset_is_new=False):
+    """conf has been through ArtifactIndex.apply, so reused_version is set when the artifacts are unchanged"""
+    action = Action(conf["name"])
+    if conf.get("reused_version") is None:
+        action.add(CUSTOM_MODEL_STAGES, "new model" if conf.get("custom_model_id") is None else "artifacts changed")
+        return action
+    if dataset_is_new:
+        action.add(CUSTOM_MODEL_STAGES, "training dataset changed")
+        return action
+    if not state["version_exists"]:
+        action.add(CUSTOM_MODEL_STAGES, f"custom model version {conf.get('custom_model_version_id')} not found")
+        return action
+    if conf.get("includes_requirements") and state["build_status"] != "success":
+        action.add(["build_environment", "wait_for_environment", "test"], f"dependency build is {state['build_status']}")
+    if state["package_build_status"] is None:
+        action.add(["register", "wait_for_package_build"], "no registered model version for this custom model version")
+    elif state["package_build_status"] != "complete":
+        action.add(["wait_for_package_build"], f"model package build is {state['package_build_status']}")
+    if "register" in action.stages or state["deployed_package_id"] != conf.get("registered_model_version_id"):
+        action.add(["deploy"], "deployment is not serving the registered model version" if conf.get("deployment_id") else "no deployment")
+    plan_settings(action, conf, state)
+    return action
+
+
+def plan_settings(action, conf, state):
+    """settings only need reconciling after a (re)deploy or when the current ones differ from the conf"""
+    if "deploy" in action.stages:
+        action.add(["settings"], "check settings after deploy")
+    elif patch := diff_settings(state["settings"], desired_settings(conf)):
+        action.add(["settings"], f"settings differ: {', '.join(sorted(patch))}")
+
+
+def plan_external(conf, state, dataset_is_new=False):
+    action = Action(conf["name"])
+    if dataset_is_new:
+        action.add(EXTERNAL_STAGES, "training dataset changed")
+        return action
+    ## external versions have no package build, build_status can be empty on one that exists
+    if not state["registered_version_exists"]:
+        action.add(["register"], "no registered model version")
+    elif conf.get("registered_spec_hash") != spec_hash(conf, EXTERNAL_SPEC_KEYS):
+        action.add(["register"], "target / class / dataset settings changed")
+    if "register" in action.stages or state["deployed_package_id"] != conf.get("registered_model_version_id"):
+        action.add(["deploy"], "deployment is not serving the registered model version" if conf.get("deployment_id") else "no deployment")
+    plan_settings(action, conf, state)
+    return action
+
+
+def format_plan(actions, stage_order):
+    lines = []
+    for action in actions:
+        if not action.stages:
+            lines.append(f"  {action.name}: up to date")
+            continue
+        stages = [stage for stage in stage_order if stage in action.stages]
+        lines.append(f"  {action.name}: {', '.join(stages)}")
+        for reason in action.reasons:
+            lines.append(f"      - {reason}")
+    changed = sum(1 for action in actions if action.stages)
+    lines.insert(0, f"plan: {changed} of {len(actions)} model(s) to update")
+    return "\n".join(lines)
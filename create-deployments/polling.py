@@ -0,0 +1,108 @@
+import time
+import random
+import asyncio
+import logging
+
+from tracing import record
+
+logger = logging.getLogger(__name__)
+
+
+class PollTimeout(Exception):
+    """Raised when a long running DataRobot operation is still pending at the poller deadline"""
+
+
+class PollScheduler(object):
+    """
+    one place to wait on every long running DataRobot operation (dependency builds, training data
+    assignment, model package builds, batch jobs) for all models at once.
+
+    waits run as coroutines on the event loop instead of each holding a thread in a tight
+    refresh() loop.  each one backs off exponentially with jitter between checks, at most
+    max_parallel checks hit the api at the same time, and everything shares one overall deadline.
+    """
+
+    def __init__(self, initial_interval=2.0, max_interval=60.0, factor=2.0, jitter=0.25, deadline=None, max_parallel=8):
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.factor = factor
+        self.jitter = jitter
+        self.max_parallel = max_parallel
+        self.deadline_at = None
+        self.set_deadline(deadline)
+        self._semaphore = None
+
+    def set_deadline(self, seconds):
+        """overall deadline in seconds from now, None for no deadline"""
+        self.deadline_at = time.monotonic() + seconds if seconds else None
+
+    @property
+    def semaphore(self):
+        ## created lazily so it binds to the running loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_parallel)
+        return self._semaphore
+
+    async def _check(self, fn, *args):
+        record("poll_checks")
+        async with self.semaphore:
+            return await asyncio.to_thread(fn, *args)
+
+    async def _sleep(self, name, interval):
+        if self.deadline_at is not None:
+            remaining = self.deadline_at - time.monotonic()
+            if remaining <= 0:
+                raise PollTimeout(f"{name}: still pending at the polling deadline")
+            interval = min(interval, remaining)
+        interval = interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+        record("poll_wait", interval)
+        await asyncio.sleep(interval)
+
+    async def wait(self, name, check, initial_interval=None):
+        """
+        call check() (sync, run in a worker thread) until it returns something other than None,
+        and return that.  the first check happens straight away.
+        """
+        interval = initial_interval or self.initial_interval
+        checks = 0
+        start = time.monotonic()
+        while True:
+            result = await self._check(check)
+            checks += 1
+            if result is not None:
+                logger.debug(f"{name}: done after {checks} checks in {time.monotonic() - start:.1f}s")
+                return result
+            await self._sleep(name, interval)
+            interval = min(interval * self.factor, self.max_interval)
+
+    async def wait_group(self, name, keys, fetch, is_done, on_done=None, initial_interval=None, max_interval=None):
+        """
+        wait on many operations of the same kind with one call per round, for operations that
+        have a list endpoint.  fetch(pending_keys) returns {key: state} for (at least) the pending
+        keys, is_done(state) says whether an operation has finished.  on_done(key, state) is
+        called as each one finishes.  returns {key: final state}.  a round costs one call however
+        many keys are pending, so max_interval can be kept well below the poller's.
+        """
+        pending = list(keys)
+        results = {}
+        interval = initial_interval or self.initial_interval
+        max_interval = max_interval or self.max_interval
+        while pending:
+            states = await self._check(fetch, list(pending))
+            for key in list(pending):
+                state = states.get(key)
+                if state is not None and is_done(state):
+                    results[key] = state
+                    pending.remove(key)
+                    if on_done is not None:
+                        on_done(key, state)
+            if not pending:
+                break
+            logger.debug(f"{name}: {len(pending)} of {len(results) + len(pending)} still pending")
+            await self._sleep(name, interval)
+            interval = min(interval * self.factor, max_interval)
+        return results
+
+
+## shared by the deployment and monitoring scripts, main() sets the deadline from the cli
+poller = PollScheduler()
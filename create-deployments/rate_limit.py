@@ -0,0 +1,206 @@
+import os
+import re
+import time
+import random
+import asyncio
+import logging
+import threading
+from email.utils import parsedate_to_datetime
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from tracing import record, record_request
+
+logger = logging.getLogger(__name__)
+
+## throttling and transient server errors, anything else is raised straight away
+RETRYABLE_STATUS = {429, 502, 503, 504}
+## a create behind a 502 / 504 may well have gone through, sending it again would make a second
+## entity.  429 and 503 are refused before anything is done
+CREATE_RETRYABLE_STATUS = {429, 503}
+## some datarobot errors only say how long to wait in the message ("... try again in 30 seconds")
+WAIT_HINT = re.compile(r"(\d+)\s*seconds?", re.IGNORECASE)
+
+
+class TokenBucket(object):
+    """
+    client side rate limiter shared by every thread that talks to the DataRobot api.
+
+    requests take a token (refilled at `rate` per second, up to `burst`), and a 429 with a
+    Retry-After pauses the whole bucket so every worker backs off together instead of each one
+    tripping the limit on its own.
+    """
+
+    def __init__(self, rate=10.0, burst=20):
+        self.lock = threading.Lock()
+        self.configure(rate, burst)
+
+    def configure(self, rate, burst):
+        with self.lock:
+            self.rate = float(rate)
+            self.burst = float(burst)
+            self.tokens = float(burst)
+            self.updated = time.monotonic()
+            self.paused_until = 0.0
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                else:
+                    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self.lock:
+            now = time.monotonic()
+            if now + seconds > self.paused_until:
+                logger.info(f"api rate limited, pausing all requests for {seconds:.1f}s")
+            self.paused_until = max(self.paused_until, now + seconds)
+            self.tokens = 0.0
+            self.updated = max(self.updated, self.paused_until)
+
+    def pause_remaining(self):
+        with self.lock:
+            return max(0.0, self.paused_until - time.monotonic())
+
+
+limiter = TokenBucket(
+    rate=float(os.environ.get("DATAROBOT_API_RATE", 10)),
+    burst=int(os.environ.get("DATAROBOT_API_BURST", 20)),
+)
+
+
+def parse_retry_after(value):
+    """Retry-After is either a number of seconds or an http date"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimitedAdapter(HTTPAdapter):
+    """
+    takes a token before every request and turns Retry-After on 429 / 503 into a shared pause.
+    a throttled request is sent again after the pause (up to throttle_retries times) unless its
+    body is a stream that has already been read, e.g. a file upload.  those are left to
+    call_with_retry around the whole call.
+    """
+
+    def __init__(self, bucket=None, throttle_retries=5, **kwargs):
+        self.bucket = bucket or limiter
+        self.throttle_retries = throttle_retries
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        for attempt in range(self.throttle_retries + 1):
+            start = time.monotonic()
+            self.bucket.acquire()
+            throttle_wait = time.monotonic() - start
+            response = super().send(request, **kwargs)
+            record_request(request.method, response.status_code, throttle_wait)
+            if response.status_code not in (429, 503):
+                return response
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            if retry_after is not None:
+                self.bucket.pause(retry_after)
+            elif response.status_code == 429:
+                self.bucket.pause(1.0)
+            else:
+                return response
+            if attempt == self.throttle_retries or not isinstance(request.body, (bytes, str, type(None))):
+                return response
+            logger.debug(f"{request.method} {request.url} throttled, sending again after the pause")
+            record("retries")
+            response.close()
+        return response
+
+
+def install(client, bucket=None, **adapter_kwargs):
+    """
+    mount the rate limited adapter on a datarobot client (a requests.Session).  the client's own
+    connect retries are carried over to the new adapter, status retries are not: 429 / 5xx are
+    handled by the shared bucket and call_with_retry, and urllib3 would resend a streamed upload
+    whose body has already been read.
+    """
+    retries = getattr(client, "_kwargs", {}).get("max_retries") or 0
+    if isinstance(retries, Retry):
+        retries = retries.new(status_forcelist=None, respect_retry_after_header=False)
+    adapter_kwargs.setdefault("max_retries", retries)
+    adapter = RateLimitedAdapter(bucket, **adapter_kwargs)
+    client.mount("https://", adapter)
+    client.mount("http://", adapter)
+    return client
+
+
+def retry_delay(error, attempt, base_delay=2.0, max_delay=120.0, idempotent=True):
+    """
+    seconds to wait before retrying after error, None if the error is not worth retrying.  calls
+    that are not idempotent (idempotent=False) are retried on CREATE_RETRYABLE_STATUS and on any
+    error that says how long to wait (a refusal, nothing was created), never on a bare 502 / 504.
+
+    >>> class Refused(Exception): status_code = 422
+    >>> retry_delay(Refused("model is still being built, try again in 30 seconds"), 0, idempotent=False)
+    30.0
+    >>> class BadGateway(Exception): status_code = 502
+    >>> retry_delay(BadGateway("bad gateway"), 0, idempotent=False) is None
+    True
+    """
+    statuses = RETRYABLE_STATUS if idempotent else CREATE_RETRYABLE_STATUS
+    status = getattr(error, "status_code", None)
+    hint = None
+    message = getattr(error, "json", None)
+    message = message.get("message") if isinstance(message, dict) else str(error)
+    if message and (match := WAIT_HINT.search(str(message))):
+        hint = float(match.group(1))
+    if status not in statuses and hint is None:
+        return None
+    backoff = min(max_delay, base_delay * 2 ** attempt) * random.uniform(0.5, 1.0)
+    return max(backoff, hint or 0.0, limiter.pause_remaining())
+
+
+def call_with_retry(fn, *args, name=None, max_attempts=8, idempotent=True, **kwargs):
+    """
+    call fn, retrying throttled / transient failures based on status code, Retry-After and wait
+    hints.  pass idempotent=False for creates, see retry_delay.
+    """
+    for attempt in range(max_attempts):
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            delay = retry_delay(e, attempt, idempotent=idempotent)
+            if delay is None or attempt == max_attempts - 1:
+                raise
+            logger.info(f"{name or fn.__name__}: {e}. retrying in {delay:.1f}s (attempt {attempt + 1} of {max_attempts})")
+            record("retries")
+            record("retry_wait", delay)
+            time.sleep(delay)
+
+
+async def acall_with_retry(fn, *args, name=None, max_attempts=8, idempotent=True, **kwargs):
+    """call_with_retry for sync fn run in a worker thread, without holding the thread while waiting"""
+    for attempt in range(max_attempts):
+        try:
+            return await asyncio.to_thread(fn, *args, **kwargs)
+        except Exception as e:
+            delay = retry_delay(e, attempt, idempotent=idempotent)
+            if delay is None or attempt == max_attempts - 1:
+                raise
+            logger.info(f"{name or fn.__name__}: {e}. retrying in {delay:.1f}s (attempt {attempt + 1} of {max_attempts})")
+            record("retries")
+            record("retry_wait", delay)
+            await asyncio.sleep(delay)
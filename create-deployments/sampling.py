@@ -0,0 +1,67 @@
+import logging
+import tempfile
+from pathlib import Path
+
+import pandas as pd
+
+from datasets import register_training_dataset
+
+logger = logging.getLogger(__name__)
+
+
+def stratified_sample(df, columns=None, per_level=3, max_rows=200, seed=42):
+    """
+    a small sample of df that still exercises everything a model can be given: per_level rows for
+    every level of each categorical column (sex / smoker / region for the insurance data, or
+    whatever columns is given), the rows holding each numeric column's min and max, and rows with
+    missing values.  the seed is fixed so the same data always gives the same sample (and the
+    same content hash).
+
+    at most max_rows rows are kept.  the coverage rows (one per level, the min / max and missing
+    value rows) always are, the extra rows per level fill what is left.
+    """
+    if columns is None:
+        columns = [c for c in df.columns if df[c].dtype == object or str(df[c].dtype) == "category"]
+    numeric = df.select_dtypes("number").columns
+    coverage, extra = [], []
+    for column in columns:
+        for _, group in df.groupby(column, dropna=False):
+            rows = list(group.sample(min(per_level, len(group)), random_state=seed).index)
+            coverage.append(rows[0])
+            extra.extend(rows[1:])
+    for column in numeric:
+        if df[column].notna().any():
+            coverage.extend([df[column].idxmin(), df[column].idxmax()])
+        if df[column].isna().any():
+            coverage.append(df[column].isna().idxmax())
+    coverage = list(dict.fromkeys(coverage))
+    if len(coverage) > max_rows:
+        logger.warning(f"stratified sample needs {len(coverage)} rows to cover every level, more than max_rows={max_rows}")
+    extra = [i for i in dict.fromkeys(extra) if i not in set(coverage)]
+    picked = coverage + extra[:max(0, max_rows - len(coverage))]
+    return df.loc[sorted(picked)].reset_index(drop=True)
+
+
+def register_test_sample(training_dataset_id=None, training_dataset_path=None, columns=None, output_dir=None, index_path=None,
+                         sample_dataset_id=None, keep_versions=10):
+    """
+    register a stratified sample of the training data for CustomModelTest, as a new version of
+    sample_dataset_id (the previous sample) when given, keeping at most keep_versions of them.
+    the sample is registered through datasets.register_training_dataset, so an identical sample
+    (same training data) is reused from the last run instead of uploaded again.  returns the
+    dataset id.
+    """
+    if training_dataset_path is not None:
+        df = pd.read_csv(training_dataset_path)
+        name = Path(training_dataset_path).stem
+    else:
+        import datarobot as dr
+        dataset = dr.Dataset.get(training_dataset_id)
+        df = dataset.get_as_dataframe()
+        name = dataset.name
+    sample = stratified_sample(df, columns)
+    logger.info(f"custom model test sample: {len(sample)} of {len(df)} rows")
+    with tempfile.TemporaryDirectory(dir=output_dir) as workdir:
+        sample_path = Path(workdir) / f"{name}_test_sample.csv"
+        sample.to_csv(sample_path, index=False)
+        return register_training_dataset(sample_dataset_id, sample_path, keep_versions=keep_versions, index_path=index_path).id
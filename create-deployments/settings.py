@@ -0,0 +1,65 @@
+import logging
+
+from api_client import get_client
+from entity_cache import entity_cache, get_settings
+
+logger = logging.getLogger(__name__)
+
+ASSOCIATION_ID_COLUMN = "ASSOCIATION_ID"
+
+
+def desired_settings(conf, target_drift=True, feature_drift=True):
+    """the deployment settings conf asks for, in the shape of deployments/<id>/settings/"""
+    features_to_track = conf.get("features_to_track", []) or []
+    feature_selection = "manual" if features_to_track else "auto"
+    return {
+        "associationId": {"columnNames": [ASSOCIATION_ID_COLUMN], "requiredInPredictionRequests": False},
+        "predictionsDataCollection": {"enabled": True},
+        "targetDrift": {"enabled": target_drift},
+        "featureDrift": {"enabled": feature_drift, "featureSelection": feature_selection, "trackedFeatures": features_to_track},
+    }
+
+
+def fetch_settings(deployment_id, fresh=False):
+    ## cached, so the settings read while planning are not read again by the settings stage
+    return get_settings(deployment_id, fresh)
+
+
+def _same(current, desired):
+    if isinstance(desired, list):
+        return sorted(current or []) == sorted(desired)
+    return current == desired
+
+
+def diff_settings(current, desired):
+    """
+    the smallest settings PATCH that takes current to desired: only the sections with a value
+    that differs.  tracked features don't matter while feature selection is automatic.
+    """
+    patch = {}
+    for section, values in desired.items():
+        current_section = (current or {}).get(section) or {}
+        for key, value in values.items():
+            if section == "featureDrift" and key == "trackedFeatures" and values.get("featureSelection") == "auto":
+                continue
+            if not _same(current_section.get(key), value):
+                patch[section] = values
+                break
+    return patch
+
+
+def reconcile_deployment_settings(conf, current=None, target_drift=True, feature_drift=True):
+    """bring one deployment's settings in line with conf, with at most one PATCH.  returns the patch sent"""
+    deployment_id = conf["deployment_id"]
+    if current is None:
+        current = fetch_settings(deployment_id)
+    patch = diff_settings(current, desired_settings(conf, target_drift, feature_drift))
+    if not patch:
+        logger.info(f"{conf.get('name')}: deployment settings already up to date")
+        return patch
+    logger.info(f"{conf.get('name')}: updating deployment settings {sorted(patch)}: {patch}")
+    response = get_client().patch(f"deployments/{deployment_id}/settings/", data=patch)
+    entity_cache.invalidate("settings", deployment_id)
+    if response.status_code not in (200, 202, 204):
+        raise Exception(f"{conf.get('name')}: settings update returned status code {response.status_code}: {response.text}")
+    return patch
@@ -0,0 +1,243 @@
+import html
+import json
+import time
+import logging
+import threading
+import contextvars
+from pathlib import Path
+from datetime import datetime
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+## spans that belong to the run as a whole (planning, validation, dataset registration) rather than one model
+RUN = "(run)"
+WRITE_METHODS = {"POST", "PUT", "PATCH", "DELETE"}
+## where a span's time went.  whatever is not accounted for by these is api request time and local work
+WAITS = ["queued", "throttle_wait", "retry_wait", "poll_wait"]
+WAIT_COLORS = {"work": "#4c78a8", "queued": "#d3d3d3", "throttle_wait": "#e45756",
+               "retry_wait": "#f58518", "poll_wait": "#72b7b2"}
+
+## the span the current task / worker thread is running in.  asyncio.to_thread copies the
+## context, so api calls made from a stage's worker thread are counted against the stage
+_current = contextvars.ContextVar("tracing_span", default=None)
+
+
+class Span(object):
+    """one stage call for one model, with counters for the api calls and waits made inside it"""
+
+    def __init__(self, model, stage, start):
+        self.model = model
+        self.stage = stage
+        self.start = start
+        self.end = None
+        self.status = "running"
+        self.error = None
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def add(self, key, value=1):
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    @property
+    def seconds(self):
+        return (self.end if self.end is not None else time.monotonic()) - self.start
+
+    def breakdown(self):
+        """seconds per wait kind, plus the rest as work.  waits inside concurrent calls can overlap, so work is floored at 0"""
+        waits = {key: min(self.counters.get(key, 0.0), self.seconds) for key in WAITS}
+        return {**waits, "work": max(0.0, self.seconds - sum(waits.values()))}
+
+    def to_dict(self, origin):
+        return {
+            "model": self.model, "stage": self.stage, "status": self.status, "error": self.error,
+            "start": round(self.start - origin, 3), "end": round((self.end or time.monotonic()) - origin, 3),
+            "seconds": round(self.seconds, 3), "counters": {k: round(v, 3) for k, v in sorted(self.counters.items())},
+            "breakdown": {k: round(v, 3) for k, v in self.breakdown().items()},
+        }
+
+
+def record(key, value=1):
+    """add value to counter key of the span the caller is running in, if any"""
+    span = _current.get()
+    if span is not None:
+        span.add(key, value)
+
+
+def record_request(method, status_code, throttle_wait):
+    """called by the rate limited adapter for every api request"""
+    span = _current.get()
+    if span is None:
+        return
+    span.add("api_calls")
+    if method in WRITE_METHODS:
+        span.add("writes")
+    if status_code == 429:
+        span.add("throttled")
+    if throttle_wait > 0:
+        span.add("throttle_wait", throttle_wait)
+
+
+class Tracer(object):
+    """
+    records a Span for every stage call of a run and writes a per model waterfall and a
+    critical path summary at the end, so a slow rollout can be put down to throttling, builds /
+    package builds (poll_wait), retries, or our own concurrency limits (queued).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.origin = time.monotonic()
+            self.started_at = datetime.now().isoformat()
+            self.spans = []
+
+    @contextmanager
+    def span(self, model, stage):
+        span = Span(model, stage, time.monotonic())
+        with self.lock:
+            self.spans.append(span)
+        token = _current.set(span)
+        try:
+            yield span
+            span.status = "ok"
+        except BaseException as e:
+            span.status = "failed"
+            span.error = str(e)
+            raise
+        finally:
+            span.end = time.monotonic()
+            _current.reset(token)
+
+    def critical_path(self):
+        """
+        models only wait on each other through shared limits, so the run is as long as the run
+        level spans plus the chain of the model that finished last.
+        """
+        spans = [s for s in self.spans if s.end is not None]
+        model_spans = [s for s in spans if s.model != RUN]
+        if not model_spans:
+            return None, sorted(spans, key=lambda s: s.start)
+        last = max(model_spans, key=lambda s: s.end).model
+        return last, sorted([s for s in spans if s.model in (RUN, last)], key=lambda s: s.start)
+
+    def report(self):
+        with self.lock:
+            spans = list(self.spans)
+        end = max([s.end or time.monotonic() for s in spans], default=self.origin)
+        models = {}
+        stages = {}
+        for span in spans:
+            model = models.setdefault(span.model, {"start": span.start, "end": span.end or end, "status": "ok"})
+            model["start"] = min(model["start"], span.start)
+            model["end"] = max(model["end"], span.end or end)
+            if span.status == "failed":
+                model["status"] = "failed"
+            stage = stages.setdefault(span.stage, {"count": 0, "seconds": 0.0, "max_seconds": 0.0, "counters": {}, "breakdown": {}})
+            stage["count"] += 1
+            stage["seconds"] += span.seconds
+            stage["max_seconds"] = max(stage["max_seconds"], span.seconds)
+            for key, value in span.counters.items():
+                stage["counters"][key] = stage["counters"].get(key, 0) + value
+            for key, value in span.breakdown().items():
+                stage["breakdown"][key] = stage["breakdown"].get(key, 0.0) + value
+        critical_model, critical_spans = self.critical_path()
+        breakdown = {}
+        for span in critical_spans:
+            for key, value in span.breakdown().items():
+                breakdown[key] = breakdown.get(key, 0.0) + value
+        return {
+            "started_at": self.started_at,
+            "wall_seconds": round(end - self.origin, 3),
+            "models": {name: {"start": round(m["start"] - self.origin, 3), "end": round(m["end"] - self.origin, 3),
+                              "seconds": round(m["end"] - m["start"], 3), "status": m["status"]} for name, m in models.items()},
+            "stages": {name: {**s, "seconds": round(s["seconds"], 3), "max_seconds": round(s["max_seconds"], 3),
+                              "counters": {k: round(v, 3) for k, v in s["counters"].items()},
+                              "breakdown": {k: round(v, 3) for k, v in s["breakdown"].items()}} for name, s in stages.items()},
+            "critical_path": {
+                "model": critical_model,
+                "spans": [f"{s.model}:{s.stage}" for s in critical_spans],
+                "breakdown": {k: round(v, 3) for k, v in breakdown.items()},
+            },
+            "spans": [s.to_dict(self.origin) for s in spans],
+        }
+
+    def summary(self, report=None):
+        report = report or self.report()
+        critical = report["critical_path"]
+        lines = [f"trace: {report['wall_seconds']:.1f}s wall clock, critical path through {critical['model'] or 'the run'}"]
+        for key, value in sorted(critical["breakdown"].items(), key=lambda kv: -kv[1]):
+            if value >= 0.05:
+                lines.append(f"  {key:<14} {value:8.1f}s")
+        for name, stage in report["stages"].items():
+            counters = stage["counters"]
+            lines.append(f"  stage {name}: {stage['count']} call(s), {stage['seconds']:.1f}s total, {stage['max_seconds']:.1f}s max, "
+                         f"{int(counters.get('api_calls', 0))} api calls, {int(counters.get('throttled', 0))} throttled")
+        return "\n".join(lines)
+
+    def write(self, path):
+        """write the report as json to path, and the waterfall next to it as html.  returns the report"""
+        report = self.report()
+        path = Path(path)
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+        with open(path.with_suffix(".html"), "w") as f:
+            f.write(waterfall_html(report))
+        logger.info(f"trace written to {path} and {path.with_suffix('.html')}")
+        return report
+
+
+def waterfall_html(report):
+    """a self contained page, one row per model, one bar per stage split into work and waits"""
+    wall = max(report["wall_seconds"], 1e-9)
+    critical = report["critical_path"]["model"]
+    rows = []
+    for model in sorted(report["models"], key=lambda m: (m != RUN, report["models"][m]["start"])):
+        bars = []
+        for span in (s for s in report["spans"] if s["model"] == model):
+            left = 100 * span["start"] / wall
+            segments = []
+            for key in WAITS + ["work"]:
+                share = span["breakdown"].get(key, 0.0) / max(span["seconds"], 1e-9)
+                if share > 0:
+                    segments.append(f'<span style="flex:{share:.4f};background:{WAIT_COLORS[key]}"></span>')
+            title = html.escape(f"{span['stage']}: {span['seconds']:.1f}s {span['status']} "
+                                + ", ".join(f"{k}={v}" for k, v in {**span["counters"], **span["breakdown"]}.items()))
+            outline = "outline:2px solid #000;" if span["status"] == "failed" else ""
+            bars.append(f'<div class="bar" title="{title}" style="left:{left:.3f}%;width:{max(100 * span["seconds"] / wall, 0.2):.3f}%;{outline}">'
+                        f'{"".join(segments)}</div>')
+        label = html.escape(model) + (" *" if model == critical else "")
+        rows.append(f'<tr><td class="name">{label}</td><td class="lane">{"".join(bars)}</td></tr>')
+    legend = " ".join(f'<span class="key" style="background:{color}"></span>{key}' for key, color in WAIT_COLORS.items())
+    stage_rows = "".join(
+        f"<tr><td>{html.escape(name)}</td><td>{s['count']}</td><td>{s['seconds']:.1f}</td><td>{s['max_seconds']:.1f}</td>"
+        + "".join(f"<td>{s['breakdown'].get(key, 0):.1f}</td>" for key in WAITS + ["work"])
+        + f"<td>{int(s['counters'].get('api_calls', 0))}</td><td>{int(s['counters'].get('throttled', 0))}</td></tr>"
+        for name, s in report["stages"].items())
+    breakdown = ", ".join(f"{k} {v:.1f}s" for k, v in sorted(report["critical_path"]["breakdown"].items(), key=lambda kv: -kv[1]) if v >= 0.05)
+    return f"""<!doctype html>
+<html><head><meta charset="utf-8"><title>rollout trace {html.escape(report['started_at'])}</title>
+<style>
+body {{font-family: sans-serif; font-size: 13px; margin: 20px}}
+table {{border-collapse: collapse}} td, th {{padding: 2px 8px; text-align: right}}
+td.name {{text-align: left; white-space: nowrap}} td.lane {{position: relative; width: 900px; height: 18px; background: #f7f7f7}}
+.bar {{position: absolute; top: 2px; height: 14px; display: flex; overflow: hidden}}
+.key {{display: inline-block; width: 12px; height: 12px; margin: 0 4px 0 12px; vertical-align: middle}}
+</style></head><body>
+<h3>rollout started {html.escape(report['started_at'])}, {report['wall_seconds']:.1f}s wall clock</h3>
+<p>critical path (*): {html.escape(str(critical))} - {html.escape(breakdown)}</p>
+<p>{legend}</p>
+<table>{"".join(rows)}</table>
+<h3>stages</h3>
+<table><tr><th>stage</th><th>calls</th><th>total s</th><th>max s</th>{"".join(f"<th>{k}</th>" for k in WAITS + ["work"])}<th>api calls</th><th>429s</th></tr>
+{stage_rows}</table>
+</body></html>
+"""
+
+
+## shared by the deployment scripts, like poller and limiter
+tracer = Tracer()
@@ -0,0 +1,105 @@
+import os
+import pickle
+import asyncio
+import logging
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+from artifact_cache import hash_file
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = int(os.environ.get("VALIDATION_WORKERS", min(os.cpu_count() or 1, 8)))
+
+## test data is read once per worker process, not once per artifact
+_test_data = {}
+
+
+def needs_drum(artifact_folder):
+    """custom hooks (custom.py) or anything other than one pickled model has to go through drum"""
+    folder = Path(artifact_folder)
+    return (folder / "custom.py").exists() or len(list(folder.glob("*.pkl"))) != 1
+
+
+def score_in_process(artifact_folder, target_type, test_data_path):
+    """
+    load the pickled model the way drum's sklearn predictor does and score the test data with it.
+    runs in a worker process, returns (passed, message).
+    """
+    try:
+        import numpy as np
+        import pandas as pd
+
+        if test_data_path not in _test_data:
+            _test_data[test_data_path] = pd.read_csv(test_data_path)
+        df = _test_data[test_data_path]
+        with open(next(Path(artifact_folder).glob("*.pkl")), "rb") as f:
+            model = pickle.load(f)
+        if target_type == "binary":
+            predictions = np.asarray(model.predict_proba(df))
+            if predictions.shape != (len(df), 2) or not np.allclose(predictions.sum(axis=1), 1.0):
+                return False, f"predict_proba returned shape {predictions.shape}, expected ({len(df)}, 2) summing to 1"
+        else:
+            predictions = np.asarray(model.predict(df), dtype=float)
+            if predictions.shape[0] != len(df):
+                return False, f"predict returned {predictions.shape[0]} rows for {len(df)} input rows"
+        if not np.isfinite(predictions).all():
+            return False, "predictions contain nan or inf"
+    except Exception as e:
+        return False, f"{type(e).__name__}: {e}"
+    return True, f"scored {len(df)} rows"
+
+
+def validation_key(conf):
+    return "|".join([
+        conf["artifact_hash"], hash_file(conf["drum_test_data_path"]), conf["target_type"].lower(),
+        str(conf.get("positive_class_label")), str(conf.get("negative_class_label")),
+    ])
+
+
+async def validate_artifacts(confs, drum_fallback, index=None, max_workers=DEFAULT_WORKERS):
+    """
+    score every conf's artifact folder against its drum_test_data_path before anything is sent to
+    datarobot.  pickled models are loaded and scored in a bounded process pool, folders that need
+    drum (see needs_drum) go through drum_fallback(conf).  with an ArtifactIndex, results are
+    cached by artifact + test data hash, so unchanged artifacts are not scored again.  returns the
+    names of the confs that failed.
+    """
+    failed = []
+    pending = []
+    for conf in confs:
+        key = validation_key(conf) if index is not None and "artifact_hash" in conf else None
+        if key is not None and index.validation(key):
+            logger.info(f"{conf.get('name')}: artifacts validated before, skipping local validation")
+            conf["drum_test_passed"] = True
+        else:
+            pending.append((conf, key))
+    if not pending:
+        return failed
+
+    loop = asyncio.get_running_loop()
+    drum_slots = asyncio.Semaphore(max_workers)
+    ## spawn, not fork: the parent has api client threads and an event loop running
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        async def _validate(conf, key):
+            if needs_drum(conf["artifact_folder"]):
+                try:
+                    async with drum_slots:
+                        await drum_fallback(conf)
+                    passed, message = True, "drum score passed"
+                except Exception as e:
+                    passed, message = False, str(e)
+            else:
+                passed, message = await loop.run_in_executor(
+                    pool, score_in_process, conf["artifact_folder"], conf["target_type"].lower(), conf["drum_test_data_path"])
+            conf["drum_test_passed"] = passed
+            if passed:
+                logger.info(f"{conf.get('name')}: local validation passed, {message}")
+                if key is not None:
+                    index.record_validation(key)
+            else:
+                logger.error(f"{conf.get('name')}: local validation failed, {message}")
+                failed.append(conf["name"])
+        await asyncio.gather(*[_validate(conf, key) for conf, key in pending])
+    return failed
@@ -6,6 +6,9 @@ import logging
 import time
 from datarobot_mlops.mlops import MLOps
 import os
+import queue
+from timing import RequestTimer, request_stats
+import metrics
 
 
 ## this will be an unstructured model exposing the following hooks
@@ -17,11 +20,34 @@ logging.basicConfig(
                 format="{} - %(levelname)s - %(asctime)s - %(message)s".format("debug-loggers"),
         )
 logger = logging.getLogger(__name__)
-try: 
-    mlops = MLOps().init()
-except Exception as e:
-    print(e)
-    mlops = None
+## one line per request with the ms spent in each stage, silence with logging.getLogger("timing").setLevel("WARNING")
+timing_logger = logging.getLogger("timing")
+## mlops is set up once per process (see get_mlops) so a forked worker never reuses the
+## spooler of its parent.  with pre-forked workers (serving/) reports go onto mlops_queue
+## instead and a single reporter process owns the spooler, see mlops_reporter.py
+mlops = None
+mlops_pid = None
+mlops_queue = None
+
+def get_mlops():
+    global mlops, mlops_pid
+    if mlops_pid != os.getpid():
+        mlops_pid = os.getpid()
+        try: 
+            mlops = MLOps().init()
+        except Exception as e:
+            print(e)
+            mlops = None
+    return mlops
+
+def start_metrics(offset=0):
+    ## prometheus metrics on a separate local port, METRICS_PORT=0 turns it off
+    port = int(os.environ.get("METRICS_PORT", 9464))
+    if port:
+        try:
+            metrics.start_metrics_server(port + offset)
+        except OSError as e:
+            logger.warning(f"could not start metrics server on port {port + offset}: {e}")
 
 def init(**kwargs):
     """
@@ -30,8 +56,24 @@ def init(**kwargs):
 
     :param kwargs: additional keyword arguments to the function.
     code_dir - code folder passed in --code_dir argument
+    prefork - set by serving/ when the model is loaded in a parent process that forks workers,
+              mlops and the metrics server are then started per worker in init_worker
     """
-    pass
+    if kwargs.get("prefork"):
+        return
+    start_metrics()
+    get_mlops()
+
+def init_worker(worker_id, reporter_queue=None):
+    """
+    called in each forked worker when serving with serving/gunicorn.conf.py
+
+    :param worker_id: 0 based worker slot, the metrics server listens on METRICS_PORT + worker_id
+    :param reporter_queue: queue of the shared mlops reporter process, None to report from the worker
+    """
+    global mlops_queue
+    mlops_queue = reporter_queue
+    start_metrics(offset=worker_id)
 
 def load_model(input_dir):
     """
@@ -46,33 +88,82 @@ def load_model(input_dir):
     :param input_dir: the directory to load serialized models from
     :returns: Object containing the model - the predict hook will get this object as a parameter
     """
-    # Returning a string with value "dummy" as the model.
-    return RoutingModel(input_dir)
+    start = time.perf_counter()
+    model = RoutingModel(input_dir)
+    metrics.model_load_seconds.set(time.perf_counter() - start)
+    metrics.models_loaded.set(len(model.models))
+    return model
+
+def get_stats():
+    """rolling per stage timing histogram of recent requests, also served on /stats/ by custom_flask.py"""
+    return request_stats.snapshot()
+
+def mlops_enabled():
+    return mlops_queue is not None or get_mlops() is not None
+
+def report(call, **kwargs):
+    """wraps a single mlops report call so in flight calls and failures show up in the metrics"""
+    if mlops_queue is not None:
+        try:
+            mlops_queue.put_nowait((call, kwargs))
+        except queue.Full:
+            metrics.mlops_report_failures.inc(call=call)
+            logger.warning(f"mlops reporter queue is full, dropping {call}")
+        try:
+            metrics.mlops_queue_depth.set(mlops_queue.qsize())
+        except NotImplementedError:
+            pass
+        return
+    metrics.mlops_inflight.inc()
+    try:
+        return getattr(mlops, call)(**kwargs)
+    except Exception:
+        metrics.mlops_report_failures.inc(call=call)
+        raise
+    finally:
+        metrics.mlops_inflight.dec()
 
 def score_unstructured(model, data, query, **kwargs):
+    timer = RequestTimer()
     if kwargs["mimetype"] in ["application/text", "text/csv"]:
-        so = StringIO(data.decode())
-        df = pd.read_csv(so)
+        with timer.stage("decode"):
+            so = StringIO(data.decode() if isinstance(data, bytes) else data)
+        with timer.stage("frame"):
+            df = pd.read_csv(so)
     elif kwargs["mimetype"] == "application/json":
-        j = json.loads(data)
-        df = pd.DataFrame(j)
+        with timer.stage("decode"):
+            j = json.loads(data)
+        with timer.stage("frame"):
+            df = pd.DataFrame(j)
     else:
         logger.warning(f"recieved mimetype {kwargs['mimetype']} is not one of application/text, text/csv, application/json")
+        metrics.requests_total.inc(mimetype=kwargs["mimetype"], status="unsupported")
         return json.dumps({"message": f"{kwargs['mimetype']} recieved, but model does not know how to handle"})
     start = time.time() 
     ## concurrent predictions, or 
-    # preds = model.futures_predict(df)
+    # preds = dict(model.concurrent_predict(df, timer=timer))
     ## sequential predictions
-    preds = dict( model.predict(df))
+    with timer.stage("predict"):
+        preds = dict( model.predict(df, timer=timer))
     end = time.time()
-    if mlops:
-      mlops.report_predictions_data(features_df = df, deployment_id = os.environ.get("DEPLOYMENT_ID"),model_id = os.environ.get("MODEL_ID") )
-      mlops.report_deployment_stats(df.shape[0], (end - start)*1000, deployment_id = os.environ.get("DEPLOYMENT_ID"),model_id = os.environ.get("MODEL_ID"))
-      for model_config in model.routing_config:
-          tag = model_config["tag"]
-          dep_id = model_config["deployment_id"]
-          model_id = model_config["model_id"] 
-          print(f"reporting prediction data for tag: {tag} deployment id:{dep_id} model package id: {model_id}")
-          mlops.report_deployment_stats(df.shape[0], (end - start)*1000 / 19, deployment_id = dep_id, model_id = model_id)
-          mlops.report_predictions_data(predictions = preds[tag], deployment_id = dep_id, model_id = model_id)
-    return json.dumps(preds)
\ No newline at end of file
+    with timer.stage("serialize"):
+        out = json.dumps(preds)
+    if mlops_enabled():
+      with timer.stage("mlops"):
+        report("report_predictions_data", features_df = df, deployment_id = os.environ.get("DEPLOYMENT_ID"),model_id = os.environ.get("MODEL_ID") )
+        report("report_deployment_stats", num_predictions = df.shape[0], execution_time_ms = (end - start)*1000, deployment_id = os.environ.get("DEPLOYMENT_ID"),model_id = os.environ.get("MODEL_ID"))
+        for model_config in model.routing_config:
+            tag = model_config["tag"]
+            dep_id = model_config["deployment_id"]
+            model_id = model_config["model_id"] 
+            if model_config.get("remote"):
+                ## datarobot hosted deployments record their own predictions and service stats
+                continue
+            logger.debug(f"reporting prediction data for tag: {tag} deployment id:{dep_id} model package id: {model_id}")
+            report("report_deployment_stats", num_predictions = df.shape[0], execution_time_ms = (end - start)*1000 / 19, deployment_id = dep_id, model_id = model_id)
+            report("report_predictions_data", predictions = preds[tag], deployment_id = dep_id, model_id = model_id)
+    total = timer.total()
+    request_stats.record(timer, total)
+    metrics.observe_request(timer, total, kwargs["mimetype"], df.shape[0])
+    timing_logger.info(f"rows={df.shape[0]} mimetype={kwargs['mimetype']} total={total:.2f} {timer.summary()}")
+    return out
@@ -0,0 +1,20 @@
+## drum picks this file up from the code dir and calls init_app with its flask app
+## before serving, which lets us add routes next to /predictUnstructured/
+from flask import Response, jsonify, request
+from timing import request_stats
+import metrics
+
+
+def init_app(app):
+    @app.route("/stats/", methods=["GET"])
+    def stats():
+        """rolling per stage timing of recent requests. ?reset=true clears the window after reading"""
+        snapshot = request_stats.snapshot()
+        if request.args.get("reset", "").lower() == "true":
+            request_stats.reset()
+        return jsonify(snapshot)
+
+    @app.route("/metrics/", methods=["GET"])
+    def prometheus_metrics():
+        """same payload as the standalone metrics port, for scrapers that can only reach the drum port"""
+        return Response(metrics.registry.render(), mimetype=metrics.CONTENT_TYPE)
@@ -2,7 +2,6 @@ import os
 import yaml
 import pandas as pd
 from helper import *
-from requests_futures.sessions import FuturesSession
 from io import StringIO
 from datarobot_drum import RuntimeParameters
 import numpy as np
@@ -10,6 +9,7 @@ import logging
 import time
 from pathlib import Path 
 import pickle 
+import threading
 from concurrent.futures import ThreadPoolExecutor
 
 
@@ -21,27 +21,102 @@ logger = logging.getLogger(__name__)
 logger.setLevel("WARNING")
 
 
+## realtime prediction endpoint of a datarobot hosted deployment, used for remote tags without a prediction_url
+DEFAULT_PREDICTION_URL = "https://app.datarobot.com/api/v2/deployments/{deployment_id}/predictions"
+
+
+def get_api_token():
+    try:
+        return RuntimeParameters.get("DATAROBOT_API_TOKEN")["apiToken"]
+    except Exception:
+        return os.environ.get("DATAROBOT_API_TOKEN")
+
+
 class RoutingModel(object):
+    """
+    scores every tag in routing_config.yaml.  tags are scored in-process from models/<tag>/model.pkl,
+    unless the entry has `remote: true`, in which case the deployment is called over http at
+    `prediction_url` (default: the datarobot realtime endpoint for `deployment_id`).  remote
+    requests are all sent before local scoring starts, so the network time overlaps with it.
+    """
     def __init__(self, code_dir: str):
         path = Path(code_dir) / "models"    
         with open(os.path.join(code_dir, "routing_config.yaml"), "r") as f:
             self.routing_config = yaml.load(f, Loader=yaml.FullLoader)
+        self.tags = [model_config["tag"] for model_config in self.routing_config]
         self.models = {}
+        self.remote = {}
         for model_config in self.routing_config:
             quantile = model_config["tag"]
+            if model_config.get("remote"):
+                url = model_config.get("prediction_url") or DEFAULT_PREDICTION_URL.format(deployment_id=model_config["deployment_id"])
+                if base_url := os.environ.get("REMOTE_PREDICTION_BASE_URL"):
+                    ## point every remote tag at another host, e.g. a local stub prediction server
+                    url = base_url.rstrip("/") + "/api/v2/deployments/" + model_config["deployment_id"] + "/predictions"
+                self.remote[quantile] = url
+                continue
             model_path = path / model_config["tag"] / "model.pkl"
             with open( str(model_path), "rb") as f:
                 model = pickle.load(f) 
                 self.models[quantile] = model
+        ## the remote client owns a loop thread, which a forked worker does not inherit (serving/
+        ## loads the model in the master with preload_app), so it is created per process on first use
+        self._remote_client = None
+        self._remote_client_pid = None
+        self._remote_client_lock = threading.Lock()
+        if self.remote:
+            logger.info(f"scoring {list(self.remote)} remotely")
+
+    @property
+    def remote_client(self):
+        if self.remote and self._remote_client_pid != os.getpid():
+            with self._remote_client_lock:
+                if self._remote_client_pid != os.getpid():
+                    from remote_client import RemotePredictionClient
+                    self._remote_client = RemotePredictionClient(get_api_token())
+                    self._remote_client_pid = os.getpid()
+        return self._remote_client
+
+    def _predict_one(self, tag, model, df, timer=None):
+        if timer is None:
+            return model.predict(df)
+        with timer.stage(f"predict.{tag}"):
+            return model.predict(df)
+
+    def _submit_remote(self, df, timer=None):
+        if not self.remote:
+            return []
+        body = df.to_csv(index=False).encode("utf-8")
+        futures = []
+        client = self.remote_client
+        for tag, url in self.remote.items():
+            on_done = None
+            if timer is not None:
+                on_done = (lambda ms, tag=tag: timer.stages.__setitem__(f"predict.{tag}", ms))
+            futures.append((tag, client.submit(url, body, on_done)))
+        return futures
+
+    def _in_tag_order(self, predictions):
+        predictions = dict(predictions)
+        return [ (tag, predictions[tag]) for tag in self.tags]
 
-    def predict(self, df):
-        return [ (tag, model.predict(df).tolist()) for tag, model in self.models.items()]
+    def predict(self, df, timer=None):
+        remote_futures = self._submit_remote(df, timer)
+        predictions = [ (tag, self._predict_one(tag, model, df, timer).tolist()) for tag, model in self.models.items()]
+        if not remote_futures:
+            return predictions
+        predictions += [ (tag, self.remote_client.result(future)) for tag, future in remote_futures]
+        return self._in_tag_order(predictions)
 
-    def concurrent_predict(self, df):
+    def concurrent_predict(self, df, timer=None):
+        remote_futures = self._submit_remote(df, timer)
         with ThreadPoolExecutor() as executor:
-            futures = [ (tag, executor.submit(model.predict, df)) for tag, model in self.models.items()]
+            futures = [ (tag, executor.submit(self._predict_one, tag, model, df, timer)) for tag, model in self.models.items()]
             predictions = []
             for tag, future in futures:
                 result = (tag, future.result().tolist() )
                 predictions.append( result )
-        return predictions
+        if not remote_futures:
+            return predictions
+        predictions += [ (tag, self.remote_client.result(future)) for tag, future in remote_futures]
+        return self._in_tag_order(predictions)
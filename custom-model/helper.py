@@ -19,7 +19,7 @@ class DataRobotPredictionError(Exception):
 
 
 def make_datarobot_deployment_url_payload(
-    deployment_id, api_url, api_key, datarobot_key=None, passthrough_columns=None
+    deployment_id, api_url, api_key, datarobot_key=None, passthrough_columns=None, accept="text/csv"
 ):
     # Set HTTP headers. The charset should match the contents of the file.
     headers = {
@@ -27,8 +27,10 @@ def make_datarobot_deployment_url_payload(
         # 'Content-Type': 'application/json; charset=UTF-8',
         "Authorization": "Bearer {}".format(api_key),
         # "DataRobot-Key": datarobot_key,
-        'Accept': "text/csv"
+        'Accept': accept
     }
+    if datarobot_key:
+        headers["DataRobot-Key"] = datarobot_key
 
     url = api_url 
 
@@ -0,0 +1,177 @@
+import math
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+## seconds, roughly the prometheus client defaults stretched out to cover large batches
+DEFAULT_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + (extra or [])
+    if not pairs:
+        return ""
+    escaped = [(k, str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')) for k, v in pairs]
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        if not self.labelnames:
+            self.values[()] = 0
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(self._key(labels), 0)
+
+    def render(self):
+        with self.lock:
+            items = list(self.values.items())
+        return self.header() + [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(v)}" for key, v in items]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = sorted(buckets) + [math.inf]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            state = self.values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state["counts"][i] += 1
+                    break
+            state["sum"] += value
+            state["count"] += 1
+
+    def render(self):
+        with self.lock:
+            items = [(key, {"counts": list(s["counts"]), "sum": s["sum"], "count": s["count"]}) for key, s in self.values.items()]
+        lines = self.header()
+        for key, state in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, state["counts"]):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', _format_value(bound))])} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(state['sum'])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {state['count']}")
+        return lines
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+requests_total = registry.register(Counter("umbrella_requests_total", "Requests received, by mimetype and outcome", ["mimetype", "status"]))
+rows_scored_total = registry.register(Counter("umbrella_rows_scored_total", "Rows scored by the umbrella model"))
+request_duration = registry.register(Histogram("umbrella_request_duration_seconds", "End to end score_unstructured time", ["mimetype"]))
+stage_duration = registry.register(Histogram("umbrella_stage_duration_seconds", "Time spent in each request stage", ["stage"]))
+predict_duration = registry.register(Histogram("umbrella_predict_duration_seconds", "Per submodel predict time", ["tag"]))
+mlops_inflight = registry.register(Gauge("umbrella_mlops_reports_inflight", "MLOps report calls currently in progress"))
+mlops_queue_depth = registry.register(Gauge("umbrella_mlops_queue_depth", "Reports waiting for the shared mlops reporter process (multi worker serving)"))
+mlops_report_failures = registry.register(Counter("umbrella_mlops_report_failures_total", "MLOps report calls that raised", ["call"]))
+model_load_seconds = registry.register(Gauge("umbrella_model_load_seconds", "Time taken to load all submodels"))
+models_loaded = registry.register(Gauge("umbrella_models_loaded", "Number of submodels loaded"))
+
+
+def observe_request(timer, total_ms, mimetype, rows):
+    """record a finished request, timer is the RequestTimer from timing.py"""
+    requests_total.inc(mimetype=mimetype, status="ok")
+    rows_scored_total.inc(rows)
+    request_duration.observe(total_ms / 1000, mimetype=mimetype)
+    for name, ms in timer.stages.items():
+        if name.startswith("predict."):
+            predict_duration.observe(ms / 1000, tag=name[len("predict."):])
+        else:
+            stage_duration.observe(ms / 1000, stage=name)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip("/") not in ["", "/metrics"]:
+            self.send_error(404)
+            return
+        body = registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def start_metrics_server(port, address="0.0.0.0"):
+    """serve /metrics in the prometheus text format from a daemon thread"""
+    server = ThreadingHTTPServer((address, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True)
+    thread.start()
+    logger.info(f"serving prometheus metrics on {address}:{port}/metrics")
+    return server
@@ -0,0 +1,53 @@
+import os
+import logging
+import multiprocessing as mp
+
+logger = logging.getLogger(__name__)
+
+
+def _reporter_loop(report_queue):
+    ## imported here so the parent that forks the reporter never touches the mlops library
+    from datarobot_mlops.mlops import MLOps
+    try:
+        mlops = MLOps().init()
+    except Exception as e:
+        logger.error(f"mlops reporter could not initialise mlops, reports will be dropped: {e}")
+        mlops = None
+    logger.info(f"mlops reporter started in pid {os.getpid()}")
+    while True:
+        item = report_queue.get()
+        if item is None:
+            break
+        if mlops is None:
+            continue
+        call, kwargs = item
+        try:
+            getattr(mlops, call)(**kwargs)
+        except Exception as e:
+            logger.warning(f"mlops reporter: {call} failed: {e}")
+    if mlops is not None:
+        mlops.shutdown()
+    logger.info("mlops reporter stopped")
+
+
+def start_reporter(maxsize=None):
+    """
+    fork a single process that owns the mlops spooler for every serving worker.
+
+    workers put (call, kwargs) tuples on the returned queue (see custom.report), so there is
+    only ever one filesystem / kafka spooler writer no matter how many workers are running.
+    """
+    maxsize = maxsize if maxsize is not None else int(os.environ.get("MLOPS_REPORTER_QUEUE_SIZE", 10000))
+    ctx = mp.get_context("fork")
+    report_queue = ctx.Queue(maxsize=maxsize)
+    process = ctx.Process(target=_reporter_loop, args=(report_queue,), name="mlops-reporter", daemon=True)
+    process.start()
+    return report_queue, process
+
+
+def stop_reporter(report_queue, process, timeout=30):
+    report_queue.put(None)
+    process.join(timeout)
+    if process.is_alive():
+        logger.warning("mlops reporter did not stop in time, terminating")
+        process.terminate()
@@ -0,0 +1,117 @@
+import os
+import random
+import asyncio
+import logging
+import threading
+import concurrent.futures
+
+import aiohttp
+
+from helper import DataRobotPredictionError, make_datarobot_deployment_url_payload, MAX_PREDICTION_FILE_SIZE_BYTES
+
+logger = logging.getLogger(__name__)
+
+## status codes worth another attempt, anything else in the 4xx range is a bad request
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+class RetryablePredictionError(DataRobotPredictionError):
+    """Raised for throttling, server errors and timeouts from a remote deployment"""
+
+
+class RemotePredictionClient(object):
+    """
+    pooled keep-alive http client for scoring submodels hosted as DataRobot deployments.
+
+    the client owns an asyncio loop in a background thread so the synchronous scoring path can
+    fire off every remote tag at once (submit) and keep scoring local tags while they are in
+    flight.  each request gets a timeout, is hedged (a duplicate is sent if no answer arrives
+    within hedge_after seconds, first answer wins) and retried with backoff on retryable errors.
+    """
+
+    def __init__(self, api_token, max_per_host=None, timeout=None, hedge_after=None, max_retries=None, backoff=0.5):
+        self.api_token = api_token
+        self.max_per_host = max_per_host or int(os.environ.get("REMOTE_MAX_PER_HOST", 8))
+        self.timeout = timeout or float(os.environ.get("REMOTE_TIMEOUT", 30))
+        hedge_after = hedge_after if hedge_after is not None else os.environ.get("REMOTE_HEDGE_AFTER", "1.0")
+        self.hedge_after = float(hedge_after) if hedge_after not in ["", "0", 0, None] else None
+        self.max_retries = max_retries if max_retries is not None else int(os.environ.get("REMOTE_MAX_RETRIES", 2))
+        self.backoff = backoff
+        ## longest a request can legitimately take: every attempt (a hedged one starts hedge_after
+        ## late) timing out, plus the backoff between attempts
+        attempts = self.max_retries + 1
+        self.result_timeout = attempts * (self.timeout + (self.hedge_after or 0)) + self.backoff * 2 ** attempts
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="remote-predictions", daemon=True)
+        self.thread.start()
+        self.session = asyncio.run_coroutine_threadsafe(self._make_session(), self.loop).result()
+
+    async def _make_session(self):
+        connector = aiohttp.TCPConnector(limit=0, limit_per_host=self.max_per_host, keepalive_timeout=60)
+        return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+    def submit(self, url, body, on_done=None):
+        """schedule a prediction request, returns a concurrent.futures.Future with the list of predictions"""
+        if len(body) > MAX_PREDICTION_FILE_SIZE_BYTES:
+            raise DataRobotPredictionError(f"payload of {len(body)} bytes exceeds the {MAX_PREDICTION_FILE_SIZE_BYTES} byte prediction limit")
+        return asyncio.run_coroutine_threadsafe(self._predict(url, body, on_done), self.loop)
+
+    def result(self, future):
+        """the predictions of a submitted request, never waiting longer than result_timeout"""
+        try:
+            return future.result(timeout=self.result_timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise DataRobotPredictionError(f"remote prediction did not finish within {self.result_timeout:.0f}s")
+
+    async def _predict(self, url, body, on_done=None):
+        start = self.loop.time()
+        try:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    return await self._hedged(url, body)
+                except (RetryablePredictionError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    if attempt == self.max_retries:
+                        raise DataRobotPredictionError(f"{url}: giving up after {attempt + 1} attempts: {e!r}") from e
+                    wait_for = self.backoff * 2 ** attempt * (1 + random.random())
+                    logger.warning(f"{url}: attempt {attempt + 1} failed ({e!r}), retrying in {wait_for:.2f}s")
+                    await asyncio.sleep(wait_for)
+        finally:
+            if on_done is not None:
+                on_done((self.loop.time() - start) * 1000)
+
+    async def _hedged(self, url, body):
+        tasks = {asyncio.ensure_future(self._post(url, body))}
+        if self.hedge_after is not None:
+            done, _ = await asyncio.wait(tasks, timeout=self.hedge_after)
+            if not done:
+                logger.info(f"{url}: no answer after {self.hedge_after}s, sending hedged request")
+                tasks.add(asyncio.ensure_future(self._post(url, body)))
+        error = None
+        try:
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _post(self, url, body):
+        payload = make_datarobot_deployment_url_payload(None, url, self.api_token, accept="application/json")
+        params = {k: v for k, v in payload["params"].items() if v is not None}
+        async with self.session.post(payload["url"], params=params, headers=payload["headers"], data=body) as response:
+            if response.status in RETRYABLE_STATUS:
+                raise RetryablePredictionError(f"{url} returned {response.status}: {await response.text()}")
+            if response.status != 200:
+                raise DataRobotPredictionError(f"{url} returned {response.status}: {await response.text()}")
+            result = await response.json(content_type=None)
+        rows = sorted(result["data"], key=lambda row: row.get("rowId", 0))
+        return [row["prediction"] for row in rows]
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.session.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
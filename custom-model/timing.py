@@ -0,0 +1,82 @@
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+
+## upper bounds (ms) of the histogram buckets reported by RollingStats
+BUCKETS_MS = [0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+
+class RequestTimer(object):
+    """collects wall clock durations (ms) for the named stages of a single request"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + (time.perf_counter() - start) * 1000
+
+    def total(self):
+        return (time.perf_counter() - self.started) * 1000
+
+    def summary(self, top_level_only=True):
+        """compact `stage=ms` string, per tag stages (`predict.<tag>`) are left out by default"""
+        parts = [f"{name}={ms:.2f}" for name, ms in self.stages.items() if not (top_level_only and "." in name)]
+        return " ".join(parts)
+
+
+class RollingStats(object):
+    """rolling window of the last `window` requests per stage, summarised on demand"""
+
+    def __init__(self, window=1024):
+        self.window = window
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.requests = 0
+
+    def record(self, timer, total_ms=None):
+        with self.lock:
+            self.requests += 1
+            stages = dict(timer.stages)
+            stages["total"] = total_ms if total_ms is not None else timer.total()
+            for name, ms in stages.items():
+                if name not in self.samples:
+                    self.samples[name] = deque(maxlen=self.window)
+                self.samples[name].append(ms)
+
+    def snapshot(self):
+        with self.lock:
+            samples = {name: np.array(values) for name, values in self.samples.items()}
+            requests = self.requests
+        stages = {}
+        for name, values in samples.items():
+            if len(values) == 0:
+                continue
+            counts = np.histogram(values, bins=[0] + BUCKETS_MS + [np.inf])[0]
+            stages[name] = {
+                "count": int(len(values)),
+                "mean_ms": float(values.mean()),
+                "p50_ms": float(np.percentile(values, 50)),
+                "p95_ms": float(np.percentile(values, 95)),
+                "p99_ms": float(np.percentile(values, 99)),
+                "max_ms": float(values.max()),
+                "histogram": {f"le_{b}": int(c) for b, c in zip(BUCKETS_MS + ["inf"], counts)},
+            }
+        return {"requests": requests, "window": self.window, "stages": stages}
+
+    def reset(self):
+        with self.lock:
+            self.samples = {}
+            self.requests = 0
+
+
+## shared by custom.py (recording) and custom_flask.py (the /stats/ endpoint)
+request_stats = RollingStats()
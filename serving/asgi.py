@@ -0,0 +1,118 @@
+"""
+Usage:
+    python serving/asgi.py --bind 0.0.0.0:12346 --workers 4
+
+Lightweight async serving entry point for the umbrella model.  The model is loaded through
+the same hooks drum uses (custom-model/custom.py) and responses are byte for byte the same as
+`drum server`, so the two can be benchmarked side by side with benchmarks/load_test.py.
+"""
+import os
+import sys
+import asyncio
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from umbrella_server import UmbrellaModelServer
+
+logging.basicConfig(
+    level=logging.INFO,
+    stream=sys.stdout,
+    format='%(asctime)s %(filename)s:%(lineno)d %(levelname)s %(message)s',
+)
+logger = logging.getLogger(__name__)
+
+## under gunicorn (UMBRELLA_WORKER_CLASS=uvicorn.workers.UvicornWorker) the master sets
+## UMBRELLA_PREFORK and the model is loaded here, before the workers are forked.  standalone
+## uvicorn workers load it on lifespan startup instead
+server = UmbrellaModelServer(prefork=True) if os.environ.get("UMBRELLA_PREFORK") else None
+## scoring is cpu bound, it runs off the event loop so pings and keep-alive connections are
+## still served while a batch is being scored
+executor = ThreadPoolExecutor(max_workers=int(os.environ.get("UMBRELLA_SCORING_THREADS", 1)), thread_name_prefix="scoring")
+
+
+async def read_body(receive):
+    """consume the request body as it streams in, returns None if the client went away"""
+    body = bytearray()
+    more_body = True
+    while more_body:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        body.extend(message.get("body", b""))
+        more_body = message.get("more_body", False)
+    return bytes(body)
+
+
+async def lifespan(receive, send):
+    global server
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            try:
+                if server is None:
+                    server = await asyncio.get_running_loop().run_in_executor(None, UmbrellaModelServer)
+                await send({"type": "lifespan.startup.complete"})
+            except Exception as e:
+                logger.exception("failed to load the umbrella model")
+                await send({"type": "lifespan.startup.failed", "message": str(e)})
+        elif message["type"] == "lifespan.shutdown":
+            executor.shutdown(wait=True)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+    body = await read_body(receive)
+    if body is None:
+        return
+    headers = {k.decode("latin-1").title(): v.decode("latin-1") for k, v in scope.get("headers", [])}
+    args = (scope["method"], scope["path"], body, headers.get("Content-Type"), scope.get("query_string", b"").decode("latin-1"), headers)
+    if scope["method"] == "POST":
+        status, content_type, payload = await asyncio.get_running_loop().run_in_executor(executor, server.handle, *args)
+    else:
+        status, content_type, payload = server.handle(*args)
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", content_type.encode("latin-1")), (b"content-length", str(len(payload)).encode("latin-1"))],
+    })
+    await send({"type": "http.response.body", "body": payload})
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description=__doc__, usage='python %(prog)s [--bind 0.0.0.0:12346] [--workers 4]',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('--bind', help='host:port to listen on', default=os.environ.get("UMBRELLA_BIND", "0.0.0.0:12346"))
+    parser.add_argument('--workers', type=int, help='number of worker processes', default=int(os.environ.get("UMBRELLA_WORKERS", 1)))
+    parser.add_argument('--keep-alive', type=int, help='seconds to hold idle keep-alive connections open', default=5)
+    parser.add_argument('--log-level', default="info")
+    return parser.parse_args()
+
+
+def main():
+    import uvicorn
+    args = parse_args()
+    host, _, port = args.bind.rpartition(":")
+    uvicorn.run(
+        "asgi:app",
+        app_dir=os.path.dirname(os.path.abspath(__file__)),
+        host=host,
+        port=int(port),
+        workers=args.workers,
+        timeout_keep_alive=args.keep_alive,
+        log_level=args.log_level,
+        lifespan="on",
+    )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,62 @@
+## gunicorn -c serving/gunicorn.conf.py
+##
+## pre-forked multi worker serving for the umbrella model.  the model is loaded once in the
+## master (preload_app) and forked into UMBRELLA_WORKERS sync workers.  a single mlops reporter
+## process, forked from the master before the workers, owns the spooler and every worker sends
+## its reports to it over a queue.
+import os
+import sys
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+bind = os.environ.get("UMBRELLA_BIND", "0.0.0.0:12345")
+workers = int(os.environ.get("UMBRELLA_WORKERS", multiprocessing.cpu_count()))
+## sync wsgi workers by default, UMBRELLA_WORKER_CLASS=uvicorn.workers.UvicornWorker serves asgi.py instead
+worker_class = os.environ.get("UMBRELLA_WORKER_CLASS", "sync")
+if "uvicorn" in worker_class.lower():
+    os.environ["UMBRELLA_PREFORK"] = "1"
+    wsgi_app = "asgi:app"
+else:
+    wsgi_app = "wsgi:application"
+preload_app = True
+timeout = int(os.environ.get("UMBRELLA_TIMEOUT", 120))
+keepalive = 5
+loglevel = os.environ.get("UMBRELLA_LOG_LEVEL", "info")
+
+## worker slots, so every worker gets a stable 0..workers-1 id for its metrics port
+_free_slots = set(range(workers))
+_reporter = {}
+
+
+def when_ready(server):
+    if os.environ.get("MLOPS_SPOOLER_TYPE"):
+        from mlops_reporter import start_reporter
+        report_queue, process = start_reporter()
+        _reporter["queue"], _reporter["process"] = report_queue, process
+        server.log.info(f"mlops reporter running in pid {process.pid}")
+    else:
+        server.log.info("MLOPS_SPOOLER_TYPE not set, no shared mlops reporter started")
+
+
+def pre_fork(server, worker):
+    worker.slot = min(_free_slots) if _free_slots else len(server.WORKERS)
+    _free_slots.discard(worker.slot)
+
+
+def post_fork(server, worker):
+    import custom
+    custom.init_worker(worker.slot, _reporter.get("queue"))
+    server.log.info(f"worker {worker.slot} (pid {worker.pid}) ready")
+
+
+def child_exit(server, worker):
+    slot = getattr(worker, "slot", None)
+    if slot is not None and slot < workers:
+        _free_slots.add(slot)
+
+
+def on_exit(server):
+    if "queue" in _reporter:
+        from mlops_reporter import stop_reporter
+        stop_reporter(_reporter["queue"], _reporter["process"])
@@ -0,0 +1,94 @@
+import os
+import gc
+import sys
+import json
+import logging
+import importlib
+import traceback
+from pathlib import Path
+from urllib.parse import parse_qsl
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CODE_DIR = str(Path(__file__).resolve().parent.parent / "custom-model")
+## mimetypes drum decodes to str before calling score_unstructured, everything else is passed as bytes
+TEXTUAL_MIMETYPES = ("text/", "application/json")
+
+
+def parse_content_type(content_type):
+    """'application/text; charset=UTF-8' -> ('application/text', 'UTF-8')"""
+    if not content_type:
+        return None, None
+    parts = [p.strip() for p in content_type.split(";")]
+    mimetype = parts[0].lower() or None
+    charset = None
+    for param in parts[1:]:
+        key, _, value = param.partition("=")
+        if key.strip().lower() == "charset":
+            charset = value.strip().strip('"')
+    return mimetype, charset
+
+
+class UmbrellaModelServer(object):
+    """
+    loads the umbrella model through the same init / load_model / score_unstructured hooks that
+    drum uses (custom-model/custom.py) and answers requests the way drum's prediction server does,
+    so responses are byte for byte the same as `drum server`.
+    """
+
+    def __init__(self, code_dir=None, prefork=False):
+        self.code_dir = code_dir or os.environ.get("UMBRELLA_CODE_DIR", DEFAULT_CODE_DIR)
+        if self.code_dir not in sys.path:
+            sys.path.insert(0, self.code_dir)
+        self.custom = importlib.import_module("custom")
+        self.custom.init(code_dir=self.code_dir, prefork=prefork)
+        self.model = self.custom.load_model(self.code_dir)
+        logger.info(f"umbrella model loaded from {self.code_dir} in pid {os.getpid()}")
+        if prefork:
+            ## move everything loaded so far out of the gc's reach, otherwise the first collection in
+            ## each forked worker writes to every object header and un-shares the pages holding the models
+            gc.freeze()
+
+    def handle(self, method, path, body, content_type, query_string, headers=None):
+        """returns (status, content_type, body bytes)"""
+        route = "/" + path.strip("/")
+        if route in ["/", "/ping"] and method == "GET":
+            return 200, "application/json", json.dumps({"message": "OK"}).encode("utf-8")
+        if route == "/stats" and method == "GET":
+            return 200, "application/json", json.dumps(self.custom.get_stats()).encode("utf-8")
+        if route == "/metrics" and method == "GET":
+            metrics = importlib.import_module("metrics")
+            return 200, metrics.CONTENT_TYPE, metrics.registry.render().encode("utf-8")
+        if route == "/predictUnstructured" and method == "POST":
+            return self.predict_unstructured(body, content_type, query_string, headers or {})
+        return 404, "application/json", json.dumps({"message": f"ERROR: {method} {path} not found"}).encode("utf-8")
+
+    def predict_unstructured(self, body, content_type, query_string, headers):
+        mimetype, charset = parse_content_type(content_type)
+        mimetype = mimetype or "text/plain"
+        charset = charset or "utf8"
+        data = body.decode(charset) if mimetype.startswith(TEXTUAL_MIMETYPES) else body
+        query = dict(parse_qsl(query_string or ""))
+        try:
+            response = self.custom.score_unstructured(self.model, data, query, mimetype=mimetype, charset=charset, headers=headers)
+        except Exception as e:
+            logger.error(traceback.format_exc())
+            return 500, "application/json", json.dumps({"message": f"ERROR: {e}"}).encode("utf-8")
+        return self.resolve_response(response)
+
+    @staticmethod
+    def resolve_response(response):
+        out_kwargs = {}
+        if isinstance(response, tuple):
+            response, out_kwargs = response[0], (response[1] or {})
+        out_mimetype = out_kwargs.get("mimetype")
+        out_charset = out_kwargs.get("charset")
+        if isinstance(response, str):
+            out_mimetype = out_mimetype or "text/plain"
+            out_charset = out_charset or "utf8"
+            response = response.encode(out_charset)
+        elif response is None:
+            response = b""
+        out_mimetype = out_mimetype or "application/octet-stream"
+        out_content_type = f"{out_mimetype}; charset={out_charset}" if out_charset else out_mimetype
+        return 200, out_content_type, response
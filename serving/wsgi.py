@@ -0,0 +1,30 @@
+## WSGI entry point for multi worker serving, see gunicorn.conf.py.
+## with preload_app the model is loaded here once, in the gunicorn master, and the
+## workers get it through fork so the model memory is shared copy-on-write
+import logging
+from http import HTTPStatus
+
+from umbrella_server import UmbrellaModelServer
+
+logger = logging.getLogger(__name__)
+
+server = UmbrellaModelServer(prefork=True)
+
+
+def application(environ, start_response):
+    try:
+        length = int(environ.get("CONTENT_LENGTH") or 0)
+    except ValueError:
+        length = 0
+    body = environ["wsgi.input"].read(length) if length else b""
+    headers = {k[5:].replace("_", "-").title(): v for k, v in environ.items() if k.startswith("HTTP_")}
+    status, content_type, payload = server.handle(
+        environ["REQUEST_METHOD"],
+        environ.get("PATH_INFO", "/"),
+        body,
+        environ.get("CONTENT_TYPE"),
+        environ.get("QUERY_STRING"),
+        headers,
+    )
+    start_response(f"{status} {HTTPStatus(status).phrase}", [("Content-Type", content_type), ("Content-Length", str(len(payload)))])
+    return [payload]
@@ -0,0 +1,18 @@
+export MLOPS_SPOOLER_TYPE="FILESYSTEM"
+export MLOPS_FILESYSTEM_DIRECTORY="/tmp/ta"
+export MLOPS_DEPLOYMENT_ID="dummy_id_1234"
+export MLOPS_MODEL_ID="dummy_id_4321"
+export DEPLOYMENT_ID="dummy_id_1234" ## dummy id for umbrella model
+export MODEL_ID="dummy_id_4321"      ## dummy model package id for umbrella model
+
+## one process per core, so keep numpy / blas from starting a thread pool in every worker
+export OMP_NUM_THREADS=1
+export OPENBLAS_NUM_THREADS=1
+export MKL_NUM_THREADS=1
+
+export UMBRELLA_WORKERS=${UMBRELLA_WORKERS:-$(nproc)}
+export UMBRELLA_BIND="0.0.0.0:12345"
+export METRICS_PORT=9464             ## worker n serves metrics on 9464 + n
+
+echo "starting umbrella model with $UMBRELLA_WORKERS workers"
+exec gunicorn -c serving/gunicorn.conf.py